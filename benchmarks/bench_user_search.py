@@ -0,0 +1,115 @@
+"""Compare legacy regex search with the indexed search on a synthetic collection.
+
+Usage::
+
+    python benchmarks/bench_user_search.py --uri mongodb://localhost:27017 --users 1000000
+
+The script fills ``<db>.user_profiles`` with synthetic users (Thai and Latin
+display names), builds the search indexes, then runs each query with both
+strategies and prints wall time plus ``explain()`` docs/keys examined.
+Use a scratch database: ``--drop`` removes it when the run finishes.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from pymongo import MongoClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.search import build_search_query, ensure_search_indexes, search_fields  # noqa: E402
+
+LATIN_SYLLABLES = ["ka", "ri", "na", "to", "mi", "su", "le", "on", "pa", "chai", "win", "dee", "noi", "ploy"]
+THAI_SYLLABLES = ["สม", "ชาย", "หญิง", "มณี", "ทอง", "ศรี", "สุข", "ใจ", "ดี", "น้ำ", "ฝน", "ฟ้า", "แก้ว", "พร"]
+DEFAULT_QUERIES = ["chai", "pl", "dee noi", "สมชาย", "แก้ว", "ฟ้า", "zzzz"]
+
+
+def _random_name(rng: random.Random) -> str:
+    syllables = THAI_SYLLABLES if rng.random() < 0.6 else LATIN_SYLLABLES
+    word = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+    if rng.random() < 0.3:
+        word += " " + "".join(rng.choice(syllables) for _ in range(rng.randint(1, 3)))
+    return word.title()
+
+
+def populate(collection, users: int, batch_size: int, seed: int) -> None:
+    rng = random.Random(seed)
+    existing = collection.estimated_document_count()
+    batch = []
+    for i in range(existing, users):
+        name = _random_name(rng)
+        batch.append({
+            "line_id": "U" + f"{i:032x}",
+            "user_profiles": name,
+            "user_question_left": rng.randint(0, 50),
+            **search_fields(name),
+        })
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+            print(f"  inserted {i + 1}/{users}", end="\r", flush=True)
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    print()
+
+
+def _explain(collection, query, limit: int):
+    stats = collection.find(query, limit=limit).explain().get("executionStats", {})
+    return stats.get("totalDocsExamined"), stats.get("totalKeysExamined")
+
+
+def _time(collection, query, limit: int, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(collection.find(query, {"_id": 1}, limit=limit))
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="search_bench")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--query", action="append", dest="queries")
+    parser.add_argument("--drop", action="store_true", help="Drop the benchmark database afterwards.")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    collection = client[args.db]["user_profiles"]
+
+    print(f"Populating {args.db}.user_profiles with {args.users} users...")
+    populate(collection, args.users, args.batch_size, args.seed)
+    print("Building search indexes...")
+    ensure_search_indexes(collection)
+
+    header = f"{'query':<12} {'strategy':<8} {'median ms':>10} {'docs examined':>14} {'keys examined':>14}"
+    print(header)
+    print("-" * len(header))
+    for keyword in args.queries or DEFAULT_QUERIES:
+        strategies = {
+            "regex": {"user_profiles": {"$regex": re.escape(keyword), "$options": "i"}},
+            "indexed": build_search_query(keyword),
+        }
+        for label, query in strategies.items():
+            elapsed = _time(collection, query, args.limit, args.repeat)
+            docs, keys = _explain(collection, query, args.limit)
+            print(f"{keyword:<12} {label:<8} {elapsed:>10.1f} {docs!s:>14} {keys!s:>14}")
+
+    if args.drop:
+        client.drop_database(args.db)
+
+
+if __name__ == "__main__":
+    main()
@@ -77,10 +77,21 @@ def get_setting(dotted_key: str, default: Any = None, *, required: bool = False,
     return value
 
 
+def get_bool_setting(dotted_key: str, default: bool = False) -> bool:
+    """Resolve a boolean flag; accepts TOML booleans and common string spellings."""
+    value = get_setting(dotted_key, default=default)
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in {"1", "true", "yes", "on"}
+
+
 MONGO_URI: str = get_setting("mongo.uri", required=True)
 DB_NAME: str = get_setting("mongo.db_name", default="users")
 COLL_NAME: str = get_setting("mongo.collection", default="user_profiles")
 COLL_QUESTIONS_NAME: str = get_setting("mongo.questions_collection", default="questions")
+COLL_TOKEN_AUDIT_NAME: str = get_setting("mongo.token_audit_collection", default="token_audit")
+COLL_CALENDAR_ARCHIVE_NAME: str = get_setting("mongo.calendar_archive_collection", default="user_calendar_archive")
+COLL_USER_EVENTS_NAME: str = get_setting("mongo.events_collection", default="user_events")
 
 API_BASE_URL: str = get_setting("api.base_url", default="https://api.spmu.me")
 STAR_PREDICT_URL: str = get_setting("api.star_predict_url", default=f"{API_BASE_URL}/api/api5_star_predict")
@@ -89,3 +100,59 @@ STAR_PREDICT_URL: str = get_setting("api.star_predict_url", default=f"{API_BASE_
 MONGO_URL: str = get_setting("mongo.url", default=MONGO_URI)
 GPT_URL: str = get_setting("gpt.url", default="https://api.openai.com/v1/chat/completions")
 GPT_API_KEY: str = get_setting("gpt.api_key", default="", required=False)
+GPT_MODEL: str = get_setting("gpt.model", default="gpt-4o")
+GPT_ASYNC_ENABLED: bool = get_bool_setting("gpt.async_enabled", default=False)
+GPT_MAX_CONCURRENCY: int = int(get_setting("gpt.max_concurrency", default=32))
+GPT_CACHE_ENABLED: bool = get_bool_setting("gpt.cache_enabled", default=True)
+GPT_CACHE_TTL_DAYS: int = int(get_setting("gpt.cache_ttl_days", default=30))
+GPT_CACHE_MAX_ENTRIES: int = int(get_setting("gpt.cache_max_entries", default=50000))
+# USD per 1M tokens, used to report spend and cache savings.
+GPT_PRICE_INPUT_PER_1M: float = float(get_setting("gpt.price_input_per_1m", default=2.50))
+GPT_PRICE_OUTPUT_PER_1M: float = float(get_setting("gpt.price_output_per_1m", default=10.00))
+GPT_EST_COST_PER_DAY_USD: float = float(get_setting("gpt.est_cost_per_day_usd", default=0.03))
+GPT_REGEN_THROTTLE_SECONDS: float = float(get_setting("gpt.regen_throttle_seconds", default=2.0))
+
+SEARCH_AUTOCOMPLETE_ENABLED: bool = get_bool_setting("search.autocomplete_enabled", default=True)
+SEARCH_AUTOCOMPLETE_REFRESH_SECONDS: float = float(get_setting("search.autocomplete_refresh_seconds", default=30))
+
+# Multi-document transactions need a replica set or sharded cluster (Atlas qualifies).
+MONGO_USE_TRANSACTIONS: bool = get_bool_setting("mongo.use_transactions", default=False)
+# Create registered indexes that are missing when the app first connects (otherwise only report them).
+MONGO_CREATE_INDEXES: bool = get_bool_setting("mongo.create_indexes", default=False)
+
+# Send search, calendar, reference-data and export reads to secondaries (bounded staleness); writes stay on the primary.
+READ_ROUTING_ENABLED: bool = get_bool_setting("read_routing.enabled", default=False)
+READ_MAX_STALENESS_SECONDS: int = int(get_setting("read_routing.max_staleness_seconds", default=120))
+_secondary_routes = get_setting("read_routing.secondary_routes", default="search,calendar,reference,export")
+READ_SECONDARY_ROUTES: tuple = tuple(
+    route.strip()
+    for route in (_secondary_routes.split(",") if isinstance(_secondary_routes, str) else _secondary_routes)
+    if route.strip()
+)
+
+# Streaming exports: documents per cursor batch, where files are written (empty: system temp dir),
+# and the largest file offered as a browser download.
+EXPORT_BATCH_SIZE: int = int(get_setting("export.batch_size", default=5000))
+EXPORT_DIR: str = get_setting("export.dir", default="")
+EXPORT_DOWNLOAD_MAX_MB: int = int(get_setting("export.download_max_mb", default=200))
+
+JOBS_MAX_WORKERS: int = int(get_setting("jobs.max_workers", default=4))
+# Separate pool for bulk calendar/GPT work so it cannot starve the shared one.
+JOBS_BULK_MAX_WORKERS: int = int(get_setting("jobs.bulk_max_workers", default=2))
+# Run the upgrade's star prediction / GPT step as a background job instead of inline.
+UPGRADE_BACKGROUND_CALENDAR: bool = get_bool_setting("upgrade.background_calendar", default=True)
+
+# How period_predictions days are written: "full" (star detail texts, what the LINE
+# API reads today), "ids" or "bitmask" (compact; texts joined from StarDetail.csv).
+PREDICTION_STORAGE: str = get_setting("calendar.prediction_storage", default="full")
+# "copy" writes general calendar entries into calendar_basic on each user; "reference"
+# stores only calendar_basic_range and resolves days from the shared calendar collections.
+CALENDAR_BASIC_STORAGE: str = get_setting("calendar.basic_storage", default="copy")
+# "embedded" keeps day maps in user_profiles; "bucketed" stores them per user and month.
+CALENDAR_STORAGE: str = get_setting("calendar.storage", default="embedded")
+
+# Predictions / GPT days older than this many days (and before the current period) are archived.
+ARCHIVE_HORIZON_DAYS: int = int(get_setting("archive.horizon_days", default=180))
+
+# Keep only the newest N history_log entries on the user (0 keeps all); full history is in user_events.
+HISTORY_TAIL_CAP: int = int(get_setting("history.tail_cap", default=0))
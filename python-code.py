@@ -12,9 +12,13 @@ if str(CURRENT_DIR) not in sys.path:
 
 import config  # noqa: E402
 from search_display import render_search_and_results  # noqa: E402
+from tab_bulk_tokens import render_bulk_tokens_tab  # noqa: E402
+from tab_bulk_upgrade import render_bulk_upgrade_tab  # noqa: E402
 from tab_delete_user import render_delete_user_tab  # noqa: E402
 from tab_edit_user import render_edit_user_tab  # noqa: E402
+from tab_export import render_export_tab  # noqa: E402
 from tab_manage_calendar import render_manage_calendar_tab  # noqa: E402
+from tab_maintenance import missing_index_count, render_maintenance_tab  # noqa: E402
 from tab_manage_questions import render_manage_questions_tab  # noqa: E402
 from tab_upgrade_user import render_upgrade_user_tab  # noqa: E402
 from um_utils import ensure_session, get_db  # noqa: E402
@@ -31,6 +35,9 @@ with st.status("Connecting to MongoDB...", expanded=False) as status_box:
         st.session_state.collection = db[config.COLL_NAME]
         st.session_state.collection_questions = db[config.COLL_QUESTIONS_NAME]
         st.session_state.collection_transactions = db.get_collection("transactions")
+        st.session_state.collection_token_audit = db[config.COLL_TOKEN_AUDIT_NAME]
+        st.session_state.collection_calendar_archive = db[config.COLL_CALENDAR_ARCHIVE_NAME]
+        st.session_state.collection_user_events = db[config.COLL_USER_EVENTS_NAME]
         st.session_state.mongo_client = client
         st.session_state.connected = True
         status_box.update(label="MongoDB connection established.", state="complete")
@@ -41,29 +48,56 @@ with st.status("Connecting to MongoDB...", expanded=False) as status_box:
         st.error(f"Unable to connect to MongoDB: {exc}")
         st.stop()
 
+if missing := missing_index_count():
+    st.warning(f"{missing} registered index(es) are missing; hot queries may scan whole collections. See Maintenance.")
 
-render_search_and_results()
-
-user = st.session_state.get("found_user")
-if user:
-    tab_labels = [
-        "Edit Profile",
-        "Upgrade Package",
-        "Manage Custom Questions",
-        "Manage Calendar",
-        "Delete User",
-    ]
-    tabs = st.tabs(tab_labels)
-
-    with tabs[0]:
-        render_edit_user_tab(user)
-    with tabs[1]:
-        render_upgrade_user_tab(user)
-    with tabs[2]:
-        render_manage_questions_tab()
-    with tabs[3]:
-        render_manage_calendar_tab(user)
-    with tabs[4]:
-        render_delete_user_tab(user)
-else:
-    st.info("Search for a user and load their profile to access management actions.")
+
+def render_users_workspace() -> None:
+    render_search_and_results()
+
+    user = st.session_state.get("found_user")
+    if user:
+        # A radio instead of st.tabs: st.tabs runs every tab body on each rerun, which
+        # would fetch every lazy facet of the user up front.
+        tab_renderers = {
+            "Edit Profile": lambda: render_edit_user_tab(user),
+            "Upgrade Package": lambda: render_upgrade_user_tab(user),
+            "Manage Custom Questions": render_manage_questions_tab,
+            "Manage Calendar": lambda: render_manage_calendar_tab(user),
+            "Delete User": lambda: render_delete_user_tab(user),
+        }
+        active_tab = st.radio(
+            "Section",
+            options=list(tab_renderers),
+            key="active_user_tab",
+            horizontal=True,
+            label_visibility="collapsed",
+        )
+        tab_renderers[active_tab]()
+    else:
+        st.info("Search for a user and load their profile to access management actions.")
+
+
+def render_bulk_workspace() -> None:
+    operations = {
+        "Package upgrade": render_bulk_upgrade_tab,
+        "Token adjustment": render_bulk_tokens_tab,
+    }
+    operation = st.radio(
+        "Operation",
+        options=list(operations),
+        key="bulk_operation",
+        horizontal=True,
+        label_visibility="collapsed",
+    )
+    operations[operation]()
+
+
+WORKSPACES = {
+    "Users": render_users_workspace,
+    "Bulk operations": render_bulk_workspace,
+    "Export": render_export_tab,
+    "Maintenance": render_maintenance_tab,
+}
+workspace = st.radio("Workspace", options=list(WORKSPACES), key="workspace", horizontal=True)
+WORKSPACES[workspace]()
@@ -1,15 +1,37 @@
 """Search utilities and result rendering for the User Admin console."""
 from __future__ import annotations
 
-from typing import Any, Dict, List
-
-import pandas as pd
+import pyarrow as pa
 import streamlit as st
 
-from um_utils import as_int, get_user_type, load_user_data
+import config
+from services.search import (
+    backfill_search_fields,
+    count_missing_search_fields,
+    ensure_search_indexes,
+    estimate_search_total,
+)
+from services import read_routing
+from services.autocomplete import POLL_REBUILD_SECONDS
+from services.tables import search_display_table
+from um_utils import (
+    get_autocomplete_index,
+    load_search_page,
+    load_user_data,
+    read_collection,
+    render_table_downloads,
+)
+
+
+PAGE_SIZE_OPTIONS = [25, 50, 100, 200]
+SUGGESTION_LIMIT = 8
 
 
-SearchResult = Dict[str, Any]
+def _reset_pagination() -> None:
+    st.session_state.search_page_index = 0
+    st.session_state.search_page_cursors = [None]
+    st.session_state.search_has_more = False
+    st.session_state.search_total = None
 
 
 def _trigger_search() -> None:
@@ -17,7 +39,90 @@ def _trigger_search() -> None:
     st.session_state.do_search = True
     st.session_state.selected_id = None
     st.session_state.found_user = None
-    st.session_state.user_questions = []
+    st.session_state.user_facets = {}
+    _reset_pagination()
+
+
+def _next_page() -> None:
+    rows = st.session_state.get("search_results")
+    if rows is None or not rows.num_rows or not st.session_state.search_has_more:
+        return
+    page_index = st.session_state.search_page_index + 1
+    cursors = st.session_state.search_page_cursors
+    if page_index >= len(cursors):
+        last = rows.num_rows - 1
+        cursors.append((rows["sort_name"][last].as_py(), rows["doc_id"][last].as_py()))
+    st.session_state.search_page_index = page_index
+    st.session_state.do_search = True
+
+
+def _previous_page() -> None:
+    if st.session_state.search_page_index > 0:
+        st.session_state.search_page_index -= 1
+        st.session_state.do_search = True
+
+
+def _change_page_size() -> None:
+    # Cursors depend on the page boundaries, so start over from the first page.
+    keep_total = st.session_state.search_total
+    _reset_pagination()
+    st.session_state.search_total = keep_total
+    st.session_state.do_search = True
+
+
+def _load_suggestion(doc_id: str) -> None:
+    st.session_state.selected_id = doc_id
+    success, message = load_user_data(doc_id)
+    if not success:
+        st.session_state.suggestion_error = message
+
+
+def _render_suggestions() -> None:
+    """Prefix matches from the in-memory name index, shown without a database round trip."""
+    if not config.SEARCH_AUTOCOMPLETE_ENABLED:
+        return
+    text = (st.session_state.kw or "").strip()
+    if not text:
+        return
+    index = get_autocomplete_index()
+    if not index.ready:
+        st.caption("Name suggestions are warming up...")
+        return
+    suggestions = index.suggest(text, limit=SUGGESTION_LIMIT)
+    if not suggestions:
+        return
+    st.caption("Suggestions")
+    columns = st.columns(min(len(suggestions), 4))
+    for idx, suggestion in enumerate(suggestions):
+        columns[idx % len(columns)].button(
+            suggestion["name"] or "(no name)",
+            key=f"suggestion_{suggestion['doc_id']}",
+            use_container_width=True,
+            on_click=_load_suggestion,
+            args=(suggestion["doc_id"],),
+        )
+    error = st.session_state.pop("suggestion_error", None)
+    if error:
+        st.error(error)
+
+
+def _render_autocomplete_stats() -> None:
+    if not config.SEARCH_AUTOCOMPLETE_ENABLED:
+        return
+    stats = get_autocomplete_index().stats()
+    lag = stats["refresh_lag_seconds"]
+    st.caption(
+        f"Autocomplete index ({stats['mode']}): {stats['users']} users, {stats['entries']} entries, "
+        f"~{stats['approx_memory_mb']} MB"
+        + (f", refreshed {lag}s ago" if lag is not None else "")
+    )
+    if stats["mode"] == "polling":
+        st.caption(
+            "No change stream on this deployment: renames are polled, and deleted users stay suggestible "
+            f"until the next full rebuild (every {POLL_REBUILD_SECONDS // 60} minutes)."
+        )
+    if stats["last_error"]:
+        st.caption(f"Last refresh error: {stats['last_error']}")
 
 
 def _ensure_collection() -> bool:
@@ -30,14 +135,75 @@ def _ensure_collection() -> bool:
     return True
 
 
-def _run_search(keyword: str) -> List[SearchResult]:
-    query = {"user_profiles": {"$regex": keyword, "$options": "i"}}
-    collection = st.session_state.collection
-    results = list(collection.find(query, limit=200))
-    st.session_state.search_results = results
+def _run_search(keyword: str) -> pa.Table:
+    results = load_search_page(keyword)
+    if st.session_state.search_total is None:
+        with read_routing.timed("search"):
+            st.session_state.search_total = estimate_search_total(
+                read_collection(st.session_state.collection, "search"), keyword
+            )
     return results
 
 
+def _format_total() -> str:
+    total = st.session_state.get("search_total")
+    if not total:
+        return ""
+    count, capped = total
+    return f"{count}+" if capped else str(count)
+
+
+def _render_search_index_maintenance() -> None:
+    with st.expander("Search index maintenance", expanded=False):
+        st.caption(
+            "Searches use normalized name fields with an n-gram index. "
+            "Users created or renamed outside this console need a backfill before they are indexed."
+        )
+        _render_autocomplete_stats()
+        if st.button("Build search index and backfill users", use_container_width=True):
+            if not _ensure_collection():
+                return
+            collection = st.session_state.collection
+            with st.status("Updating search index...", expanded=False) as status_box:
+                try:
+                    ensure_search_indexes(collection)
+                    updated = backfill_search_fields(collection)
+                    remaining = count_missing_search_fields(collection)
+                    status_box.update(label=f"Indexed {updated} user(s); {remaining} remaining.", state="complete")
+                except Exception as exc:  # noqa: BLE001
+                    status_box.update(label="Search index update failed.", state="error")
+                    st.error(f"Unable to update the search index: {exc}")
+
+
+def _render_pagination(row_count: int) -> None:
+    page_index = st.session_state.search_page_index
+    first = page_index * int(st.session_state.search_page_size) + 1
+    prev_col, info_col, size_col, next_col = st.columns([1, 2, 1, 1])
+    prev_col.button(
+        "Previous",
+        use_container_width=True,
+        disabled=page_index == 0,
+        on_click=_previous_page,
+    )
+    total = _format_total()
+    info_col.caption(
+        f"Page {page_index + 1}: users {first}-{first + row_count - 1}" + (f" of {total}" if total else "")
+    )
+    size_col.selectbox(
+        "Page size",
+        options=PAGE_SIZE_OPTIONS,
+        key="search_page_size",
+        label_visibility="collapsed",
+        on_change=_change_page_size,
+    )
+    next_col.button(
+        "Next",
+        use_container_width=True,
+        disabled=not st.session_state.search_has_more,
+        on_click=_next_page,
+    )
+
+
 def render_search_and_results() -> None:
     """Render search form, results table, and user selection controls."""
     st.subheader("Search for users")
@@ -48,6 +214,7 @@ def render_search_and_results() -> None:
         placeholder="Enter part of the LINE display name",
         on_change=_trigger_search,
     )
+    _render_suggestions()
     st.button("Search", use_container_width=True, on_click=_trigger_search)
 
     if st.session_state.do_search:
@@ -58,8 +225,8 @@ def render_search_and_results() -> None:
             with st.status(f"Searching for '{keyword}'...", expanded=False) as status_box:
                 try:
                     results = _run_search(keyword)
-                    if results:
-                        status_box.update(label=f"Found {len(results)} user(s).", state="complete")
+                    if results.num_rows:
+                        status_box.update(label=f"Found {_format_total()} user(s).", state="complete")
                     else:
                         status_box.update(label="No users matched that query.", state="complete")
                 except Exception as exc:  # noqa: BLE001
@@ -67,50 +234,34 @@ def render_search_and_results() -> None:
                     st.error(f"Unable to fetch results: {exc}")
         st.session_state.do_search = False
 
-    results = st.session_state.get("search_results", [])
-    if not results:
-        return
+    _render_search_index_maintenance()
 
-    dataframe_rows: List[Dict[str, Any]] = []
-    backend_rows: List[Dict[str, str]] = []
-    for doc in results:
-        doc_id = str(doc.get("_id"))
-        name = str(doc.get("user_profiles", ""))
-        dataframe_rows.append(
-            {
-                "LINE Name": name,
-                "LINE ID": str(doc.get("line_id", "")),
-                "Tokens": as_int(doc.get("user_question_left", 0)),
-                "User Type": get_user_type(doc),
-            }
-        )
-        backend_rows.append({"doc_id": doc_id, "name": name})
-
-    st.dataframe(pd.DataFrame(dataframe_rows), hide_index=True, use_container_width=True)
-
-    if not backend_rows:
+    results = st.session_state.get("search_results")
+    if results is None or not results.num_rows:
         return
 
-    previous_index = 0
+    table = search_display_table(results)
+    st.dataframe(table, hide_index=True, use_container_width=True)
+    _render_pagination(results.num_rows)
+    render_table_downloads(
+        table, "search_results", key="search_results", stamp=st.session_state.get("search_results_stamp")
+    )
+
+    doc_ids = results["doc_id"].to_pylist()
+    names = [name or f"User {idx + 1}" for idx, name in enumerate(results["name"].to_pylist())]
     selected_id = st.session_state.get("selected_id")
-    if selected_id:
-        for idx, row in enumerate(backend_rows):
-            if row["doc_id"] == selected_id:
-                previous_index = idx
-                break
+    previous_index = doc_ids.index(selected_id) if selected_id in doc_ids else 0
 
-    names = [row["name"] or f"User {idx + 1}" for idx, row in enumerate(backend_rows)]
     selected_idx = st.selectbox(
         "Pick a user to load",
-        options=list(range(len(backend_rows))),
+        options=list(range(len(doc_ids))),
         index=previous_index,
         format_func=lambda idx: names[idx],
     )
-    chosen_row = backend_rows[selected_idx]
 
     if st.button("Load user profile", type="primary", use_container_width=True):
-        doc_id = chosen_row.get("doc_id")
-        display_name = chosen_row.get("name") or "selected user"
+        doc_id = doc_ids[selected_idx]
+        display_name = results["name"][selected_idx].as_py() or "selected user"
         if doc_id:
             with st.status(f"Loading data for {display_name}...", expanded=False) as status_box:
                 success, message = load_user_data(doc_id)
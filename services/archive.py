@@ -0,0 +1,243 @@
+"""Cold archive for old calendar days.
+
+Star predictions and GPT days far in the past are rarely read but ride along in
+every hot read of the user. The archiver moves days older than
+``archive.horizon_days`` into ``user_calendar_archive``, one document per
+``(line_id, YYYY-MM)`` in the same shape as the calendar buckets
+(``predictions`` / ``gpt`` sub-maps). Days inside the user's current
+``period_available`` are never archived, so GPT generation for the period still
+sees them.
+
+Both storage layouts are handled: embedded days are ``$unset`` from the user
+document, and the prediction/GPT maps of buckets whose whole month is before
+the cutoff are moved (see ``calendar_store``).
+"""
+from __future__ import annotations
+
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List
+
+from pymongo import ASCENDING, UpdateOne
+
+import config
+from . import calendar_store, jobs
+from .indexes import create_group_indexes
+
+ARCHIVE_JOB_KEY = "archive:calendar"
+# User-document maps that are archived; calendar_basic is cheap to rebuild and stays hot.
+ARCHIVED_MAPS = ("period_predictions", "period_predictions_gpt")
+
+
+def archive_cutoff(horizon_days: int | None = None, today: date | None = None) -> str:
+    """ISO date; days strictly before it are old enough to archive."""
+    horizon_days = config.ARCHIVE_HORIZON_DAYS if horizon_days is None else int(horizon_days)
+    return ((today or date.today()) - timedelta(days=horizon_days)).isoformat()
+
+
+def ensure_archive_indexes(archive_collection) -> None:
+    create_group_indexes(archive_collection, "calendar_archive")
+
+
+def _old_days_expr(field: str) -> Dict[str, Any]:
+    """``{date: value}`` of ``field`` restricted to keys before ``$$cutoff``."""
+    return {
+        "$arrayToObject": {
+            "$filter": {
+                "input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}},
+                "cond": {"$lt": ["$$this.k", "$$cutoff"]},
+            }
+        }
+    }
+
+
+def _embedded_pipeline(cutoff: str) -> List[Dict[str, Any]]:
+    return [
+        {"$match": {"$or": [{field: {"$type": "object"}} for field in ARCHIVED_MAPS]}},
+        {"$sort": {"_id": 1}},
+        {
+            "$project": {
+                "line_id": 1,
+                "old": {
+                    "$let": {
+                        # Never reach into the current period.
+                        "vars": {"cutoff": {"$min": [cutoff, {"$ifNull": ["$period_available.start_date", cutoff]}]}},
+                        "in": {field: _old_days_expr(field) for field in ARCHIVED_MAPS},
+                    }
+                },
+            }
+        },
+        {"$match": {"$or": [{f"old.{field}": {"$ne": {}}} for field in ARCHIVED_MAPS]}},
+    ]
+
+
+def _archive_embedded(collection, archive_collection, cutoff, batch_size, summary, on_batch) -> None:
+    archive_ops: List[UpdateOne] = []
+    user_ops: List[UpdateOne] = []
+
+    def _flush() -> None:
+        if archive_ops:
+            # Copy first: a failure in between leaves days in both places, never in neither.
+            archive_collection.bulk_write(archive_ops, ordered=False)
+            collection.bulk_write(user_ops, ordered=False)
+        archive_ops.clear()
+        user_ops.clear()
+        if on_batch is not None:
+            on_batch(summary)
+
+    for doc in collection.aggregate(_embedded_pipeline(cutoff), allowDiskUse=True, batchSize=batch_size):
+        line_id = doc.get("line_id")
+        if not line_id:
+            continue
+        updates = {
+            f"{field}.{date_key}": value
+            for field in ARCHIVED_MAPS
+            for date_key, value in ((doc.get("old") or {}).get(field) or {}).items()
+        }
+        _, month_sets = calendar_store.split_day_updates(updates)
+        archive_ops.extend(calendar_store.bucket_operations(line_id, month_sets))
+        user_ops.append(UpdateOne({"_id": doc["_id"]}, {"$unset": {field: "" for field in updates}}))
+        summary["users"] += 1
+        summary["days"] += len(updates)
+        if len(user_ops) >= batch_size:
+            _flush()
+    _flush()
+
+
+def _archive_buckets(collection, archive_collection, cutoff, batch_size, summary, on_batch) -> None:
+    buckets = calendar_store.bucket_collection(collection.database)
+    projection = {"line_id": 1, "month": 1, "predictions": 1, "gpt": 1, "updated_at": 1}
+    cursor = buckets.find(
+        {
+            "month": {"$lt": calendar_store.month_of(cutoff)},
+            "$or": [{"predictions": {"$exists": True}}, {"gpt": {"$exists": True}}],
+        },
+        projection,
+        batch_size=batch_size,
+    ).sort([("line_id", ASCENDING), ("month", ASCENDING)])
+
+    batch: List[Dict[str, Any]] = []
+
+    def _flush() -> None:
+        line_ids = sorted({bucket["line_id"] for bucket in batch})
+        period_starts = {
+            user["line_id"]: (user.get("period_available") or {}).get("start_date")
+            for user in collection.find({"line_id": {"$in": line_ids}}, {"line_id": 1, "period_available.start_date": 1})
+        }
+        archive_ops: List[UpdateOne] = []
+        bucket_ops: List[UpdateOne] = []
+        for bucket in batch:
+            user_cutoff = min(filter(None, [cutoff, period_starts.get(bucket["line_id"])]))
+            # Whole months only: the bucket's last possible day must be before the cutoff.
+            if bucket["month"] >= calendar_store.month_of(user_cutoff):
+                continue
+            month_set = {
+                f"{sub}.{date_key}": value
+                for sub in ("predictions", "gpt")
+                for date_key, value in (bucket.get(sub) or {}).items()
+            }
+            if month_set:
+                archive_ops.extend(
+                    calendar_store.bucket_operations(bucket["line_id"], {bucket["month"]: month_set})
+                )
+            # Basic days stay in the bucket; skip it if it was written to since it was read.
+            bucket_ops.append(
+                UpdateOne(
+                    {"_id": bucket["_id"], "updated_at": bucket.get("updated_at")},
+                    {"$unset": {"predictions": "", "gpt": ""}},
+                )
+            )
+            summary["buckets"] += 1
+            summary["days"] += len(month_set)
+        if archive_ops:
+            archive_collection.bulk_write(archive_ops, ordered=False)
+        if bucket_ops:
+            buckets.bulk_write(bucket_ops, ordered=False)
+        batch.clear()
+        if on_batch is not None:
+            on_batch(summary)
+
+    for bucket in cursor:
+        batch.append(bucket)
+        if len(batch) >= batch_size:
+            _flush()
+    if batch:
+        _flush()
+
+
+def archive_old_calendar_days(
+    collection,
+    archive_collection,
+    *,
+    horizon_days: int | None = None,
+    batch_size: int = 200,
+    on_batch: Callable[[Dict[str, int]], None] | None = None,
+) -> Dict[str, Any]:
+    """
+    Move calendar days older than the horizon into ``archive_collection``.
+
+    Returns ``{cutoff, users, buckets, days}``; ``on_batch(summary)`` is called
+    after each batch with the running totals.
+    """
+    cutoff = archive_cutoff(horizon_days)
+    ensure_archive_indexes(archive_collection)
+    summary: Dict[str, Any] = {"cutoff": cutoff, "users": 0, "buckets": 0, "days": 0}
+    _archive_embedded(collection, archive_collection, cutoff, batch_size, summary, on_batch)
+    if calendar_store.is_bucketed():
+        _archive_buckets(collection, archive_collection, cutoff, batch_size, summary, on_batch)
+    return summary
+
+
+def submit_archive_job(collection, archive_collection, *, horizon_days: int | None = None) -> str:
+    """Run ``archive_old_calendar_days`` as a background job; returns the job id."""
+
+    def _job(progress):
+        return archive_old_calendar_days(
+            collection,
+            archive_collection,
+            horizon_days=horizon_days,
+            on_batch=lambda summary: progress(**summary),
+        )
+
+    return jobs.submit(ARCHIVE_JOB_KEY, _job, kind="archive", horizon_days=horizon_days)
+
+
+def load_archived_days(
+    archive_collection,
+    line_id: str,
+    start_date: str | None = None,
+    end_date: str | None = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Archived days of one user as ``{"period_predictions": {...}, "period_predictions_gpt": {...}}``.
+
+    The optional ISO bounds limit the fetch to the months they touch and clip the days.
+    """
+    query: Dict[str, Any] = {"line_id": line_id}
+    months: Dict[str, str] = {}
+    if start_date:
+        months["$gte"] = calendar_store.month_of(start_date)
+    if end_date:
+        months["$lte"] = calendar_store.month_of(end_date)
+    if months:
+        query["month"] = months
+    low, high = start_date or "0000-00-00", end_date or "9999-99-99"
+    result: Dict[str, Dict[str, Any]] = {field: {} for field in ARCHIVED_MAPS}
+    for doc in archive_collection.find(query, {"predictions": 1, "gpt": 1}).sort("month", ASCENDING):
+        for field, source in (("period_predictions", "predictions"), ("period_predictions_gpt", "gpt")):
+            result[field].update(
+                (date_key, value) for date_key, value in (doc.get(source) or {}).items() if low <= date_key <= high
+            )
+    return result
+
+
+def archived_month_counts(archive_collection, line_id: str) -> Dict[str, int]:
+    """``{month: days}`` archived for one user, from the date keys only."""
+    keys = [
+        {"$map": {"input": {"$objectToArray": {"$ifNull": [f"${source}", {}]}}, "in": "$$this.k"}}
+        for source in ("predictions", "gpt")
+    ]
+    pipeline = [
+        {"$match": {"line_id": line_id}},
+        {"$project": {"month": 1, "days": {"$size": {"$setUnion": keys}}}},
+    ]
+    return {row["month"]: row["days"] for row in archive_collection.aggregate(pipeline) if row["days"]}
@@ -0,0 +1,258 @@
+"""Process-wide autocomplete index of LINE display names.
+
+The index is a sorted array of ``(token, doc_id)`` pairs, where tokens are the
+normalised full name plus each of its words, so prefix lookups are a binary
+search followed by a short scan. It is built once per process and kept fresh
+from a MongoDB change stream when the deployment supports one, otherwise by
+polling ``updated_at`` (indexed, see ``services/indexes.py``). Polling cannot
+see deletes, so in that mode the index is also rebuilt every
+``POLL_REBUILD_SECONDS`` to drop deleted users.
+"""
+from __future__ import annotations
+
+import bisect
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .search import normalize_name
+
+PROJECTION = {"user_profiles": 1, "updated_at": 1}
+# Only name changes (plus inserts, replaces and deletes) leave the server, and
+# only the name: other user writes, e.g. per-day GPT stores, are filtered out.
+CHANGE_PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                {"operationType": "update", "updateDescription.updatedFields.user_profiles": {"$exists": True}},
+            ]
+        }
+    },
+    {
+        "$project": {
+            "operationType": 1,
+            "documentKey": 1,
+            "fullDocument.user_profiles": 1,
+            "updateDescription.updatedFields.user_profiles": 1,
+        }
+    },
+]
+# In polling mode deleted users linger until the next full rebuild.
+POLL_REBUILD_SECONDS = 3600
+# Rough per-entry cost of the two parallel lists (one pointer each).
+_POINTER_BYTES = 16
+
+
+def _tokens(normalized: str) -> List[str]:
+    if not normalized:
+        return []
+    tokens = {normalized}
+    tokens.update(word for word in normalized.split(" ") if word)
+    return sorted(tokens)
+
+
+def _user_bytes(display: str, normalized: str, tokens: List[str]) -> int:
+    return (
+        sys.getsizeof(display)
+        + sys.getsizeof(normalized)
+        + sum(sys.getsizeof(token) + _POINTER_BYTES for token in tokens)
+    )
+
+
+class AutocompleteIndex:
+    def __init__(self, collection, *, refresh_seconds: float = 30.0) -> None:
+        self._collection = collection
+        self._refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self._keys: List[str] = []
+        self._ids: List[str] = []
+        self._names: Dict[str, Tuple[str, str]] = {}
+        self._last_seen: Any = None
+        self._approx_bytes = 0
+        self._thread: threading.Thread | None = None
+        self.ready = False
+        self.mode = "starting"
+        self.last_refresh_at: float | None = None
+        self.last_change_at: float | None = None
+        self.build_seconds: float | None = None
+        self.last_error: str | None = None
+
+    # -- maintenance -----------------------------------------------------
+    def start(self) -> None:
+        """Build the index and keep it fresh from a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="autocomplete-index", daemon=True)
+            self._thread.start()
+
+    def build(self) -> None:
+        started = time.perf_counter()
+        pairs: List[Tuple[str, str]] = []
+        names: Dict[str, Tuple[str, str]] = {}
+        last_seen = None
+        approx_bytes = 0
+        for doc in self._collection.find({}, PROJECTION, batch_size=5000):
+            doc_id = str(doc["_id"])
+            display = str(doc.get("user_profiles") or "")
+            normalized = normalize_name(display)
+            tokens = _tokens(normalized)
+            names[doc_id] = (display, normalized)
+            pairs.extend((token, doc_id) for token in tokens)
+            approx_bytes += _user_bytes(display, normalized, tokens)
+            updated_at = doc.get("updated_at")
+            if updated_at is not None and (last_seen is None or _safe_gt(updated_at, last_seen)):
+                last_seen = updated_at
+        pairs.sort()
+        with self._lock:
+            self._keys = [token for token, _ in pairs]
+            self._ids = [doc_id for _, doc_id in pairs]
+            self._names = names
+            self._last_seen = last_seen
+            self._approx_bytes = approx_bytes
+        self.build_seconds = time.perf_counter() - started
+        self.last_refresh_at = time.time()
+        self.ready = True
+
+    def upsert(self, doc_id: str, display_name: str) -> None:
+        normalized = normalize_name(display_name)
+        display = str(display_name or "")
+        tokens = _tokens(normalized)
+        with self._lock:
+            self._remove_locked(doc_id)
+            self._names[doc_id] = (display, normalized)
+            self._approx_bytes += _user_bytes(display, normalized, tokens)
+            for token in tokens:
+                index = bisect.bisect_left(self._keys, token)
+                while index < len(self._keys) and self._keys[index] == token and self._ids[index] < doc_id:
+                    index += 1
+                self._keys.insert(index, token)
+                self._ids.insert(index, doc_id)
+        self.last_change_at = time.time()
+
+    def remove(self, doc_id: str) -> None:
+        with self._lock:
+            self._remove_locked(doc_id)
+            self._names.pop(doc_id, None)
+        self.last_change_at = time.time()
+
+    def _remove_locked(self, doc_id: str) -> None:
+        previous = self._names.get(doc_id)
+        if not previous:
+            return
+        tokens = _tokens(previous[1])
+        self._approx_bytes -= _user_bytes(previous[0], previous[1], tokens)
+        for token in tokens:
+            index = bisect.bisect_left(self._keys, token)
+            while index < len(self._keys) and self._keys[index] == token:
+                if self._ids[index] == doc_id:
+                    del self._keys[index]
+                    del self._ids[index]
+                    break
+                index += 1
+
+    def poll_changes(self) -> int:
+        """
+        Apply documents whose ``updated_at`` moved past the last value seen (any
+        document carrying one when none was seen at build time).
+        """
+        changed = 0
+        since = {"$gt": self._last_seen} if self._last_seen is not None else {"$exists": True, "$ne": None}
+        cursor = self._collection.find({"updated_at": since}, PROJECTION).sort("updated_at", 1)
+        for doc in cursor:
+            self.upsert(str(doc["_id"]), doc.get("user_profiles") or "")
+            self._last_seen = doc.get("updated_at", self._last_seen)
+            changed += 1
+        self.last_refresh_at = time.time()
+        return changed
+
+    def _watch(self) -> None:
+        # Updates carry the new name in updatedFields, so no updateLookup is needed.
+        with self._collection.watch(CHANGE_PIPELINE) as stream:
+            self.mode = "change_stream"
+            for change in stream:
+                doc_id = str(change["documentKey"]["_id"])
+                if change["operationType"] == "delete":
+                    self.remove(doc_id)
+                    continue
+                if change["operationType"] == "update":
+                    source = (change.get("updateDescription") or {}).get("updatedFields") or {}
+                else:
+                    source = change.get("fullDocument") or {}
+                self.upsert(doc_id, source.get("user_profiles") or "")
+                self.last_refresh_at = time.time()
+
+    def _run(self) -> None:
+        try:
+            self.build()
+        except PyMongoError as exc:
+            self.last_error = str(exc)
+            self.mode = "error"
+            return
+        while True:
+            try:
+                self._watch()
+            except OperationFailure:
+                # Standalone servers have no change streams; fall back to polling.
+                self.mode = "polling"
+                break
+            except PyMongoError as exc:
+                self.last_error = str(exc)
+                time.sleep(self._refresh_seconds)
+        built_at = time.monotonic()
+        while True:
+            time.sleep(self._refresh_seconds)
+            try:
+                if time.monotonic() - built_at >= POLL_REBUILD_SECONDS:
+                    self.build()
+                    built_at = time.monotonic()
+                else:
+                    self.poll_changes()
+            except PyMongoError as exc:
+                self.last_error = str(exc)
+
+    # -- queries ---------------------------------------------------------
+    def suggest(self, text: str, limit: int = 8) -> List[Dict[str, str]]:
+        prefix = normalize_name(text)
+        if not prefix:
+            return []
+        results: List[Dict[str, str]] = []
+        seen = set()
+        with self._lock:
+            index = bisect.bisect_left(self._keys, prefix)
+            while index < len(self._keys) and len(results) < limit:
+                if not self._keys[index].startswith(prefix):
+                    break
+                doc_id = self._ids[index]
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    results.append({"doc_id": doc_id, "name": self._names[doc_id][0]})
+                index += 1
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        # Counters only: this runs on every rerun of the search page.
+        with self._lock:
+            entries = len(self._keys)
+            users = len(self._names)
+            approx_bytes = self._approx_bytes
+        lag = time.time() - self.last_refresh_at if self.last_refresh_at else None
+        return {
+            "ready": self.ready,
+            "mode": self.mode,
+            "users": users,
+            "entries": entries,
+            "approx_memory_mb": round(approx_bytes / (1024 * 1024), 2),
+            "build_seconds": round(self.build_seconds, 2) if self.build_seconds is not None else None,
+            "refresh_lag_seconds": round(lag, 1) if lag is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+def _safe_gt(left: Any, right: Any) -> bool:
+    try:
+        return left > right
+    except TypeError:
+        return False
@@ -0,0 +1,197 @@
+"""Bulk token grants and adjustments.
+
+Targets are selected by a list of LINE ids or a structured filter and adjusted
+server-side with one ordered-free ``bulk_write`` per batch. Each update carries
+the zero-floor guard in its filter and stamps ``last_token_operation`` with the
+operation id and the balance it replaced, so the audit entries (balance before,
+delta, reason, operation id) come from one ``find`` on that stamp per batch and
+are written with one ``insert_many``. Legacy string balances are converted to
+numbers before the run, as ``services.upgrade.token_update`` does.
+"""
+from __future__ import annotations
+
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+TOKEN_OPERATION_FIELD = "last_token_operation"
+AUDIT_PROJECTION = {"line_id": 1, TOKEN_OPERATION_FIELD: 1}
+# int(float(balance)), 0 when it does not parse: the same rule as services.upgrade.user_balance.
+_NUMERIC_BALANCE = {
+    "$toLong": {
+        "$trunc": {"$convert": {"input": "$user_question_left", "to": "double", "onError": 0, "onNull": 0}}
+    }
+}
+
+
+def build_token_filter(
+    *,
+    line_ids: Iterable[str] | None = None,
+    active_on: str | None = None,
+    min_tokens: int | None = None,
+    max_tokens: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Combine the selection criteria into a query.
+
+    ``active_on`` (YYYY-MM-DD) keeps users whose mu insight period covers that
+    day; token bounds are inclusive.
+    """
+    clauses: List[Dict[str, Any]] = []
+    if line_ids is not None:
+        clauses.append({"line_id": {"$in": sorted(set(line_ids))}})
+    if active_on:
+        clauses.append({"period_available.start_date": {"$lte": active_on}})
+        clauses.append({"period_available.end_date": {"$gte": active_on}})
+    bounds: Dict[str, int] = {}
+    if min_tokens is not None:
+        bounds["$gte"] = int(min_tokens)
+    if max_tokens is not None:
+        bounds["$lte"] = int(max_tokens)
+    if bounds:
+        clauses.append({"user_question_left": bounds})
+    if not clauses:
+        return {}
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def _with_floor(query: Dict[str, Any], delta: int, floor_at_zero: bool) -> Dict[str, Any]:
+    if delta >= 0 or not floor_at_zero:
+        return query
+    guard = {"user_question_left": {"$gte": -delta}}
+    return {"$and": [query, guard]} if query else guard
+
+
+def count_token_targets(collection, query: Dict[str, Any], *, delta: int = 0, floor_at_zero: bool = True) -> Dict[str, int]:
+    """Dry run: users matched, and how many would be skipped by the zero floor."""
+    matched = collection.count_documents(query)
+    eligible = collection.count_documents(_with_floor(query, delta, floor_at_zero))
+    return {"matched": matched, "eligible": eligible, "skipped": matched - eligible}
+
+
+def normalize_string_balances(collection, query: Dict[str, Any]) -> int:
+    """Convert legacy string ``user_question_left`` values of matching users to numbers; returns how many."""
+    string_balance = {"user_question_left": {"$type": "string"}}
+    result = collection.update_many(
+        {"$and": [query, string_balance]} if query else string_balance,
+        [{"$set": {"user_question_left": _NUMERIC_BALANCE}}],
+    )
+    return result.modified_count
+
+
+def _token_operation(doc_id: Any, delta: int, floor_at_zero: bool, operation_id: str) -> UpdateOne:
+    # A pipeline update, so the stamped balance_before is the value this write replaced.
+    return UpdateOne(
+        _with_floor({"_id": doc_id}, delta, floor_at_zero),
+        [
+            {
+                "$set": {
+                    "user_question_left": {"$add": [{"$ifNull": ["$user_question_left", 0]}, delta]},
+                    TOKEN_OPERATION_FIELD: {
+                        "operation_id": operation_id,
+                        "delta": delta,
+                        "balance_before": "$user_question_left",
+                        "at": "$$NOW",
+                    },
+                }
+            }
+        ],
+    )
+
+
+def apply_token_delta(
+    collection,
+    audit_collection,
+    query: Dict[str, Any],
+    delta: int,
+    *,
+    reason: str,
+    floor_at_zero: bool = True,
+    batch_size: int = 500,
+    on_batch: Callable[[int], None] | None = None,
+) -> Dict[str, Any]:
+    """
+    Add ``delta`` to ``user_question_left`` for every user matching ``query``.
+
+    With ``floor_at_zero`` a negative delta skips users whose balance would drop
+    below zero; the guard is part of each update, so spends or adjustments made
+    while the run is in progress are respected. Users whose single update fails
+    are listed in ``summary["errors"]`` and the run continues; any other database
+    error stops it after auditing the users already updated. ``on_batch(users_updated)``
+    is called after each batch.
+    """
+    delta = int(delta)
+    operation_id = uuid.uuid4().hex
+    summary: Dict[str, Any] = {
+        "operation_id": operation_id,
+        "updated": 0,
+        "skipped": 0,
+        "normalized": 0,
+        "errors": [],
+    }
+    if delta == 0:
+        return summary
+    summary["normalized"] = normalize_string_balances(collection, query)
+    targets = _with_floor(query, delta, floor_at_zero)
+    if targets is not query:
+        summary["skipped"] = collection.count_documents(query) - collection.count_documents(targets)
+
+    def _flush(batch: List[Any]) -> bool:
+        ok = True
+        try:
+            result = collection.bulk_write(
+                [_token_operation(doc_id, delta, floor_at_zero, operation_id) for doc_id in batch], ordered=False
+            )
+            matched, failed = result.matched_count, 0
+        except BulkWriteError as exc:
+            details = exc.details or {}
+            matched, failed = details.get("nMatched", 0), len(details.get("writeErrors") or [])
+            summary["errors"].extend(
+                f"User {batch[error['index']]}: {error.get('errmsg')}" for error in details.get("writeErrors") or []
+            )
+        except PyMongoError as exc:
+            summary["errors"].append(str(exc))
+            matched, failed, ok = len(batch), 0, False
+        # Unmatched updates: the balance dropped below the floor after the cursor read it.
+        summary["skipped"] += max(0, len(batch) - matched - failed)
+
+        updated = list(
+            collection.find(
+                {"_id": {"$in": batch}, f"{TOKEN_OPERATION_FIELD}.operation_id": operation_id}, AUDIT_PROJECTION
+            )
+        )
+        summary["updated"] += len(updated)
+        now = datetime.utcnow()
+        audit = [
+            {
+                "operation_id": operation_id,
+                "user_id": doc["_id"],
+                "line_id": doc.get("line_id"),
+                "delta": delta,
+                "balance_before": doc[TOKEN_OPERATION_FIELD].get("balance_before"),
+                "reason": reason,
+                "created_at": now,
+            }
+            for doc in updated
+        ]
+        if audit and audit_collection is not None:
+            audit_collection.insert_many(audit, ordered=False)
+        if on_batch is not None:
+            on_batch(summary["updated"])
+        return ok
+
+    batch: List[Any] = []
+    # Walk _id order so documents whose balance we just changed cannot reappear in the scan.
+    cursor = collection.find(targets, {"_id": 1}, batch_size=batch_size).sort("_id", 1)
+    for doc in cursor:
+        batch.append(doc["_id"])
+        if len(batch) >= batch_size:
+            if not _flush(batch):
+                return summary
+            batch = []
+    if batch:
+        _flush(batch)
+    return summary
@@ -0,0 +1,240 @@
+"""Bulk package upgrades from a CSV of ``line_id,package_id`` rows.
+
+Each batch reads the affected users once, plans every row with the same rules
+as ``apply_package_upgrade`` and applies them with one ``bulk_write``; the
+matching transaction records go in with one ``insert_many``. Calendar, star and
+GPT work is handed to the background job pool, which bounds how many users are
+processed at once (``jobs.max_workers``).
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .calendar import submit_calendar_job
+from .history import HISTORY_SUMMARY_FIELD, history_update, merge_update, record_events
+from .packages import PACKAGES, get_package
+from .search import LINE_ID_PATTERN
+from .transactions import build_transaction_doc
+from .upgrade import THAI_TZ, plan_upgrade, token_update
+
+REQUIRED_COLUMNS = ("line_id", "package_id")
+BULK_READ_PROJECTION = {
+    "line_id": 1,
+    "birth_date": 1,
+    "period_available": 1,
+    "user_question_left": 1,
+    f"{HISTORY_SUMMARY_FIELD}.first_purchase": 1,
+}
+
+
+def parse_upgrade_csv(source) -> Tuple[List[Dict[str, str]], List[str]]:
+    """
+    Read and validate an upload. Returns ``(rows, errors)``; rows that fail
+    validation are reported in ``errors`` and left out of ``rows``.
+    """
+    frame = pd.read_csv(source, dtype=str).fillna("")
+    frame.columns = [str(column).strip().lower() for column in frame.columns]
+    missing = [column for column in REQUIRED_COLUMNS if column not in frame.columns]
+    if missing:
+        return [], [f"Missing column(s): {', '.join(missing)}"]
+
+    rows: List[Dict[str, str]] = []
+    errors: List[str] = []
+    for position, record in enumerate(frame.to_dict(orient="records"), start=2):
+        line_id = str(record["line_id"]).strip()
+        package_id = str(record["package_id"]).strip()
+        if not LINE_ID_PATTERN.match(line_id):
+            errors.append(f"Line {position}: invalid line_id {line_id!r}")
+            continue
+        if package_id not in PACKAGES:
+            errors.append(f"Line {position}: unknown package_id {package_id!r}")
+            continue
+        rows.append({"line_id": line_id, "package_id": package_id})
+    return rows, errors
+
+
+def count_known_users(collection, rows: Iterable[Dict[str, str]]) -> int:
+    """Dry run: how many distinct line_ids in ``rows`` exist."""
+    line_ids = sorted({row["line_id"] for row in rows})
+    return collection.count_documents({"line_id": {"$in": line_ids}})
+
+
+def _report_row(row: Dict[str, str], status: str, message: str = "", **fields: Any) -> Dict[str, Any]:
+    return {
+        "line_id": row["line_id"],
+        "package_id": row["package_id"],
+        "status": status,
+        "message": message,
+        "start_date": fields.get("start_date"),
+        "end_date": fields.get("end_date"),
+        "new_token_balance": fields.get("new_token_balance"),
+        "calendar_job_id": fields.get("calendar_job_id"),
+    }
+
+
+def _apply_batch(
+    batch: List[Dict[str, str]],
+    *,
+    collection,
+    transactions_collection,
+    events_collection,
+    timestamp_iso: str,
+    reference_factory: Callable[[], str],
+    sub_type: str,
+    payment_type: str,
+    queue_calendar: bool,
+) -> List[Dict[str, Any]]:
+    line_ids = list({row["line_id"] for row in batch})
+    users = {doc["line_id"]: doc for doc in collection.find({"line_id": {"$in": line_ids}}, BULK_READ_PROJECTION)}
+
+    now = datetime.now(THAI_TZ)
+    report: List[Dict[str, Any]] = [{} for _ in batch]
+    operations: List[UpdateOne] = []
+    planned: List[Tuple[int, Dict[str, Any], Dict[str, Any], Dict[str, Any]]] = []
+
+    for idx, row in enumerate(batch):
+        user = users.get(row["line_id"])
+        if user is None:
+            report[idx] = _report_row(row, "not_found", "No user with this line_id.")
+            continue
+        package = get_package(row["package_id"])
+        reference_id = reference_factory()
+        plan = plan_upgrade(
+            user,
+            package,
+            now=now,
+            reference_id=reference_id,
+            timestamp_iso=timestamp_iso,
+            sub_type=sub_type,
+            payment_type=payment_type,
+        )
+        tokens = token_update(user, plan["result"]["extra_tokens"])
+        # Later rows for the same user build on this one, as sequential upgrades would.
+        user["period_available"] = plan["period_available"]
+        user["user_question_left"] = plan["result"]["new_token_balance"]
+        history = history_update(plan["history_entry"], user=user)
+        if "$set" in history:
+            # The empty first purchase is replaced by this row; later rows use $min again.
+            user[HISTORY_SUMMARY_FIELD] = {"first_purchase": None}
+        operations.append(
+            UpdateOne(
+                {"_id": user["_id"]},
+                merge_update(
+                    merge_update({"$set": {"period_available": plan["period_available"]}}, tokens),
+                    history,
+                ),
+            )
+        )
+        planned.append((idx, user, package, plan))
+
+    failed_ops: Dict[int, str] = {}
+    if operations:
+        try:
+            collection.bulk_write(operations, ordered=True)
+        except BulkWriteError as exc:
+            # Ordered: the first error stops the batch, so it and everything after it failed.
+            write_errors = exc.details.get("writeErrors") or []
+            first = write_errors[0]["index"] if write_errors else 0
+            message = write_errors[0].get("errmsg", "write failed") if write_errors else str(exc)
+            for op_index in range(first, len(operations)):
+                failed_ops[op_index] = message if op_index == first else "Skipped after an earlier write error."
+
+    transactions: List[Dict[str, Any]] = []
+    events: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+    calendar_users: Dict[str, Tuple[Dict[str, Any], str, str]] = {}
+    for op_index, (idx, user, package, plan) in enumerate(planned):
+        row = batch[idx]
+        result = plan["result"]
+        if op_index in failed_ops:
+            report[idx] = _report_row(row, "failed", failed_ops[op_index])
+            continue
+        transactions.append(
+            build_transaction_doc(
+                user=user,
+                package=package,
+                reference_id=result["reference_id"],
+                timestamp_iso=timestamp_iso,
+                sub_type=sub_type,
+                payment_type=payment_type,
+            )
+        )
+        events.append((user, plan["history_entry"]))
+        report[idx] = _report_row(row, "upgraded", **result)
+        # One calendar job per user covering the widest range any of its rows needs.
+        start, end = result["calendar_start_date"], result["end_date"]
+        if row["line_id"] in calendar_users:
+            _, prev_start, prev_end = calendar_users[row["line_id"]]
+            start, end = min(start, prev_start), max(end, prev_end)
+        calendar_users[row["line_id"]] = (user, start, end)
+
+    if transactions and transactions_collection is not None:
+        try:
+            transactions_collection.insert_many(transactions, ordered=False)
+        except Exception as exc:  # noqa: BLE001
+            for entry in report:
+                if entry.get("status") == "upgraded":
+                    entry["message"] = f"Transaction record failed: {exc}"
+
+    try:
+        record_events(events_collection, events)
+    except Exception as exc:  # noqa: BLE001
+        for entry in report:
+            if entry.get("status") == "upgraded" and not entry["message"]:
+                entry["message"] = f"History event failed: {exc}"
+
+    if queue_calendar:
+        job_ids = {
+            # GPT runs inside each job on the bulk pool, so at most jobs.bulk_max_workers
+            # users generate at once and the shared job pool stays free.
+            line_id: submit_calendar_job(user, start, end, collection=collection, wait_for_gpt=True, pool="bulk")
+            for line_id, (user, start, end) in calendar_users.items()
+        }
+        for entry in report:
+            if entry.get("status") == "upgraded":
+                entry["calendar_job_id"] = job_ids.get(entry["line_id"])
+    return report
+
+
+def run_bulk_upgrade(
+    rows: List[Dict[str, str]],
+    *,
+    collection,
+    transactions_collection=None,
+    events_collection=None,
+    timestamp_iso: str,
+    reference_factory: Callable[[], str],
+    batch_size: int = 200,
+    sub_type: str = "standard",
+    payment_type: str = "free",
+    queue_calendar: bool = True,
+    on_batch: Callable[[int, int], None] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Upgrade every row and return one report entry per input row.
+
+    ``on_batch(rows_done, rows_total)`` is called after each batch.
+    """
+    report: List[Dict[str, Any]] = []
+    for offset in range(0, len(rows), batch_size):
+        batch = rows[offset:offset + batch_size]
+        report.extend(
+            _apply_batch(
+                batch,
+                collection=collection,
+                transactions_collection=transactions_collection,
+                events_collection=events_collection,
+                timestamp_iso=timestamp_iso,
+                reference_factory=reference_factory,
+                sub_type=sub_type,
+                payment_type=payment_type,
+                queue_calendar=queue_calendar,
+            )
+        )
+        if on_batch is not None:
+            on_batch(len(report), len(rows))
+    return report
@@ -1,80 +1,236 @@
 from __future__ import annotations
 
+import threading
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 
 import requests
 import streamlit as st
 
 import config
 from .general_calendar import get_general_calendar
-from . import backend_utils
+from pymongo import UpdateOne
+
+from .star_catalog import encode_prediction
+from . import backend_utils, calendar_store, jobs
 
 
 def _parse_iso_date(date_str: str) -> datetime.date:
     return datetime.strptime(date_str, "%Y-%m-%d").date()
 
 
-def ensure_calendar_entries(
-    user: Dict[str, Any],
+PREDICTION_DATES_FIELD = "_prediction_dates"
+CALENDAR_BASIC_RANGE_FIELD = "calendar_basic_range"
+CALENDAR_BASIC_JOB_KEY = "migrate:calendar_basic"
+
+
+def prediction_dates_stage() -> Dict[str, Any]:
+    """
+    ``$addFields`` stage listing the dates stored in ``period_predictions``.
+
+    Yields ``None`` when the field is missing or not an object, in which case
+    per-day dotted updates cannot be applied and the whole map must be written.
+    """
+    return {
+        "$addFields": {
+            PREDICTION_DATES_FIELD: {
+                "$cond": [
+                    {"$eq": [{"$type": "$period_predictions"}, "object"]},
+                    {"$map": {"input": {"$objectToArray": "$period_predictions"}, "in": "$$this.k"}},
+                    None,
+                ]
+            }
+        }
+    }
+
+
+def get_prediction_dates(collection, user_id: Any, *, line_id: str | None = None) -> List[str] | None:
+    """Return the dates already predicted for a user without transferring the predictions."""
+    pipeline = [
+        {"$match": {"_id": user_id}},
+        prediction_dates_stage(),
+        {"$project": {PREDICTION_DATES_FIELD: 1}},
+    ]
+    rows = list(collection.aggregate(pipeline))
+    dates = rows[0].get(PREDICTION_DATES_FIELD) if rows else None
+    return with_bucket_prediction_dates(line_id, dates, database=collection.database)
+
+
+def with_bucket_prediction_dates(line_id: str | None, dates: List[str] | None, *, database) -> List[str] | None:
+    """Add the dates held in calendar buckets when ``calendar.storage = "bucketed"``."""
+    if not (calendar_store.is_bucketed() and line_id):
+        return dates
+    bucket_dates = calendar_store.day_keys(line_id, "period_predictions", database=database)
+    return sorted(set(dates or []) | set(bucket_dates))
+
+
+# Day maps shown in the calendar review.
+REVIEW_MAPS = ("period_predictions", "period_predictions_gpt")
+
+
+def _map_keys_expr(field: str) -> Dict[str, Any]:
+    return {"$map": {"input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}}, "in": "$$this.k"}}
+
+
+def _window_expr(field: str, start_date_iso: str, end_date_iso: str) -> Dict[str, Any]:
+    """``{date: value}`` of ``field`` restricted to keys inside the window."""
+    return {
+        "$arrayToObject": {
+            "$filter": {
+                "input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}},
+                "cond": {"$and": [{"$gte": ["$$this.k", start_date_iso]}, {"$lte": ["$$this.k", end_date_iso]}]},
+            }
+        }
+    }
+
+
+def calendar_months(collection, user_id: Any, *, line_id: str | None = None, database=None) -> Dict[str, int]:
+    """
+    ``{"YYYY-MM": days}`` over the prediction and GPT days of a user.
+
+    Only the date keys are read, so the review can paginate by month without
+    transferring any day. In bucketed mode a month split between the user
+    document and its bucket (mid-migration) reports the larger count. Buckets
+    are read from ``database`` (default: the database of ``collection``).
+    """
+    pipeline = [
+        {"$match": {"_id": user_id}},
+        {"$project": {"_id": 0, "date": {"$setUnion": [_map_keys_expr(field) for field in REVIEW_MAPS]}}},
+        {"$unwind": "$date"},
+        {"$group": {"_id": {"$substrBytes": ["$date", 0, 7]}, "days": {"$sum": 1}}},
+    ]
+    months = {row["_id"]: row["days"] for row in collection.aggregate(pipeline)}
+    if calendar_store.is_bucketed() and line_id:
+        buckets_db = collection.database if database is None else database
+        for month, days in calendar_store.month_day_counts(line_id, REVIEW_MAPS, database=buckets_db).items():
+            months[month] = max(months.get(month, 0), days)
+    return months
+
+
+def load_calendar_window(
+    collection,
+    user_id: Any,
     start_date_iso: str,
     end_date_iso: str,
+    *,
+    line_id: str | None = None,
+    database=None,
 ) -> Dict[str, Any]:
     """
-    Mirror the post-payment calendar workflow:
-    1. Populate period_predictions via star prediction API for missing days.
-    2. Trigger the GPT background updater for standard content via calendar API.
-       Basic calendar entries are filled for every day regardless of prediction state.
+    The user's day maps clipped to ``start_date_iso``..``end_date_iso`` on the server.
+
+    Returns the user-document shape (``period_predictions``,
+    ``period_predictions_gpt``, ``calendar_basic`` and ``calendar_basic_range``),
+    so ``resolve_calendar_basic`` applies unchanged.
     """
-    collection = st.session_state.collection
-    line_id = user.get("line_id")
+    pipeline = [
+        {"$match": {"_id": user_id}},
+        {
+            "$project": {
+                "_id": 0,
+                CALENDAR_BASIC_RANGE_FIELD: 1,
+                **{field: _window_expr(field, start_date_iso, end_date_iso) for field in REVIEW_MAPS},
+                "calendar_basic": {
+                    kind: _window_expr(f"calendar_basic.{kind}", start_date_iso, end_date_iso)
+                    for kind in ("profile", "holiday")
+                },
+            }
+        },
+    ]
+    rows = list(collection.aggregate(pipeline))
+    window = rows[0] if rows else {}
+    if calendar_store.is_bucketed() and line_id:
+        window.update(
+            calendar_store.read_day_maps(
+                line_id,
+                calendar_store.USER_MAP_ROOTS,
+                embedded=window,
+                start_date=start_date_iso,
+                end_date=end_date_iso,
+                database=collection.database if database is None else database,
+            )
+        )
+    return window
 
-    if not line_id:
-        return {
-            "updated_days": 0,
-            "gpt_triggered": False,
-            "basic_profile_days": 0,
-            "basic_holiday_days": 0,
-            "errors": ["Missing line_id on user record."],
-        }
 
+def split_calendar_update(update: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Return ``(user_update, bucket_sets)`` for a ``calendar_update_doc`` result.
+
+    In bucketed mode the day fields of ``$set`` move to ``bucket_sets`` (see
+    ``calendar_store.write_day_updates``); otherwise ``bucket_sets`` is empty.
+    """
+    if not calendar_store.is_bucketed() or "$set" not in update:
+        return update, {}
+    user_set, bucket_sets = calendar_store.split_day_updates(update["$set"])
+    update = {key: value for key, value in update.items() if key != "$set"}
+    if user_set:
+        update["$set"] = user_set
+    return update, bucket_sets
+
+
+def compute_calendar_updates(
+    user: Dict[str, Any],
+    start_date_iso: str,
+    end_date_iso: str,
+    prediction_dates: List[str] | None,
+    *,
+    on_progress: Callable[..., None] | None = None,
+) -> Dict[str, Any]:
+    """
+    Work out the calendar fields to ``$set`` for a date range without writing them.
+
+    Star predictions are fetched for days not in ``prediction_dates``; basic
+    profile/holiday entries come from the cached general calendar. The result
+    carries ``valid_range``, ``set`` / ``min`` / ``max`` (dotted field -> value, see
+    ``calendar_update_doc``) plus the counters and errors that
+    ``ensure_calendar_entries`` reports. ``on_progress(days_done=, days_total=)``
+    is called after each day.
+
+    With ``calendar.basic_storage = "reference"`` basic entries are not copied;
+    ``calendar_basic_range`` is widened to cover the period instead and readers
+    resolve days with ``resolve_calendar_basic``.
+    """
+    plan: Dict[str, Any] = {
+        "valid_range": False,
+        "set": {},
+        "min": {},
+        "max": {},
+        "updated_days": 0,
+        "basic_profile_days": 0,
+        "basic_holiday_days": 0,
+        "errors": [],
+    }
     try:
         start_date = _parse_iso_date(start_date_iso)
         end_date = _parse_iso_date(end_date_iso)
     except ValueError as exc:
-        return {
-            "updated_days": 0,
-            "gpt_triggered": False,
-            "errors": [f"Invalid date range: {exc}"],
-        }
+        plan["errors"].append(f"Invalid date range: {exc}")
+        return plan
 
     if start_date > end_date:
-        return {
-            "updated_days": 0,
-            "gpt_triggered": False,
-            "errors": ["start_date is after end_date."],
-        }
+        plan["errors"].append("start_date is after end_date.")
+        return plan
+    plan["valid_range"] = True
 
-    # Reload fresh predictions to avoid stale in-memory copies
-    fresh_user = collection.find_one({"_id": user["_id"]}, {"period_predictions": 1}) or {}
-    predictions = fresh_user.get("period_predictions") or {}
+    known_dates = set(prediction_dates or [])
     birth_date = user.get("birth_date")
     can_predict = bool(birth_date)
 
     current = start_date
-    updated_days = 0
-    errors: List[str] = []
-
+    days_total = (end_date - start_date).days + 1
+    days_done = 0
+    errors: List[str] = plan["errors"]
+    new_predictions: Dict[str, Any] = {}
     month_cache: Dict[Tuple[int, int], Dict[str, Dict[str, Any]]] = {}
     basic_profile_updates: Dict[str, Dict[str, Any]] = {}
     basic_holiday_updates: Dict[str, Dict[str, Any]] = {}
 
     while current <= end_date:
         date_key = current.strftime("%Y-%m-%d")
-        if can_predict and date_key not in predictions:
+        if can_predict and date_key not in known_dates:
             try:
-                predictions[date_key] = _fetch_star_prediction(birth_date, date_key)
-                updated_days += 1
+                new_predictions[date_key] = encode_prediction(_fetch_star_prediction(birth_date, date_key))
             except Exception as exc:  # noqa: BLE001
                 errors.append(f"{date_key}: {exc}")
 
@@ -95,82 +251,417 @@ def ensure_calendar_entries(
             basic_holiday_updates[date_key] = holiday_entry
 
         current += timedelta(days=1)
+        days_done += 1
+        if on_progress is not None:
+            on_progress(days_done=days_done, days_total=days_total, errors=len(errors))
+
+    updates: Dict[str, Any] = plan["set"]
+    if new_predictions:
+        if prediction_dates is None:
+            updates["period_predictions"] = new_predictions
+        else:
+            updates.update({f"period_predictions.{k}": v for k, v in new_predictions.items()})
+    if config.CALENDAR_BASIC_STORAGE == "reference":
+        plan["min"][f"{CALENDAR_BASIC_RANGE_FIELD}.start_date"] = start_date_iso
+        plan["max"][f"{CALENDAR_BASIC_RANGE_FIELD}.end_date"] = end_date_iso
+    else:
+        updates.update({f"calendar_basic.profile.{k}": v for k, v in basic_profile_updates.items()})
+        updates.update({f"calendar_basic.holiday.{k}": v for k, v in basic_holiday_updates.items()})
 
-    if updated_days:
-        collection.update_one(
-            {"_id": user["_id"]},
-            {"$set": {"period_predictions": predictions}},
-        )
+    plan["updated_days"] = len(new_predictions)
+    plan["basic_profile_days"] = len(basic_profile_updates)
+    plan["basic_holiday_days"] = len(basic_holiday_updates)
+    return plan
 
-    basic_updates_payload: Dict[str, Any] = {}
-    if basic_profile_updates:
-        basic_updates_payload.update(
-            {f"calendar_basic.profile.{k}": v for k, v in basic_profile_updates.items()}
-        )
-    if basic_holiday_updates:
-        basic_updates_payload.update(
-            {f"calendar_basic.holiday.{k}": v for k, v in basic_holiday_updates.items()}
-        )
-    if basic_updates_payload:
-        collection.update_one({"_id": user["_id"]}, {"$set": basic_updates_payload})
 
+def calendar_update_doc(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a ``compute_calendar_updates`` plan into update operators, skipping empty ones."""
+    update: Dict[str, Any] = {}
+    for operator in ("set", "min", "max"):
+        if plan.get(operator):
+            update[f"${operator}"] = dict(plan[operator])
+    return update
 
+
+def _month_starts(start_date, end_date):
+    current = start_date.replace(day=1)
+    while current <= end_date:
+        yield current
+        current = (current + timedelta(days=32)).replace(day=1)
+
+
+def resolve_calendar_basic(
+    user: Dict[str, Any],
+    start_date_iso: str | None = None,
+    end_date_iso: str | None = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Basic calendar days for a user, whichever way they are stored.
+
+    Copied ``calendar_basic`` entries are returned as stored; days inside
+    ``calendar_basic_range`` are filled from the cached general calendar. The
+    optional bounds clip the result.
+    """
+    stored = user.get("calendar_basic") or {}
+    resolved = {
+        "profile": dict(stored.get("profile") or {}),
+        "holiday": dict(stored.get("holiday") or {}),
+    }
+    date_range = user.get(CALENDAR_BASIC_RANGE_FIELD) or {}
+    range_start = max(filter(None, [date_range.get("start_date"), start_date_iso]), default=None)
+    range_end = min(filter(None, [date_range.get("end_date"), end_date_iso]), default=None)
+    if date_range and range_start and range_end and range_start <= range_end:
+        start_date = _parse_iso_date(range_start)
+        end_date = _parse_iso_date(range_end)
+        for month_start in _month_starts(start_date, end_date):
+            month_data = get_general_calendar(month_start.year, month_start.month)
+            for kind in ("profile", "holiday"):
+                for date_key, entry in (month_data.get(kind) or {}).items():
+                    if range_start <= date_key <= range_end:
+                        resolved[kind].setdefault(date_key, entry)
+
+    if start_date_iso or end_date_iso:
+        low, high = start_date_iso or "0000-00-00", end_date_iso or "9999-99-99"
+        for kind in resolved:
+            resolved[kind] = {k: v for k, v in resolved[kind].items() if low <= k <= high}
+    return resolved
+
+
+def migrate_calendar_basic_to_reference(
+    collection,
+    *,
+    batch_size: int = 200,
+    dry_run: bool = False,
+    limit: int | None = None,
+    on_batch: Callable[[int], None] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Replace copied ``calendar_basic`` maps with ``calendar_basic_range``.
+
+    The range covers the earliest to the latest copied day. Returns one entry
+    per converted user with ``{line_id, days, bytes_saved}``; sizes come from
+    ``$bsonSize`` so the maps never leave the server.
+    """
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": {"calendar_basic": {"$type": "object"}}},
+        {"$sort": {"_id": 1}},
+    ]
+    if limit:
+        pipeline.append({"$limit": int(limit)})
+    pipeline.append(
+        {
+            "$project": {
+                "line_id": 1,
+                "bytes": {"$bsonSize": {"calendar_basic": "$calendar_basic"}},
+                "dates": {
+                    "$map": {
+                        "input": {
+                            "$concatArrays": [
+                                {"$objectToArray": {"$ifNull": ["$calendar_basic.profile", {}]}},
+                                {"$objectToArray": {"$ifNull": ["$calendar_basic.holiday", {}]}},
+                            ]
+                        },
+                        "in": "$$this.k",
+                    }
+                },
+            }
+        }
+    )
+
+    report: List[Dict[str, Any]] = []
+    operations: List[UpdateOne] = []
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        dates = sorted(set(doc.get("dates") or []))
+        report.append({"line_id": doc.get("line_id"), "days": len(dates), "bytes_saved": int(doc.get("bytes") or 0)})
+        if dry_run:
+            continue
+        update: Dict[str, Any] = {"$unset": {"calendar_basic": ""}}
+        if dates:
+            update["$min"] = {f"{CALENDAR_BASIC_RANGE_FIELD}.start_date": dates[0]}
+            update["$max"] = {f"{CALENDAR_BASIC_RANGE_FIELD}.end_date": dates[-1]}
+        operations.append(UpdateOne({"_id": doc["_id"]}, update))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+            if on_batch is not None:
+                on_batch(len(report))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    if on_batch is not None:
+        on_batch(len(report))
+    return report
+
+
+def submit_calendar_basic_job(collection) -> str:
+    """Run ``migrate_calendar_basic_to_reference`` over all users as a background job; returns the job id."""
+
+    def _job(progress):
+        return migrate_calendar_basic_to_reference(collection, on_batch=lambda done: progress(users=done))
+
+    return jobs.submit(CALENDAR_BASIC_JOB_KEY, _job, kind="migration")
+
+
+def trigger_gpt_calendar(user: Dict[str, Any], *, wait: bool = False) -> Dict[str, Any]:
+    """
+    Start GPT generation for a user's period: remote /calendar/fix first, then the local
+    background runner when the remote call did not take the job.
+
+    With ``wait`` the remote trigger is skipped and the local rebuild runs in the
+    calling thread, so callers on the bounded job pool cap GPT concurrency.
+
+    Returns ``{"gpt_triggered", "gpt_details", "errors"}``.
+    """
+    line_id = user.get("line_id")
+    errors: List[str] = []
     gpt_triggered = False
-    gpt_details: Dict[str, Any] | None = None
     success_statuses = {"queued", "running", "started", "completed", "success", "ok", "processed"}
 
-    if can_predict:
-        remote_details = _trigger_remote_calendar_fix(line_id)
-        status_response = None
-        status_snapshot = None
-        status_value = remote_details.get("status") if isinstance(remote_details, dict) else None
+    if not user.get("birth_date"):
+        gpt_details = {"status": "skipped", "message": "User missing birth_date; GPT calendar skipped.", "line_id": line_id}
+        return {"gpt_triggered": False, "gpt_details": gpt_details, "errors": errors}
+
+    remote_details = None if wait else _trigger_remote_calendar_fix(line_id)
+    status_response = None
+    status_snapshot = None
+    status_value = remote_details.get("status") if isinstance(remote_details, dict) else None
+
+    if status_value in success_statuses:
+        gpt_triggered = True
+
+    if status_value and status_value not in success_statuses:
+        message_text = remote_details.get("message") if isinstance(remote_details, dict) else None
+        errors.append(f"Remote GPT trigger failed: {message_text or status_value}")
+
+    if status_value not in success_statuses:
+        try:
+            status_response = start_gpt_background(line_id, wait=wait)
+            status_snapshot = backend_utils.get_gpt_task_status(line_id)
+            snapshot_status = status_snapshot.get("status") if isinstance(status_snapshot, dict) else None
+            response_status = status_response.get("status") if isinstance(status_response, dict) else None
+            status_value = snapshot_status or response_status or status_value
+            if status_value in success_statuses:
+                gpt_triggered = True
+        except Exception as exc:  # noqa: BLE001
+            errors.append(f"GPT background task: {exc}")
+            status_response = {"status": "error", "message": str(exc), "line_id": line_id}
+
+    gpt_details = {
+        "status": status_value,
+        "remote_details": remote_details,
+        "status_response": status_response,
+        "status_snapshot": status_snapshot,
+    }
+    return {"gpt_triggered": gpt_triggered, "gpt_details": gpt_details, "errors": errors}
 
-        if status_value in success_statuses:
-            gpt_triggered = True
 
-        if status_value and status_value not in success_statuses:
-            message_text = remote_details.get("message") if isinstance(remote_details, dict) else None
-            errors.append(f"Remote GPT trigger failed: {message_text or status_value}")
+def ensure_calendar_entries(
+    user: Dict[str, Any],
+    start_date_iso: str,
+    end_date_iso: str,
+    *,
+    collection=None,
+    on_progress: Callable[..., None] | None = None,
+    wait_for_gpt: bool = False,
+) -> Dict[str, Any]:
+    """
+    Mirror the post-payment calendar workflow:
+    1. Populate period_predictions via star prediction API for missing days.
+    2. Trigger the GPT background updater for standard content via calendar API
+       (or, with ``wait_for_gpt``, generate the GPT days before returning).
+       Basic calendar entries are filled for every day regardless of prediction state.
+    """
+    if collection is None:
+        collection = st.session_state.collection
+    line_id = user.get("line_id")
 
-        if status_value not in success_statuses:
-            try:
-                status_response = backend_utils.run_UpdatePeriodGPTAll_in_background(line_id)
-                status_snapshot = backend_utils.get_gpt_task_status(line_id)
-                snapshot_status = status_snapshot.get("status") if isinstance(status_snapshot, dict) else None
-                response_status = status_response.get("status") if isinstance(status_response, dict) else None
-                status_value = snapshot_status or response_status or status_value
-                if status_value in success_statuses:
-                    gpt_triggered = True
-            except Exception as exc:  # noqa: BLE001
-                errors.append(f"GPT background task: {exc}")
-                status_response = {"status": "error", "message": str(exc), "line_id": line_id}
-
-        gpt_details = {
-            "status": status_value,
-            "remote_details": remote_details,
-            "status_response": status_response,
-            "status_snapshot": status_snapshot,
+    if not line_id:
+        return {
+            "updated_days": 0,
+            "gpt_triggered": False,
+            "basic_profile_days": 0,
+            "basic_holiday_days": 0,
+            "errors": ["Missing line_id on user record."],
         }
-    else:
-        gpt_details = {"status": "skipped", "message": "User missing birth_date; GPT calendar skipped.", "line_id": line_id}
+
+    # Only the stored dates are needed to find the gaps, not the predictions themselves.
+    prediction_dates = get_prediction_dates(collection, user["_id"], line_id=line_id)
+    plan = compute_calendar_updates(user, start_date_iso, end_date_iso, prediction_dates, on_progress=on_progress)
+    if not plan["valid_range"]:
+        return {"updated_days": 0, "gpt_triggered": False, "errors": plan["errors"]}
+
+    update, bucket_sets = split_calendar_update(calendar_update_doc(plan))
+    calendar_store.write_day_updates(line_id, bucket_sets, database=collection.database)
+    if update:
+        collection.update_one({"_id": user["_id"]}, update)
+
+    if on_progress is not None:
+        on_progress(stage="gpt")
+    gpt = trigger_gpt_calendar(user, wait=wait_for_gpt)
+    errors = plan["errors"] + gpt["errors"]
 
     result: Dict[str, Any] = {
-        "updated_days": updated_days,
-        "gpt_triggered": gpt_triggered,
-        "basic_profile_days": len(basic_profile_updates),
-        "basic_holiday_days": len(basic_holiday_updates),
+        "updated_days": plan["updated_days"],
+        "gpt_triggered": gpt["gpt_triggered"],
+        "basic_profile_days": plan["basic_profile_days"],
+        "basic_holiday_days": plan["basic_holiday_days"],
+        "gpt_details": gpt["gpt_details"],
     }
-    if gpt_details is not None:
-        result["gpt_details"] = gpt_details
     if errors:
         result["errors"] = errors
     return result
 
 
 
+def calendar_job_key(line_id: str) -> str:
+    return f"calendar:{line_id}"
+
+
+# Calendar requests not yet picked up, per line_id, and the job draining them.
+# Both are only changed under _calendar_lock, so a request either joins the
+# running job's queue or starts a new job; it is never dropped.
+_calendar_lock = threading.Lock()
+_pending_calendar: Dict[str, Dict[str, Any]] = {}
+_calendar_drainers: Dict[str, str] = {}
+
+
+def _merge_calendar_results(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if len(results) == 1:
+        return results[0]
+    merged: Dict[str, Any] = {
+        "updated_days": sum(r.get("updated_days", 0) for r in results),
+        "gpt_triggered": any(r.get("gpt_triggered") for r in results),
+        "basic_profile_days": sum(r.get("basic_profile_days", 0) for r in results),
+        "basic_holiday_days": sum(r.get("basic_holiday_days", 0) for r in results),
+        "gpt_details": results[-1].get("gpt_details"),
+        "runs": len(results),
+    }
+    errors = [err for r in results for err in r.get("errors") or []]
+    if errors:
+        merged["errors"] = errors
+    return merged
+
+
+def submit_calendar_job(
+    user: Dict[str, Any],
+    start_date_iso: str,
+    end_date_iso: str,
+    *,
+    collection,
+    wait_for_gpt: bool = False,
+    pool: str = "default",
+) -> str:
+    """
+    Run ``ensure_calendar_entries`` as a background job; returns the job id.
+
+    A request for a user whose calendar job is still queued or running is added
+    to that job's queue (ranges waiting together are widened to cover both) and
+    runs after the current range, so a second upgrade never loses its period.
+    ``wait_for_gpt`` generates the GPT days inside the job; bulk callers pair it
+    with ``pool="bulk"`` so their GPT runs are bounded by ``jobs.bulk_max_workers``
+    and never occupy the shared job pool.
+    """
+    line_id = user.get("line_id")
+    with _calendar_lock:
+        pending = _pending_calendar.get(line_id)
+        if pending:
+            start_date_iso = min(start_date_iso, pending["start_date"])
+            end_date_iso = max(end_date_iso, pending["end_date"])
+            wait_for_gpt = wait_for_gpt or pending["wait_for_gpt"]
+        _pending_calendar[line_id] = {
+            "user": dict(user),
+            "start_date": start_date_iso,
+            "end_date": end_date_iso,
+            "wait_for_gpt": wait_for_gpt,
+        }
+        if line_id in _calendar_drainers:
+            return _calendar_drainers[line_id]
+
+        def _job(progress):
+            results: List[Dict[str, Any]] = []
+            while True:
+                with _calendar_lock:
+                    request = _pending_calendar.pop(line_id, None)
+                    if request is None:
+                        _calendar_drainers.pop(line_id, None)
+                        break
+                progress(
+                    stage="calendar",
+                    days_done=0,
+                    errors=0,
+                    start_date=request["start_date"],
+                    end_date=request["end_date"],
+                )
+                try:
+                    results.append(
+                        ensure_calendar_entries(
+                            request["user"],
+                            request["start_date"],
+                            request["end_date"],
+                            collection=collection,
+                            on_progress=progress,
+                            wait_for_gpt=request["wait_for_gpt"],
+                        )
+                    )
+                except Exception:
+                    with _calendar_lock:
+                        _calendar_drainers.pop(line_id, None)
+                        queued = _pending_calendar.pop(line_id, None)
+                    if queued is not None:
+                        # Requests that arrived during the failed run get a job of their own.
+                        requeued_id = submit_calendar_job(
+                            queued["user"],
+                            queued["start_date"],
+                            queued["end_date"],
+                            collection=collection,
+                            wait_for_gpt=queued["wait_for_gpt"],
+                            pool=pool,
+                        )
+                        progress(requeued_job_id=requeued_id)
+                    raise
+            progress(stage="done")
+            return _merge_calendar_results(results)
+
+        job_id = jobs.submit(
+            calendar_job_key(line_id),
+            _job,
+            kind="calendar",
+            dedupe=False,
+            pool=pool,
+            line_id=line_id,
+            start_date=start_date_iso,
+            end_date=end_date_iso,
+        )
+        _calendar_drainers[line_id] = job_id
+        return job_id
+
+
+def start_gpt_background(
+    line_id: str,
+    mode: str = "missing",
+    throttle_seconds: float = 0.0,
+    *,
+    wait: bool = False,
+) -> Dict[str, Any]:
+    """Start the GPT calendar rebuild on the configured pipeline (async or threaded)."""
+    if config.GPT_ASYNC_ENABLED:
+        from .gpt_async import run_UpdatePeriodGPTAllAsync_in_background
+
+        return run_UpdatePeriodGPTAllAsync_in_background(line_id, mode, throttle_seconds, wait=wait)
+    return backend_utils.run_UpdatePeriodGPTAll_in_background(line_id, mode, throttle_seconds, wait=wait)
+
+
+def estimate_stale_gpt_days(line_id: str) -> Dict[str, Any]:
+    return backend_utils.estimate_std_day_regeneration(line_id, mode="stale")
+
+
+def regenerate_stale_gpt_days(line_id: str) -> Dict[str, Any]:
+    """Queue a throttled background regeneration of days built from an older prompt."""
+    return start_gpt_background(line_id, mode="stale", throttle_seconds=config.GPT_REGEN_THROTTLE_SECONDS)
+
+
 def trigger_gpt_update(line_id: str) -> dict:
     try:
-        backend_utils.run_UpdatePeriodGPTAll_in_background(line_id)
+        start_gpt_background(line_id)
         return {"status": "started"}
     except Exception as exc:  # noqa: BLE001
         return {"status": "error", "message": str(exc)}
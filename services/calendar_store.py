@@ -0,0 +1,319 @@
+"""Per-user-month buckets for calendar day maps.
+
+With ``calendar.storage = "bucketed"`` the day maps that used to grow inside
+``user_profiles`` live in ``user_calendar_buckets``, one document per
+``(line_id, YYYY-MM)``::
+
+    {"_id": "<line_id>:2025-03", "line_id": ..., "month": "2025-03",
+     "predictions": {date: ...}, "gpt": {date: ...},
+     "basic": {"profile": {date: ...}, "holiday": {date: ...}}}
+
+Callers keep using the user-document field names (``period_predictions``,
+``period_predictions_gpt``, ``calendar_basic``); ``split_day_updates`` routes dotted
+``$set`` fields to buckets and ``read_day_maps`` rebuilds the embedded shape.
+Reads merge any maps still embedded in the user document, so the migration can
+run while the app is live. Every helper takes the ``database`` that holds the
+caller's ``user_profiles``, so buckets and users always resolve from the same
+connection; pass a routed database (``read_routing.routed``) to read from a
+secondary.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from pymongo import UpdateOne
+
+import config
+from . import jobs
+from .indexes import create_group_indexes
+
+BUCKET_COLLECTION_NAME = "user_calendar_buckets"
+BUCKET_MIGRATION_JOB_KEY = "migrate:calendar_buckets"
+# User-document map -> bucket sub-document.
+DAY_MAP_FIELDS = {
+    "period_predictions": "predictions",
+    "period_predictions_gpt": "gpt",
+    "calendar_basic.profile": "basic.profile",
+    "calendar_basic.holiday": "basic.holiday",
+}
+USER_MAP_ROOTS = ("period_predictions", "period_predictions_gpt", "calendar_basic")
+
+# Databases whose bucket indexes have been ensured by this process.
+_indexes_ready: set = set()
+
+
+def is_bucketed() -> bool:
+    return config.CALENDAR_STORAGE == "bucketed"
+
+
+def bucket_collection(database):
+    """Bucket collection next to ``user_profiles`` in ``database`` (sharing its client and sessions)."""
+    collection = database[BUCKET_COLLECTION_NAME]
+    if database.name not in _indexes_ready:
+        ensure_bucket_indexes(collection)
+        _indexes_ready.add(database.name)
+    return collection
+
+
+def ensure_bucket_indexes(collection) -> None:
+    create_group_indexes(collection, "calendar_buckets")
+
+
+def month_of(date_iso: str) -> str:
+    return date_iso[:7]
+
+
+def bucket_id(line_id: str, month: str) -> str:
+    return f"{line_id}:{month}"
+
+
+def _split_dotted(field: str) -> Tuple[str, str] | None:
+    """``period_predictions.2025-03-01`` -> (``period_predictions``, ``2025-03-01``)."""
+    for user_field in DAY_MAP_FIELDS:
+        prefix = user_field + "."
+        if field.startswith(prefix):
+            date_key = field[len(prefix):]
+            if "." not in date_key:
+                return user_field, date_key
+    return None
+
+
+def split_day_updates(updates: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Split a ``$set`` dict into (user fields, {month: bucket ``$set``}).
+
+    Whole-map values (``period_predictions: {...}``) are split per day as well.
+    """
+    user_set: Dict[str, Any] = {}
+    bucket_sets: Dict[str, Dict[str, Any]] = defaultdict(dict)
+    for field, value in updates.items():
+        if field in DAY_MAP_FIELDS and isinstance(value, dict):
+            for date_key, day in value.items():
+                bucket_sets[month_of(date_key)][f"{DAY_MAP_FIELDS[field]}.{date_key}"] = day
+            continue
+        parsed = _split_dotted(field)
+        if parsed is None:
+            user_set[field] = value
+            continue
+        user_field, date_key = parsed
+        bucket_sets[month_of(date_key)][f"{DAY_MAP_FIELDS[user_field]}.{date_key}"] = value
+    return user_set, dict(bucket_sets)
+
+
+def bucket_operations(line_id: str, bucket_sets: Dict[str, Dict[str, Any]]) -> List[UpdateOne]:
+    now = datetime.utcnow()
+    return [
+        UpdateOne(
+            {"_id": bucket_id(line_id, month)},
+            {"$set": {**fields, "updated_at": now}, "$setOnInsert": {"line_id": line_id, "month": month}},
+            upsert=True,
+        )
+        for month, fields in sorted(bucket_sets.items())
+    ]
+
+
+def write_day_updates(
+    line_id: str | None,
+    bucket_sets: Dict[str, Dict[str, Any]],
+    *,
+    database,
+    session=None,
+) -> None:
+    if not line_id:
+        return
+    operations = bucket_operations(line_id, bucket_sets)
+    if operations:
+        bucket_collection(database).bulk_write(operations, ordered=False, session=session)
+
+
+def set_day(line_id: str, user_field: str, date_key: str, value: Any, *, database) -> None:
+    write_day_updates(
+        line_id, {month_of(date_key): {f"{DAY_MAP_FIELDS[user_field]}.{date_key}": value}}, database=database
+    )
+
+
+def _month_filter(line_id: str, start_date: str | None, end_date: str | None) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"line_id": line_id}
+    bounds: Dict[str, str] = {}
+    if start_date:
+        bounds["$gte"] = month_of(start_date)
+    if end_date:
+        bounds["$lte"] = month_of(end_date)
+    if bounds:
+        query["month"] = bounds
+    return query
+
+
+def _in_range(date_key: str, start_date: str | None, end_date: str | None) -> bool:
+    return (not start_date or date_key >= start_date) and (not end_date or date_key <= end_date)
+
+
+def read_day_maps(
+    line_id: str,
+    user_fields: Iterable[str],
+    *,
+    embedded: Dict[str, Any] | None = None,
+    start_date: str | None = None,
+    end_date: str | None = None,
+    database,
+) -> Dict[str, Any]:
+    """
+    Rebuild ``{user_field: {date: value}}`` for ``user_fields`` (roots such as
+    ``calendar_basic`` expand to their profile/holiday maps).
+
+    ``embedded`` is the projected user document; any maps still stored there are
+    merged underneath the bucket data.
+    """
+    wanted = [field for field in DAY_MAP_FIELDS if field.split(".")[0] in set(user_fields)]
+    result: Dict[str, Any] = {}
+
+    def _target(user_field: str) -> Dict[str, Any]:
+        if user_field.startswith("calendar_basic."):
+            basic = result.setdefault("calendar_basic", {})
+            return basic.setdefault(user_field.split(".", 1)[1], {})
+        return result.setdefault(user_field, {})
+
+    for user_field in wanted:
+        source: Any = embedded or {}
+        for part in user_field.split("."):
+            source = source.get(part) if isinstance(source, dict) else None
+        target = _target(user_field)
+        for date_key, value in (source or {}).items():
+            if _in_range(date_key, start_date, end_date):
+                target[date_key] = value
+
+    projection = {DAY_MAP_FIELDS[field]: 1 for field in wanted}
+    for bucket in bucket_collection(database).find(_month_filter(line_id, start_date, end_date), projection):
+        for user_field in wanted:
+            source: Any = bucket
+            for part in DAY_MAP_FIELDS[user_field].split("."):
+                source = source.get(part) if isinstance(source, dict) else None
+            target = _target(user_field)
+            for date_key, value in (source or {}).items():
+                if _in_range(date_key, start_date, end_date):
+                    target[date_key] = value
+    return result
+
+
+def day_keys(line_id: str, user_field: str, *, database) -> List[str]:
+    """Dates stored in buckets for one map, without transferring the values."""
+    sub = DAY_MAP_FIELDS[user_field]
+    pipeline = [
+        {"$match": {"line_id": line_id}},
+        {"$project": {"keys": {"$map": {"input": {"$objectToArray": {"$ifNull": [f"${sub}", {}]}}, "in": "$$this.k"}}}},
+        {"$unwind": "$keys"},
+        {"$group": {"_id": None, "keys": {"$addToSet": "$keys"}}},
+    ]
+    rows = list(bucket_collection(database).aggregate(pipeline))
+    return sorted(rows[0]["keys"]) if rows else []
+
+
+def month_day_counts(line_id: str, user_fields: Iterable[str], *, database) -> Dict[str, int]:
+    """``{month: days}`` over the union of ``user_fields`` dates in buckets, without transferring the values."""
+    keys = [
+        {"$map": {"input": {"$objectToArray": {"$ifNull": [f"${DAY_MAP_FIELDS[field]}", {}]}}, "in": "$$this.k"}}
+        for field in user_fields
+    ]
+    pipeline = [
+        {"$match": {"line_id": line_id}},
+        {"$project": {"month": 1, "days": {"$size": {"$setUnion": keys}}}},
+    ]
+    return {row["month"]: row["days"] for row in bucket_collection(database).aggregate(pipeline) if row["days"]}
+
+
+def gpt_day_versions(line_id: str, *, database) -> Dict[str, Any]:
+    """``{date: prompt_version|None}`` for GPT days stored in buckets."""
+    pipeline = [
+        {"$match": {"line_id": line_id}},
+        {"$project": {"days": {"$objectToArray": {"$ifNull": ["$gpt", {}]}}}},
+        {"$unwind": "$days"},
+        {"$project": {"_id": 0, "date": "$days.k", "version": "$days.v.prompt_version"}},
+    ]
+    return {row["date"]: row.get("version") for row in bucket_collection(database).aggregate(pipeline)}
+
+
+def gpt_day_exists(line_id: str, date_key: str, prompt_version: str | None = None, *, database) -> bool:
+    field = f"gpt.{date_key}"
+    query: Dict[str, Any] = {"_id": bucket_id(line_id, month_of(date_key))}
+    if prompt_version:
+        query[f"{field}.prompt_version"] = prompt_version
+    else:
+        query[field] = {"$exists": True}
+    return bucket_collection(database).count_documents(query, limit=1) > 0
+
+
+def _embedded_maps_query() -> Dict[str, Any]:
+    return {"$or": [{root: {"$type": "object"}} for root in USER_MAP_ROOTS]}
+
+
+def count_embedded_users(collection) -> int:
+    """Users that still carry day maps in their own document."""
+    return collection.count_documents(_embedded_maps_query())
+
+
+def migrate_users_to_buckets(
+    collection,
+    *,
+    batch_size: int = 50,
+    limit: int | None = None,
+    on_batch: Callable[[int], None] | None = None,
+) -> Dict[str, int]:
+    """
+    Move embedded day maps into buckets, one user at a time.
+
+    Each user's maps are upserted into buckets, then unset from the user
+    document only if they are unchanged since they were read; a user written to
+    mid-copy is counted as ``retry`` and picked up by the next run.
+    """
+    buckets = bucket_collection(collection.database)
+    projection = {"line_id": 1, **{root: 1 for root in USER_MAP_ROOTS}}
+    cursor = collection.find(_embedded_maps_query(), projection, batch_size=batch_size).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(int(limit))
+
+    summary = {"users": 0, "days": 0, "buckets": 0, "retry": 0, "skipped": 0}
+    for doc in cursor:
+        line_id = doc.get("line_id")
+        if not line_id:
+            summary["skipped"] += 1
+            continue
+        maps = {root: doc[root] for root in USER_MAP_ROOTS if isinstance(doc.get(root), dict)}
+        updates: Dict[str, Any] = {}
+        for user_field in DAY_MAP_FIELDS:
+            source: Any = maps
+            for part in user_field.split("."):
+                source = source.get(part) if isinstance(source, dict) else None
+            if isinstance(source, dict):
+                updates.update({f"{user_field}.{date_key}": value for date_key, value in source.items()})
+        _, bucket_sets = split_day_updates(updates)
+        operations = bucket_operations(line_id, bucket_sets)
+        if operations:
+            buckets.bulk_write(operations, ordered=False)
+
+        # Compare-and-unset: only clear maps nobody changed while they were copied.
+        result = collection.update_one(
+            {"_id": doc["_id"], **maps},
+            {"$unset": {root: "" for root in maps}},
+        )
+        if result.modified_count:
+            summary["users"] += 1
+            summary["days"] += len(updates)
+            summary["buckets"] += len(operations)
+        else:
+            summary["retry"] += 1
+        if on_batch is not None and (summary["users"] + summary["retry"]) % batch_size == 0:
+            on_batch(summary["users"])
+    if on_batch is not None:
+        on_batch(summary["users"])
+    return summary
+
+
+def submit_bucket_migration_job(collection) -> str:
+    """Run ``migrate_users_to_buckets`` as a background job; returns the job id."""
+
+    def _job(progress):
+        return migrate_users_to_buckets(collection, on_batch=lambda done: progress(users=done))
+
+    return jobs.submit(BUCKET_MIGRATION_JOB_KEY, _job, kind="migration")
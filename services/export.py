@@ -0,0 +1,206 @@
+"""Streaming CSV/Parquet export of users and transactions.
+
+The export reads ``user_profiles`` (core fields only) or ``transactions`` with
+one cursor in ``_id`` order, ``export.batch_size`` documents per round trip, and
+appends each batch to a file under ``export.dir`` as an Arrow record batch
+(``pyarrow.csv.CSVWriter`` / ``pyarrow.parquet.ParquetWriter``, one row group
+per batch). Only the current batch is held in memory, whatever the collection
+size. Exports run as background jobs. Reads use the ``export`` route, so they go
+to a secondary when read routing is enabled.
+"""
+from __future__ import annotations
+
+import itertools
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from pymongo import ASCENDING
+
+import config
+from . import jobs, read_routing
+from .history import HISTORY_HEAD_PROJECTION, HISTORY_SUMMARY_FIELD, first_sub_type
+from .tables import parse_tokens, user_types
+
+EXPORT_FORMATS = ("csv", "parquet")
+# Finished files older than this are removed when the next export starts.
+EXPORT_RETENTION_SECONDS = 24 * 3600
+
+# (column, dotted path or callable, kind); "int" columns keep missing values as null.
+USER_EXPORT_COLUMNS = [
+    ("_id", "_id", "text"),
+    ("line_id", "line_id", "text"),
+    ("name", "user_profiles", "text"),
+    ("tokens", "user_question_left", "int"),
+    ("user_type", first_sub_type, "user_type"),
+    ("period_start", "period_available.start_date", "text"),
+    ("period_end", "period_available.end_date", "text"),
+    ("purchase_count", f"{HISTORY_SUMMARY_FIELD}.purchase_count", "int"),
+    ("first_purchase_at", f"{HISTORY_SUMMARY_FIELD}.first_purchase.timestamp", "text"),
+    ("last_purchase_at", f"{HISTORY_SUMMARY_FIELD}.last_purchase.timestamp", "text"),
+    ("last_package_id", f"{HISTORY_SUMMARY_FIELD}.last_purchase.package_id", "text"),
+]
+TRANSACTION_EXPORT_COLUMNS = [
+    ("_id", "_id", "text"),
+    ("referenceId", "referenceId", "text"),
+    ("line_id", "line_id", "text"),
+    ("packageId", "packageId", "text"),
+    ("packageTitle", "packageTitle", "text"),
+    ("price", "price", "text"),
+    ("tokens", "tokens", "int"),
+    ("duration_days", "duration_days", "int"),
+    ("subType", "subType", "text"),
+    ("paymentType", "paymentType", "text"),
+    ("timestamp", "timestamp", "text"),
+    ("created_at", "created_at", "text"),
+]
+EXPORT_DATASETS: Dict[str, Dict[str, Any]] = {
+    "users": {
+        "columns": USER_EXPORT_COLUMNS,
+        "projection": {
+            "line_id": 1,
+            "user_profiles": 1,
+            "user_question_left": 1,
+            "period_available.start_date": 1,
+            "period_available.end_date": 1,
+            HISTORY_SUMMARY_FIELD: 1,
+            # first_sub_type falls back to the first entry for users not yet backfilled.
+            "history_log": HISTORY_HEAD_PROJECTION,
+        },
+    },
+    "transactions": {
+        "columns": TRANSACTION_EXPORT_COLUMNS,
+        "projection": {path: 1 for _, path, _ in TRANSACTION_EXPORT_COLUMNS if path != "_id"},
+    },
+}
+_TYPES = {"text": pa.string(), "int": pa.int64(), "user_type": pa.string()}
+
+
+def export_job_key(dataset: str) -> str:
+    return f"export:{dataset}"
+
+
+def export_schema(dataset: str) -> pa.Schema:
+    return pa.schema([(name, _TYPES[kind]) for name, _, kind in EXPORT_DATASETS[dataset]["columns"]])
+
+
+def _lookup(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def _text(value: Any) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def export_batch(dataset: str, docs: List[Dict[str, Any]]) -> pa.RecordBatch:
+    """One record batch in ``export_schema(dataset)`` for a list of projected documents."""
+    arrays = []
+    for _, path, kind in EXPORT_DATASETS[dataset]["columns"]:
+        getter = path if callable(path) else (lambda doc, path=path: _lookup(doc, path))
+        text = pa.array([_text(getter(doc)) for doc in docs], pa.string())
+        if kind == "int":
+            text = pc.if_else(pc.is_null(text), pa.scalar(None, pa.int64()), parse_tokens(text))
+        elif kind == "user_type":
+            text = user_types(text)
+        arrays.append(text)
+    return pa.RecordBatch.from_arrays(arrays, schema=export_schema(dataset))
+
+
+def _writer(path: str, schema: pa.Schema, fmt: str):
+    if fmt == "csv":
+        return pa_csv.CSVWriter(path, schema)
+    if fmt == "parquet":
+        return pq.ParquetWriter(path, schema)
+    raise ValueError(f"Unknown export format: {fmt}")
+
+
+def write_export(
+    collection,
+    dataset: str,
+    fmt: str,
+    path: str,
+    *,
+    batch_size: int | None = None,
+    on_batch: Callable[[int], None] | None = None,
+) -> int:
+    """Stream ``dataset`` from ``collection`` into ``path``; returns the number of rows written."""
+    batch_size = int(batch_size or config.EXPORT_BATCH_SIZE)
+    projection = EXPORT_DATASETS[dataset]["projection"]
+    cursor = collection.find({}, projection, batch_size=batch_size).sort("_id", ASCENDING)
+    rows = 0
+    writer = _writer(path, export_schema(dataset), fmt)
+    try:
+        while True:
+            docs = list(itertools.islice(cursor, batch_size))
+            if not docs:
+                break
+            writer.write_batch(export_batch(dataset, docs))
+            rows += len(docs)
+            if on_batch:
+                on_batch(rows)
+    finally:
+        writer.close()
+        cursor.close()
+    return rows
+
+
+def export_dir() -> Path:
+    path = Path(config.EXPORT_DIR or Path(tempfile.gettempdir()) / "user_admin_exports")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _prune_exports(directory: Path) -> None:
+    cutoff = time.time() - EXPORT_RETENTION_SECONDS
+    for path in directory.glob("*"):
+        try:
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def submit_export_job(collection, dataset: str, fmt: str, *, batch_size: int | None = None) -> str:
+    """
+    Export ``dataset`` as a background job; returns the job id.
+
+    Progress reports ``rows`` and an estimated ``total``. The result is
+    ``{"path", "file_name", "rows", "bytes"}``; a failed export removes its file.
+    """
+    if dataset not in EXPORT_DATASETS:
+        raise ValueError(f"Unknown export dataset: {dataset}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    collection = read_routing.routed(collection, "export")
+
+    def _job(progress):
+        directory = export_dir()
+        _prune_exports(directory)
+        file_name = f"{dataset}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        handle, path = tempfile.mkstemp(prefix=f"{dataset}_", suffix=f".{fmt}", dir=directory)
+        os.close(handle)
+        progress(rows=0, total=collection.estimated_document_count())
+        try:
+            rows = write_export(
+                collection, dataset, fmt, path, batch_size=batch_size, on_batch=lambda done: progress(rows=done)
+            )
+        except Exception:
+            os.remove(path)
+            raise
+        return {"path": path, "file_name": file_name, "rows": rows, "bytes": os.path.getsize(path)}
+
+    return jobs.submit(export_job_key(dataset), _job, kind="export", dataset=dataset, format=fmt)
@@ -8,6 +8,7 @@ import pandas as pd
 from pymongo import MongoClient
 
 import config
+from . import read_routing
 
 
 def _calendar_client():
@@ -24,7 +25,8 @@ def load_calendar_profile_month(year: int, month: int) -> Dict[str, Any]:
         start = datetime(year, month, 1)
         end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
 
-        results = list(collection.find({"date": {"$gte": start, "$lt": end}}))
+        with read_routing.timed("reference"):
+            results = list(read_routing.routed(collection, "reference").find({"date": {"$gte": start, "$lt": end}}))
         if not results:
             return {}
 
@@ -47,7 +49,8 @@ def load_calendar_holiday_month(year: int, month: int) -> Dict[str, Any]:
         start = datetime(year, month, 1)
         end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
 
-        results = list(collection.find({"date": {"$gte": start, "$lt": end}}))
+        with read_routing.timed("reference"):
+            results = list(read_routing.routed(collection, "reference").find({"date": {"$gte": start, "$lt": end}}))
         if not results:
             return {}
 
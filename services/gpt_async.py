@@ -0,0 +1,452 @@
+"""Asyncio GPT calendar pipeline.
+
+All async GPT jobs share one event loop running in a daemon thread, so hundreds
+of date completions can be in flight without a thread per user. Completions are
+consumed as server-sent event streams and partial progress is published through
+``backend_utils._update_gpt_status``. Blocking Mongo calls run on a dedicated
+thread pool sized to ``gpt.max_concurrency`` rather than the loop's default
+executor.
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import json
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict
+
+import httpx
+
+import config
+from . import backend_utils, gpt_cache, single_flight
+from .backend_utils import _now_iso, _update_gpt_status
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 3
+BACKOFF_FACTOR = 1.5
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+_semaphore: asyncio.Semaphore | None = None
+_client: httpx.AsyncClient | None = None
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared event loop, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="gpt-async-loop", daemon=True)
+            thread.start()
+            _loop = loop
+        return _loop
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Created lazily so it is bound to the shared loop.
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, int(config.GPT_MAX_CONCURRENCY)))
+    return _semaphore
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(config.GPT_MAX_CONCURRENCY)), thread_name_prefix="gpt-async-io"
+        )
+    return _executor
+
+
+async def _blocking(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking (Mongo) call on the pipeline's own thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        limit = max(1, int(config.GPT_MAX_CONCURRENCY))
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        )
+    return _client
+
+
+def _error_message(body: bytes) -> str:
+    try:
+        parsed = json.loads(body or b"{}")
+    except ValueError:
+        return body.decode("utf-8", "ignore")
+    if isinstance(parsed, dict):
+        return str(parsed.get("error") or parsed.get("message") or parsed)
+    return str(parsed)
+
+
+async def stream_gpt(
+    text_input: str,
+    on_delta: Callable[[int], None] | None = None,
+) -> Dict[str, Any]:
+    """
+    Stream a chat completion, returning the same result dict as
+    ``backend_utils.call_gpt_with_meta``.
+
+    The response cache is consulted first. ``on_delta`` receives the number of
+    characters received so far. Mirrors the retry policy of ``call_gpt``.
+    """
+    cached = await _blocking(backend_utils.lookup_gpt_cache, text_input)
+    if cached is not None:
+        return {
+            "status_code": 200,
+            "content": cached["content"],
+            "usage": cached.get("usage"),
+            "cache_hit": True,
+            "cost_usd": gpt_cache.estimate_cost_usd(cached.get("usage")),
+        }
+
+    payload = {
+        "model": config.GPT_MODEL,
+        "messages": [{"role": "user", "content": text_input}],
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    headers = backend_utils.gpt_request_headers()
+    client = _get_client()
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            async with client.stream("POST", config.GPT_URL, json=payload, headers=headers) as response:
+                status = response.status_code
+                if status != 200:
+                    body = await response.aread()
+                    if status in RETRY_STATUSES and attempt < MAX_ATTEMPTS:
+                        await asyncio.sleep(BACKOFF_FACTOR * (2 ** (attempt - 1)))
+                        continue
+                    return {
+                        "status_code": status,
+                        "content": _error_message(body),
+                        "usage": None,
+                        "cache_hit": False,
+                        "cost_usd": 0.0,
+                    }
+
+                parts = []
+                received = 0
+                usage = None
+                finished = False
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        finished = True
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    finished = finished or bool(choices[0].get("finish_reason"))
+                    text = (choices[0].get("delta") or {}).get("content")
+                    if text:
+                        parts.append(text)
+                        received += len(text)
+                        if on_delta is not None:
+                            on_delta(received)
+                content = "".join(parts)
+                # A stream cut off early (or an empty answer) must not be served from the cache.
+                if finished and content:
+                    await _blocking(backend_utils.save_gpt_cache, text_input, content, usage)
+                return {
+                    "status_code": status,
+                    "content": content,
+                    "usage": usage,
+                    "cache_hit": False,
+                    "cost_usd": gpt_cache.estimate_cost_usd(usage),
+                }
+        except httpx.HTTPError as exc:
+            if attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(BACKOFF_FACTOR * (2 ** (attempt - 1)))
+                continue
+            raise RuntimeError(f"GPT request failed: {exc}") from exc
+
+    raise RuntimeError("GPT request failed: retries exhausted")
+
+
+async def repair_std_day(res: Dict[str, Any], text_input: str) -> Dict[str, Any]:
+    """Async counterpart of ``backend_utils.repair_std_day``."""
+    validation = backend_utils.validate_std_day(res)
+    info = {"score": validation["score"], "missing": validation["missing"], "repaired": [], "gpt": None}
+    if not validation["missing"]:
+        return info
+
+    meta = await stream_gpt(backend_utils.build_std_day_repair_prompt(text_input, validation["missing"]))
+    info["gpt"] = meta
+    if meta.get("status_code") == 200:
+        info["repaired"] = backend_utils.merge_std_day_repair(res, meta.get("content") or "", validation["missing"])
+    backend_utils.finalize_std_day_validation(res, info)
+    return info
+
+
+@contextlib.asynccontextmanager
+async def _lease_heartbeat(key: str, token: str) -> AsyncIterator[None]:
+    """Async counterpart of ``single_flight.lease_heartbeat``: one loop task per held lease."""
+
+    async def _beat() -> None:
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(single_flight.LEASE_SECONDS / 3)
+            if time.monotonic() - started > single_flight.LEASE_MAX_HOLD_SECONDS:
+                return
+            try:
+                if not await _blocking(single_flight.renew_lease, key, token):
+                    return
+            except Exception:  # noqa: BLE001 - a missed beat is retried on the next one
+                continue
+
+    task = asyncio.create_task(_beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def generate_std_day_once(
+    line_id: str,
+    target_date: str,
+    produce,
+    prompt_version: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Async counterpart of ``backend_utils.generate_std_day_once`` using the same Mongo lease.
+
+    The lease is only taken while holding a pipeline slot (``_get_semaphore``), so
+    queued days hold no lease; a day whose lease another worker holds gives its
+    slot back while it waits.
+    """
+    key = single_flight.lease_key(line_id, target_date)
+    deadline = time.monotonic() + single_flight.LEASE_WAIT_SECONDS
+    while True:
+        async with _get_semaphore():
+            token = await _blocking(single_flight.acquire_lease, key)
+            if token:
+                try:
+                    if await _blocking(backend_utils.std_day_exists, line_id, target_date, prompt_version):
+                        return backend_utils.deduplicated_std_day_result()
+                    async with _lease_heartbeat(key, token):
+                        return await produce()
+                finally:
+                    await _blocking(single_flight.release_lease, key, token)
+        if await _blocking(backend_utils.std_day_exists, line_id, target_date, prompt_version):
+            return backend_utils.deduplicated_std_day_result()
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out waiting for another worker to generate {target_date}.")
+        await asyncio.sleep(backend_utils.STD_DAY_LEASE_POLL_SECONDS)
+
+
+async def UpdatePeriodGPTAllAsync(
+    line_id: str,
+    mode: str = "missing",
+    throttle_seconds: float = 0.0,
+) -> Dict[str, Any]:
+    """
+    Async counterpart of ``backend_utils.UpdatePeriodGPTAll``.
+
+    With ``throttle_seconds`` request starts are spaced out instead of being
+    limited only by the semaphore.
+    """
+    _update_gpt_status(
+        line_id,
+        status="running",
+        message="Preparing GPT calendar rebuild.",
+        started_processing_at=_now_iso(),
+        pipeline="async",
+    )
+
+    user_info = await _blocking(backend_utils.get_std_day_user_info, line_id)
+    prompts = await _blocking(backend_utils.get_config_prompts)
+    prompt_version = backend_utils.std_day_prompt_version(prompts)
+    pending_dates, skipped_existing = await _blocking(
+        backend_utils.get_std_day_pending_dates, line_id, mode, prompt_version
+    )
+    day_names = await _blocking(backend_utils.find_std_day_names, pending_dates)
+
+    summary_data = backend_utils.start_std_day_summary(line_id, len(pending_dates), skipped_existing)
+    _update_gpt_status(line_id, mode=mode, prompt_version=prompt_version)
+    pace_lock = asyncio.Lock()
+    next_start = [time.monotonic()]
+
+    async def pace() -> None:
+        if not throttle_seconds:
+            return
+        async with pace_lock:
+            delay = next_start[0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_start[0] = time.monotonic() + throttle_seconds
+    streaming: Dict[str, int] = {}
+    last_publish = [0.0]
+
+    def publish(force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - last_publish[0] < PROGRESS_INTERVAL_SECONDS:
+            return
+        last_publish[0] = now
+        backend_utils.publish_std_day_progress(
+            summary_data,
+            in_flight=len(streaming),
+            streaming_chars=dict(streaming),
+        )
+
+    async def produce(target_date: str) -> Dict[str, Any]:
+        # Runs inside the slot and lease taken by generate_std_day_once.
+        await pace()
+        # No Mongo reads once the user, prompts and day name are prefetched; the
+        # energy calculation is still CPU work, so it stays off the loop.
+        prompt = await _blocking(
+            backend_utils.build_std_day_prompt,
+            line_id,
+            target_date,
+            user_info=user_info,
+            prompts=prompts,
+            day=day_names.get(target_date),
+        )
+        streaming[target_date] = 0
+
+        def on_delta(received: int) -> None:
+            streaming[target_date] = received
+            publish()
+
+        meta = await stream_gpt(prompt["text_input"], on_delta)
+        status_code, payload = meta["status_code"], meta["content"]
+        if status_code != 200:
+            raise RuntimeError(f"GPT call failed ({status_code}): {payload}")
+
+        res = backend_utils.parse_std_day_response(
+            payload, prompt["day_name"], prompt["theme"], prompt["prompt_version"]
+        )
+        repair = await repair_std_day(res, prompt["text_input"])
+        await _blocking(backend_utils.store_std_day, line_id, target_date, res)
+        return {"status_code": status_code, "result": res, "gpt": meta, "repair": repair}
+
+    async def generate(target_date: str) -> None:
+        try:
+            request_result = await generate_std_day_once(
+                line_id,
+                target_date,
+                lambda: produce(target_date),
+                prompt_version if mode == "stale" else None,
+            )
+            backend_utils.record_std_day_success(
+                summary_data, target_date, request_result["gpt"], request_result.get("repair")
+            )
+        except Exception as exc:  # noqa: BLE001
+            backend_utils.record_std_day_failure(summary_data, target_date, exc)
+        finally:
+            streaming.pop(target_date, None)
+            publish(force=True)
+
+    await asyncio.gather(*(generate(target_date) for target_date in pending_dates))
+    return backend_utils.finish_std_day_summary(summary_data)
+
+
+def _finish_async_job(line_id: str, future: "concurrent.futures.Future[Dict[str, Any]]") -> None:
+    try:
+        summary = future.result()
+        _update_gpt_status(
+            line_id,
+            status="completed",
+            completed_at=_now_iso(),
+            message="GPT calendar generation finished.",
+            result=summary,
+            in_flight=0,
+            streaming_chars={},
+        )
+    except Exception as exc:  # noqa: BLE001
+        import traceback
+
+        tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        print(f"UpdatePeriodGPTAllAsync crashed for {line_id}: {exc} ({type(exc).__name__})\n{tb}")
+        _update_gpt_status(
+            line_id,
+            status="error",
+            completed_at=_now_iso(),
+            message=str(exc),
+            last_error=str(exc),
+            traceback=tb,
+        )
+    finally:
+        backend_utils.release_bg_task(line_id)
+        _update_gpt_status(line_id, queue_size=len(backend_utils.BG_STD_TASK))
+
+
+def run_UpdatePeriodGPTAllAsync_in_background(
+    line_id: str,
+    mode: str = "missing",
+    throttle_seconds: float = 0.0,
+    *,
+    wait: bool = False,
+) -> Dict[str, Any]:
+    """
+    Schedule the async rebuild on the shared loop; same contract as the threaded runner.
+
+    With ``wait`` the caller blocks until the rebuild finishes and gets the final status.
+    """
+    if not backend_utils.claim_bg_task(line_id):
+        return {
+            "status": "running",
+            "line_id": line_id,
+            "queue_size": len(backend_utils.BG_STD_TASK),
+            "message": "GPT calendar generation already running for this user.",
+            "details": backend_utils.get_gpt_task_status(line_id),
+        }
+
+    entry = _update_gpt_status(
+        line_id,
+        status="queued",
+        queue_size=len(backend_utils.BG_STD_TASK),
+        started_at=_now_iso(),
+        message="GPT calendar generation started in background.",
+        pipeline="async",
+        mode=mode,
+        processed_dates=0,
+        successful_count=0,
+        failed_count=0,
+        failed_results=[],
+        pending_dates=None,
+        total_dates=None,
+        last_request=None,
+    )
+
+    future = asyncio.run_coroutine_threadsafe(UpdatePeriodGPTAllAsync(line_id, mode, throttle_seconds), _get_loop())
+    if wait:
+        _finish_async_job(line_id, future)
+        details = backend_utils.get_gpt_task_status(line_id) or {}
+        return {
+            "status": details.get("status"),
+            "line_id": line_id,
+            "queue_size": len(backend_utils.BG_STD_TASK),
+            "message": details.get("message"),
+            "details": details,
+        }
+    future.add_done_callback(lambda fut: _finish_async_job(line_id, fut))
+
+    return {
+        "status": "started",
+        "line_id": line_id,
+        "queue_size": len(backend_utils.BG_STD_TASK),
+        "message": "GPT calendar generation started in background.",
+        "details": copy.deepcopy(entry),
+    }
@@ -0,0 +1,143 @@
+"""Content-addressed cache for GPT completions.
+
+Entries are keyed by a SHA-256 of ``(model, prompt)`` and stored in MongoDB so
+every app replica shares them. A TTL index expires stale entries and the
+collection is trimmed back to ``GPT_CACHE_MAX_ENTRIES`` (least recently hit
+first) every few writes.
+"""
+from __future__ import annotations
+
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict
+
+from pymongo import ASCENDING, MongoClient
+
+import config
+from .indexes import create_group_indexes
+
+CACHE_DB_NAME = "your_database"
+CACHE_COLLECTION_NAME = "gpt_response_cache"
+EVICTION_CHECK_EVERY = 100
+
+_state_lock = threading.Lock()
+_writes_since_check = 0
+_indexes_ready = False
+
+
+@lru_cache(maxsize=1)
+def _cache_client() -> MongoClient:
+    return MongoClient(config.MONGO_URL)
+
+
+def _collection():
+    global _indexes_ready
+    collection = _cache_client()[CACHE_DB_NAME][CACHE_COLLECTION_NAME]
+    if not _indexes_ready:
+        create_group_indexes(collection, "gpt_cache")
+        _indexes_ready = True
+    return collection
+
+
+def cache_key(model: str, prompt: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def estimate_cost_usd(usage: Dict[str, Any] | None) -> float:
+    """Price a completion from its ``usage`` block using the configured per-1M token rates."""
+    if not usage:
+        return 0.0
+    prompt_tokens = int(usage.get("prompt_tokens") or 0)
+    completion_tokens = int(usage.get("completion_tokens") or 0)
+    return (
+        prompt_tokens * config.GPT_PRICE_INPUT_PER_1M
+        + completion_tokens * config.GPT_PRICE_OUTPUT_PER_1M
+    ) / 1_000_000
+
+
+def get_cached_response(model: str, prompt: str) -> Dict[str, Any] | None:
+    """Return ``{"content", "usage"}`` for a live cache entry, or ``None``."""
+    if not config.GPT_CACHE_ENABLED:
+        return None
+    now = datetime.utcnow()
+    doc = _collection().find_one_and_update(
+        {"_id": cache_key(model, prompt), "expires_at": {"$gt": now}},
+        {"$set": {"last_hit_at": now}, "$inc": {"hits": 1}},
+        projection={"content": 1, "usage": 1},
+    )
+    if not doc:
+        return None
+    return {"content": doc.get("content", ""), "usage": doc.get("usage")}
+
+
+def store_response(model: str, prompt: str, content: str, usage: Dict[str, Any] | None) -> None:
+    global _writes_since_check
+    if not config.GPT_CACHE_ENABLED:
+        return
+    now = datetime.utcnow()
+    collection = _collection()
+    collection.update_one(
+        {"_id": cache_key(model, prompt)},
+        {
+            "$set": {
+                "model": model,
+                "content": content,
+                "usage": usage,
+                "created_at": now,
+                "last_hit_at": now,
+                "expires_at": now + timedelta(days=config.GPT_CACHE_TTL_DAYS),
+            },
+            "$setOnInsert": {"hits": 0},
+        },
+        upsert=True,
+    )
+
+    with _state_lock:
+        _writes_since_check += 1
+        should_check = _writes_since_check >= EVICTION_CHECK_EVERY
+        if should_check:
+            _writes_since_check = 0
+    if should_check:
+        evict_overflow()
+
+
+def evict_overflow() -> int:
+    """Delete the least recently hit entries beyond ``GPT_CACHE_MAX_ENTRIES``."""
+    collection = _collection()
+    overflow = collection.estimated_document_count() - int(config.GPT_CACHE_MAX_ENTRIES)
+    if overflow <= 0:
+        return 0
+    stale_ids = [
+        doc["_id"]
+        for doc in collection.find({}, {"_id": 1}).sort("last_hit_at", ASCENDING).limit(overflow)
+    ]
+    if not stale_ids:
+        return 0
+    return collection.delete_many({"_id": {"$in": stale_ids}}).deleted_count
+
+
+def average_cost_usd(model: str, sample: int = 200) -> float:
+    """Average cost of recent cached completions for ``model``; falls back to the configured estimate."""
+    pipeline = [
+        {"$match": {"model": model, "usage": {"$ne": None}}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": sample},
+        {"$group": {
+            "_id": None,
+            "prompt_tokens": {"$avg": "$usage.prompt_tokens"},
+            "completion_tokens": {"$avg": "$usage.completion_tokens"},
+        }},
+    ]
+    try:
+        rows = list(_collection().aggregate(pipeline))
+    except Exception:  # noqa: BLE001
+        rows = []
+    if not rows:
+        return float(config.GPT_EST_COST_PER_DAY_USD)
+    return estimate_cost_usd(rows[0])
@@ -0,0 +1,247 @@
+"""Purchase history: summary counters on the user and a full event log.
+
+``history_log`` grows by one entry per purchase, but readers only need a few
+facts from it. Every writer applies ``history_update(entry)``, which pushes the
+entry and keeps ``history_summary`` current in the same update:
+
+- ``first_purchase``: ``{timestamp, sub_type}`` of the earliest entry (``$min``;
+  absent while the history is empty)
+- ``purchase_count``: ``$inc`` per purchase
+- ``last_purchase``: ``{timestamp, sub_type, package_id, end_date}`` (``$max``)
+
+The full history also goes to the ``user_events`` collection, so
+``history.tail_cap`` can keep only the newest entries in the user document.
+``backfill_history_summary`` computes the summary for existing users from
+their untrimmed ``history_log``; run it before setting a tail cap.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List
+
+from pymongo import ASCENDING, UpdateOne
+
+import config
+from . import jobs
+from .indexes import create_group_indexes
+
+HISTORY_SUMMARY_FIELD = "history_summary"
+HISTORY_BACKFILL_JOB_KEY = "backfill:history_summary"
+# Inclusion-projection expression: the first history entry, or nothing once the summary is backfilled.
+HISTORY_HEAD_PROJECTION = {
+    "$cond": [
+        {"$ifNull": [f"${HISTORY_SUMMARY_FIELD}.backfilled_at", False]},
+        "$$REMOVE",
+        {"$slice": [{"$ifNull": ["$history_log", []]}, 1]},
+    ]
+}
+
+
+def _first_purchase(entry: Dict[str, Any]) -> Dict[str, Any]:
+    # Field order matters: $min/$max compare embedded documents field by field.
+    return {"timestamp": entry.get("timestamp"), "sub_type": entry.get("subType")}
+
+
+def _last_purchase(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "timestamp": entry.get("timestamp"),
+        "sub_type": entry.get("subType"),
+        "package_id": entry.get("packageId"),
+        "end_date": entry.get("end_date"),
+    }
+
+
+def history_update(
+    entry: Dict[str, Any],
+    *,
+    user: Dict[str, Any] | None = None,
+    tail_cap: int | None = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Update operators that append ``entry`` and refresh ``history_summary``.
+
+    Pass the ``user`` as read (with ``history_summary``): an empty
+    ``first_purchase`` left by an older backfill sorts below every entry, so it
+    is overwritten with ``$set`` instead of ``$min``.
+    """
+    tail_cap = config.HISTORY_TAIL_CAP if tail_cap is None else int(tail_cap)
+    push: Any = {"$each": [entry], "$slice": -tail_cap} if tail_cap > 0 else entry
+    first_field = f"{HISTORY_SUMMARY_FIELD}.first_purchase"
+    first_purchase = ((user or {}).get(HISTORY_SUMMARY_FIELD) or {}).get("first_purchase")
+    first_operator = "$set" if first_purchase == {} else "$min"
+    return {
+        "$push": {"history_log": push},
+        "$inc": {f"{HISTORY_SUMMARY_FIELD}.purchase_count": 1},
+        first_operator: {first_field: _first_purchase(entry)},
+        "$max": {f"{HISTORY_SUMMARY_FIELD}.last_purchase": _last_purchase(entry)},
+    }
+
+
+def merge_update(update: Dict[str, Dict[str, Any]], extra: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Combine two update documents operator by operator (fields must not overlap)."""
+    merged = {operator: dict(fields) for operator, fields in update.items()}
+    for operator, fields in extra.items():
+        merged.setdefault(operator, {}).update(fields)
+    return merged
+
+
+def first_sub_type(doc: Dict[str, Any]) -> str | None:
+    """
+    ``subType`` of the user's first purchase.
+
+    Uses ``history_summary`` once it has been backfilled; until then the summary
+    only covers purchases made since the rollout, so ``history_log[0]`` is used.
+    """
+    summary = doc.get(HISTORY_SUMMARY_FIELD) or {}
+    if summary.get("backfilled_at"):
+        return (summary.get("first_purchase") or {}).get("sub_type")
+    history = doc.get("history_log") or []
+    first_entry = history[0] if history else None
+    return first_entry.get("subType") if isinstance(first_entry, dict) else None
+
+
+def event_id(line_id: str | None, entry: Dict[str, Any]) -> str:
+    return f"{line_id}:{entry.get('timestamp')}:{entry.get('referenceId')}"
+
+
+def event_operation(user: Dict[str, Any], entry: Dict[str, Any]) -> UpdateOne:
+    """Idempotent upsert of one history entry into the events collection."""
+    line_id = user.get("line_id")
+    return UpdateOne(
+        {"_id": event_id(line_id, entry)},
+        {"$setOnInsert": {**entry, "user_id": user.get("_id"), "line_id": line_id, "recorded_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def record_events(events_collection, user_entries: Iterable[tuple], *, session=None) -> None:
+    """Write ``(user, entry)`` pairs to the events collection."""
+    if events_collection is None:
+        return
+    operations = [event_operation(user, entry) for user, entry in user_entries]
+    if operations:
+        events_collection.bulk_write(operations, ordered=False, session=session)
+
+
+def ensure_event_indexes(events_collection) -> None:
+    create_group_indexes(events_collection, "events")
+
+
+def load_user_events(events_collection, line_id: str, limit: int = 0) -> List[Dict[str, Any]]:
+    cursor = events_collection.find({"line_id": line_id}, {"_id": 0}).sort("timestamp", ASCENDING)
+    if limit:
+        cursor = cursor.limit(int(limit))
+    return list(cursor)
+
+
+_HISTORY = {"$ifNull": ["$history_log", []]}
+
+
+def _history_entry_expr(index: int, fields: Dict[str, str]) -> Dict[str, Any]:
+    """``fields`` of ``history_log[index]``, or ``$$REMOVE`` when the history is empty.
+
+    An empty ``{}`` would sort below every real entry and block later ``$min`` updates.
+    """
+    return {
+        "$cond": [
+            {"$gt": [{"$size": _HISTORY}, 0]},
+            {
+                "$let": {
+                    "vars": {"entry": {"$arrayElemAt": [_HISTORY, index]}},
+                    "in": {name: f"$$entry.{source}" for name, source in fields.items()},
+                }
+            },
+            "$$REMOVE",
+        ]
+    }
+
+
+_FIRST_PURCHASE_FIELDS = {"timestamp": "timestamp", "sub_type": "subType"}
+_LAST_PURCHASE_FIELDS = {
+    "timestamp": "timestamp",
+    "sub_type": "subType",
+    "package_id": "packageId",
+    "end_date": "end_date",
+}
+
+
+def _summary_pipeline() -> List[Dict[str, Any]]:
+    return [
+        {
+            "$set": {
+                HISTORY_SUMMARY_FIELD: {
+                    "first_purchase": _history_entry_expr(0, _FIRST_PURCHASE_FIELDS),
+                    "purchase_count": {
+                        "$size": {"$filter": {"input": _HISTORY, "cond": {"$eq": ["$$this.event", "buy_package"]}}}
+                    },
+                    "last_purchase": _history_entry_expr(-1, _LAST_PURCHASE_FIELDS),
+                    "backfilled_at": "$$NOW",
+                }
+            }
+        }
+    ]
+
+
+def repair_empty_first_purchase(collection) -> int:
+    """
+    Rebuild ``first_purchase`` where an earlier backfill stored ``{}`` for an empty history.
+
+    ``$min`` never replaces ``{}``, so users who bought afterwards still report
+    no first ``subType``. Returns the number of users repaired.
+    """
+    field = f"{HISTORY_SUMMARY_FIELD}.first_purchase"
+    result = collection.update_many(
+        {field: {}},
+        [{"$set": {field: _history_entry_expr(0, _FIRST_PURCHASE_FIELDS)}}],
+    )
+    return result.modified_count
+
+
+def backfill_history_summary(
+    collection,
+    events_collection,
+    *,
+    batch_size: int = 200,
+    on_batch: Callable[[int], None] | None = None,
+) -> Dict[str, int]:
+    """
+    Compute ``history_summary`` for users that have not been backfilled and copy
+    their ``history_log`` into the events collection.
+
+    The summary is recomputed server-side from the array in one pipeline update
+    per batch, so purchases landing mid-run are counted exactly once. Summaries
+    left with an empty ``first_purchase`` by earlier runs are repaired first.
+    """
+    if events_collection is not None:
+        ensure_event_indexes(events_collection)
+    query = {f"{HISTORY_SUMMARY_FIELD}.backfilled_at": {"$exists": False}}
+    summary = {"users": 0, "events": 0, "repaired": repair_empty_first_purchase(collection)}
+    cursor = collection.find(query, {"line_id": 1, "history_log": 1}, batch_size=batch_size).sort("_id", 1)
+    batch: List[Dict[str, Any]] = []
+
+    def _flush() -> None:
+        entries = [(doc, entry) for doc in batch for entry in doc.get("history_log") or [] if isinstance(entry, dict)]
+        record_events(events_collection, entries)
+        collection.update_many({"_id": {"$in": [doc["_id"] for doc in batch]}, **query}, _summary_pipeline())
+        summary["users"] += len(batch)
+        summary["events"] += len(entries) if events_collection is not None else 0
+        batch.clear()
+        if on_batch is not None:
+            on_batch(summary["users"])
+
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            _flush()
+    if batch:
+        _flush()
+    return summary
+
+
+def submit_history_backfill_job(collection, events_collection) -> str:
+    """Run ``backfill_history_summary`` as a background job; returns the job id."""
+
+    def _job(progress):
+        return backfill_history_summary(collection, events_collection, on_batch=lambda done: progress(users=done))
+
+    return jobs.submit(HISTORY_BACKFILL_JOB_KEY, _job, kind="migration")
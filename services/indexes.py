@@ -0,0 +1,200 @@
+"""Declarative registry of the indexes the app's hot queries rely on.
+
+Each spec names a group (the module that owns it), where the index lives, its
+key pattern and options, and a representative ``query`` used to ``explain()``
+the hot path. Modules that used to call ``create_index`` themselves now call
+``create_group_indexes(collection, group)``; ``verify_indexes`` checks (and
+optionally creates) the whole registry, and ``start_index_verification`` runs
+that as a background job when the connection is first made.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime
+from typing import Any, Dict, List
+
+from pymongo import ASCENDING
+
+import config
+from . import jobs
+
+VERIFY_JOB_KEY = "indexes:verify"
+# Databases used outside config.DB_NAME (shared with the LINE API backend).
+BACKEND_DB_NAME = "users"
+SHARED_DB_NAME = "your_database"
+SAMPLE_LINE_ID = "U" + "0" * 32
+
+
+def _spec(group, db, collection, keys, *, query=None, sort=None, **options) -> Dict[str, Any]:
+    name = options.pop("name", None) or "_".join(f"{field}_{direction}" for field, direction in keys)
+    return {
+        "group": group,
+        "db": db,
+        "collection": collection,
+        "keys": list(keys),
+        "name": name,
+        "options": options,
+        "query": query,
+        "sort": sort,
+    }
+
+
+def _calendar_profile_collections(today: date | None = None) -> List[str]:
+    """``calendar_profiles_<Buddhist year>`` for last, this and next year."""
+    year = (today or date.today()).year
+    return [f"calendar_profiles_{y + 543}" for y in (year - 1, year, year + 1)]
+
+
+def index_specs(today: date | None = None) -> List[Dict[str, Any]]:
+    today = today or date.today()
+    # Holidays store ``date`` as a datetime; calendar profiles as an ISO string (see backend_utils readers).
+    date_query = {"date": {"$gte": datetime(today.year, today.month, 1)}}
+    profile_date_query = {"date": {"$gte": today.replace(day=1).isoformat()}}
+    line_query = {"line_id": SAMPLE_LINE_ID}
+    specs = [
+        _spec("search", config.DB_NAME, config.COLL_NAME, [("line_id", ASCENDING)], query=line_query),
+        _spec("search", config.DB_NAME, config.COLL_NAME, [("search_ngrams", ASCENDING)],
+              query={"search_ngrams": {"$all": ["abc"]}}),
+        _spec("search", config.DB_NAME, config.COLL_NAME, [("search_name", ASCENDING), ("_id", ASCENDING)],
+              query={"search_name": {"$regex": "^ab"}}, sort=[("search_name", ASCENDING), ("_id", ASCENDING)]),
+        # Autocomplete polling and the incremental search backfill read users changed since a timestamp.
+        _spec("search", config.DB_NAME, config.COLL_NAME, [("updated_at", ASCENDING)],
+              query={"updated_at": {"$gt": datetime(today.year, today.month, 1)}}, sort=[("updated_at", ASCENDING)]),
+        # UpdatePeriodGPTAll / generate_prompt look users up by line_id in the backend database.
+        _spec("backend", BACKEND_DB_NAME, "user_profiles", [("line_id", ASCENDING)], query=line_query),
+        _spec("questions", config.DB_NAME, config.COLL_QUESTIONS_NAME, [("line_id", ASCENDING)], query=line_query),
+        _spec("transactions", config.DB_NAME, "transactions", [("referenceId", ASCENDING)],
+              query={"referenceId": "000000000000"}),
+        _spec("transactions", config.DB_NAME, "transactions", [("line_id", ASCENDING)], query=line_query),
+        _spec("calendar_buckets", config.DB_NAME, "user_calendar_buckets",
+              [("line_id", ASCENDING), ("month", ASCENDING)], unique=True, query=line_query),
+        _spec("calendar_archive", config.DB_NAME, config.COLL_CALENDAR_ARCHIVE_NAME,
+              [("line_id", ASCENDING), ("month", ASCENDING)], unique=True, query=line_query),
+        _spec("events", config.DB_NAME, config.COLL_USER_EVENTS_NAME,
+              [("line_id", ASCENDING), ("timestamp", ASCENDING)], query=line_query, sort=[("timestamp", ASCENDING)]),
+        _spec("gpt_cache", SHARED_DB_NAME, "gpt_response_cache", [("expires_at", ASCENDING)],
+              name="expires_at_ttl", expireAfterSeconds=0),
+        _spec("gpt_cache", SHARED_DB_NAME, "gpt_response_cache", [("last_hit_at", ASCENDING)]),
+        _spec("leases", SHARED_DB_NAME, "gpt_generation_leases", [("expires_at", ASCENDING)],
+              name="expires_at_ttl", expireAfterSeconds=0),
+        _spec("general_calendar", SHARED_DB_NAME, "calendar_holidays_until2025_2", [("date", ASCENDING)],
+              query=date_query),
+    ]
+    specs.extend(
+        _spec("general_calendar", SHARED_DB_NAME, name, [("date", ASCENDING)], query=profile_date_query)
+        for name in _calendar_profile_collections(today)
+    )
+    return specs
+
+
+def create_group_indexes(collection, group: str) -> None:
+    """Create every index of ``group`` on ``collection`` (the spec's namespace is not checked)."""
+    for spec in index_specs():
+        if spec["group"] == group:
+            collection.create_index(spec["keys"], name=spec["name"], **spec["options"])
+
+
+def _key_pattern(keys) -> List[tuple]:
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys]
+
+
+def _find_index(existing: Dict[str, Any], spec: Dict[str, Any]) -> str | None:
+    wanted = _key_pattern(spec["keys"])
+    for name, info in existing.items():
+        if _key_pattern(info.get("key") or []) == wanted:
+            return name
+    return None
+
+
+def verify_indexes(client, *, create: bool = False) -> List[Dict[str, Any]]:
+    """
+    Check every registered index; returns one row per spec with ``status``
+    ``ok``, ``missing``, ``created``, ``no collection`` or ``error``. Matching is
+    by key pattern, so an equivalent index under another name counts as present.
+    Collections that do not exist yet are not created.
+    """
+    rows: List[Dict[str, Any]] = []
+    info_cache: Dict[tuple, Dict[str, Any]] = {}
+    names_cache: Dict[str, set] = {}
+    for spec in index_specs():
+        namespace = (spec["db"], spec["collection"])
+        row = {
+            "group": spec["group"],
+            "namespace": ".".join(namespace),
+            "index": spec["name"],
+            "keys": ", ".join(f"{field}:{direction}" for field, direction in spec["keys"]),
+            "status": "ok",
+            "message": "",
+        }
+        collection = client[spec["db"]][spec["collection"]]
+        try:
+            if spec["db"] not in names_cache:
+                names_cache[spec["db"]] = set(client[spec["db"]].list_collection_names())
+            if spec["collection"] not in names_cache[spec["db"]]:
+                row["status"] = "no collection"
+                rows.append(row)
+                continue
+            if namespace not in info_cache:
+                info_cache[namespace] = collection.index_information()
+            found = _find_index(info_cache[namespace], spec)
+            if found:
+                row["index"] = found
+            elif create:
+                collection.create_index(spec["keys"], name=spec["name"], **spec["options"])
+                row["status"] = "created"
+            else:
+                row["status"] = "missing"
+        except Exception as exc:  # noqa: BLE001
+            row["status"] = "error"
+            row["message"] = str(exc)
+        rows.append(row)
+    return rows
+
+
+def start_index_verification(client, *, create: bool | None = None) -> str:
+    """Run ``verify_indexes`` as a background job; returns the job id."""
+    create = config.MONGO_CREATE_INDEXES if create is None else create
+    return jobs.submit(VERIFY_JOB_KEY, lambda progress: verify_indexes(client, create=create), kind="indexes", create=create)
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    plan = plan.get("queryPlan", plan)
+    stages: List[str] = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        inputs = plan.get("inputStages") or []
+        plan = plan.get("inputStage") or (inputs[0] if inputs else None)
+    return stages
+
+
+def explain_hot_queries(client) -> List[Dict[str, Any]]:
+    """Summarise ``explain()`` for the representative query of every spec that has one."""
+    rows: List[Dict[str, Any]] = []
+    for spec in index_specs():
+        if spec["query"] is None:
+            continue
+        collection = client[spec["db"]][spec["collection"]]
+        row: Dict[str, Any] = {"group": spec["group"], "namespace": f"{spec['db']}.{spec['collection']}"}
+        try:
+            cursor = collection.find(spec["query"], {"_id": 1})
+            if spec["sort"]:
+                cursor = cursor.sort(spec["sort"])
+            explained = cursor.limit(20).explain()
+            stages = _plan_stages((explained.get("queryPlanner") or {}).get("winningPlan") or {})
+            stats = explained.get("executionStats") or {}
+            row.update(
+                {
+                    "plan": " <- ".join(stages),
+                    "uses_index": any(stage.startswith(("IXSCAN", "IDHACK", "EXPRESS")) for stage in stages),
+                    "keys_examined": stats.get("totalKeysExamined"),
+                    "docs_examined": stats.get("totalDocsExamined"),
+                    "returned": stats.get("nReturned"),
+                    "ms": stats.get("executionTimeMillis"),
+                }
+            )
+        except Exception as exc:  # noqa: BLE001
+            row.update({"plan": f"error: {exc}", "uses_index": False})
+        rows.append(row)
+    return rows
@@ -0,0 +1,152 @@
+"""Process-wide registry of background jobs.
+
+Jobs run on a shared ``ThreadPoolExecutor`` so slow work (star predictions, GPT
+triggers) does not block a Streamlit script run. Each job has a ``key`` such as
+``calendar:<line_id>``; submitting a key that is still queued or running returns
+the existing job instead of starting the work again, so a page reload picks up
+the job already in flight. Job state lives in memory and is shared by every
+session of this process.
+
+Long bulk work is submitted with ``pool="bulk"`` and runs on its own, smaller
+executor (``jobs.bulk_max_workers``), so it never queues single-user jobs,
+exports or migrations behind it.
+"""
+from __future__ import annotations
+
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+import config
+
+ACTIVE_STATUSES = ("queued", "running")
+MAX_FINISHED_JOBS = 2000
+
+_executors = {
+    "default": ThreadPoolExecutor(max_workers=config.JOBS_MAX_WORKERS, thread_name_prefix="admin-job"),
+    "bulk": ThreadPoolExecutor(max_workers=max(1, config.JOBS_BULK_MAX_WORKERS), thread_name_prefix="admin-bulk-job"),
+}
+_jobs: Dict[str, Dict[str, Any]] = {}
+_latest_by_key: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def _prune_locked() -> None:
+    finished = [job for job in _jobs.values() if job["status"] not in ACTIVE_STATUSES]
+    overflow = len(finished) - MAX_FINISHED_JOBS
+    if overflow <= 0:
+        return
+    finished.sort(key=lambda job: job["finished_at"] or 0)
+    for job in finished[:overflow]:
+        _jobs.pop(job["id"], None)
+        if _latest_by_key.get(job["key"]) == job["id"]:
+            _latest_by_key.pop(job["key"], None)
+
+
+def _update(job_id: str, **fields: Any) -> None:
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+
+def _run(job_id: str, fn: Callable[..., Any]) -> None:
+    _update(job_id, status="running", started_at=time.time())
+
+    def progress(**fields: Any) -> None:
+        with _lock:
+            job = _jobs.get(job_id)
+            if job is not None:
+                job["progress"].update(fields)
+
+    try:
+        result = fn(progress)
+    except Exception as exc:  # noqa: BLE001
+        _update(
+            job_id,
+            status="failed",
+            error=str(exc),
+            traceback=traceback.format_exc(),
+            finished_at=time.time(),
+        )
+        return
+    _update(job_id, status="completed", result=result, finished_at=time.time())
+
+
+def submit(
+    key: str,
+    fn: Callable[[Callable[..., None]], Any],
+    *,
+    kind: str = "job",
+    dedupe: bool = True,
+    pool: str = "default",
+    **meta: Any,
+) -> str:
+    """
+    Run ``fn(progress)`` in the background and return the job id.
+
+    ``progress(**fields)`` merges fields into the job's ``progress`` dict. When a
+    job with the same ``key`` is still active its id is returned instead, unless
+    ``dedupe`` is False (callers that coordinate their own work per key).
+    ``pool`` picks the executor (``"default"`` or ``"bulk"``).
+    """
+    executor = _executors[pool]
+    with _lock:
+        existing_id = _latest_by_key.get(key)
+        existing = _jobs.get(existing_id) if existing_id else None
+        if dedupe and existing and existing["status"] in ACTIVE_STATUSES:
+            return existing["id"]
+
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            "id": job_id,
+            "key": key,
+            "kind": kind,
+            "meta": meta,
+            "status": "queued",
+            "progress": {},
+            "result": None,
+            "error": None,
+            "traceback": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        _latest_by_key[key] = job_id
+        _prune_locked()
+
+    executor.submit(_run, job_id, fn)
+    return job_id
+
+
+def _snapshot(job: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    if job is None:
+        return None
+    copy = dict(job)
+    copy["progress"] = dict(job["progress"])
+    return copy
+
+
+def get_job(job_id: str) -> Dict[str, Any] | None:
+    with _lock:
+        return _snapshot(_jobs.get(job_id))
+
+
+def latest_job(key: str) -> Dict[str, Any] | None:
+    """Most recent job submitted under ``key``, active or finished."""
+    with _lock:
+        job_id = _latest_by_key.get(key)
+        return _snapshot(_jobs.get(job_id)) if job_id else None
+
+
+def list_jobs(kind: str | None = None) -> List[Dict[str, Any]]:
+    with _lock:
+        jobs = [_snapshot(job) for job in _jobs.values() if kind is None or job["kind"] == kind]
+    return sorted(jobs, key=lambda job: job["submitted_at"], reverse=True)
+
+
+def is_active(job: Dict[str, Any] | None) -> bool:
+    return bool(job) and job["status"] in ACTIVE_STATUSES
@@ -0,0 +1,99 @@
+"""Read routing: which reads may go to secondaries, and how long they take.
+
+Routes name a class of read. With ``read_routing.enabled`` the routes in
+``read_routing.secondary_routes`` (default search, calendar, reference data and exports)
+read with ``secondaryPreferred`` bounded by ``max_staleness_seconds``; every
+other read, and all writes, stay on the primary. Callers that just wrote pass
+``fresh=True`` to read their own write from the primary.
+
+``timed(route)`` records per-route latency for ``route_stats``.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+from pymongo.read_preferences import SecondaryPreferred
+
+import config
+
+ROUTES = ("search", "calendar", "reference", "profile", "export")
+# Smallest maxStalenessSeconds the server accepts.
+MIN_MAX_STALENESS_SECONDS = 90
+LATENCY_SAMPLES = 500
+
+_lock = threading.Lock()
+_latencies: Dict[str, deque] = {}
+_counts: Dict[str, Dict[str, float]] = {}
+
+
+def max_staleness_seconds() -> int:
+    return max(MIN_MAX_STALENESS_SECONDS, int(config.READ_MAX_STALENESS_SECONDS))
+
+
+def uses_secondary(route: str) -> bool:
+    return config.READ_ROUTING_ENABLED and route in config.READ_SECONDARY_ROUTES
+
+
+def routed(collection, route: str, *, fresh: bool = False):
+    """``collection`` with the read preference of ``route`` (primary when ``fresh``)."""
+    if fresh or not uses_secondary(route):
+        return collection
+    return collection.with_options(read_preference=SecondaryPreferred(max_staleness=max_staleness_seconds()))
+
+
+@contextmanager
+def timed(route: str) -> Iterator[None]:
+    """Record how long the block takes under ``route``; failures are counted separately."""
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _lock:
+            _latencies.setdefault(route, deque(maxlen=LATENCY_SAMPLES)).append(elapsed_ms)
+            counts = _counts.setdefault(route, {"reads": 0, "errors": 0, "total_ms": 0.0})
+            counts["reads"] += 1
+            counts["errors"] += int(failed)
+            counts["total_ms"] += elapsed_ms
+
+
+def _percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def route_stats() -> List[Dict[str, Any]]:
+    """One row per route seen so far: target, read count, errors and latency (ms)."""
+    with _lock:
+        snapshot = {route: (list(samples), dict(_counts[route])) for route, samples in _latencies.items()}
+    rows = []
+    for route, (samples, counts) in sorted(snapshot.items()):
+        rows.append(
+            {
+                "route": route,
+                "target": f"secondaryPreferred ({max_staleness_seconds()}s)" if uses_secondary(route) else "primary",
+                "reads": int(counts["reads"]),
+                "errors": int(counts["errors"]),
+                "mean_ms": round(counts["total_ms"] / max(counts["reads"], 1), 1),
+                "p50_ms": round(_percentile(samples, 0.50), 1),
+                "p95_ms": round(_percentile(samples, 0.95), 1),
+                "max_ms": round(max(samples, default=0.0), 1),
+            }
+        )
+    return rows
+
+
+def reset_route_stats() -> None:
+    with _lock:
+        _latencies.clear()
+        _counts.clear()
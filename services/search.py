@@ -0,0 +1,179 @@
+"""Indexed user search.
+
+Each user document carries two derived fields maintained on write:
+
+- ``search_name``: the LINE display name, NFC-normalised, case-folded, with
+  zero-width characters removed and decomposed Thai SARA AM recomposed.
+- ``search_ngrams``: the distinct character trigrams of ``search_name``.
+
+Substring queries of three or more characters become an ``$all`` match on the
+multikey ``search_ngrams`` index; shorter queries use an anchored prefix range
+on ``search_name``. A LINE user id is matched exactly on ``line_id``. Documents
+that have not been backfilled yet are still found through the legacy regex
+branch, which the ``search_name`` index limits to the un-backfilled set.
+"""
+from __future__ import annotations
+
+import re
+import unicodedata
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+from .history import HISTORY_HEAD_PROJECTION
+from .indexes import create_group_indexes
+
+NGRAM_SIZE = 3
+SEARCH_SORT = [("search_name", ASCENDING), ("_id", ASCENDING)]
+# Totals above this are reported as "at least" so counting stays cheap on broad keywords.
+SEARCH_COUNT_CAP = 1000
+# Only what the results table needs; heavy maps (predictions, calendars) stay in Mongo.
+SEARCH_RESULT_PROJECTION = {
+    "user_profiles": 1,
+    "line_id": 1,
+    "user_question_left": 1,
+    "search_name": 1,
+    "history_summary.first_purchase": 1,
+    "history_summary.backfilled_at": 1,
+    # get_user_type falls back to the first entry only until the history backfill has run.
+    "history_log": HISTORY_HEAD_PROJECTION,
+}
+LINE_ID_PATTERN = re.compile(r"^U[0-9a-f]{32}$")
+
+_ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff"), None)
+# NIKHAHIT + SARA AA is how some keyboards type SARA AM; fold it to the single code point.
+_THAI_SARA_AM_DECOMPOSED = "\u0e4d\u0e32"
+_THAI_SARA_AM = "\u0e33"
+
+
+def normalize_name(value: Any) -> str:
+    text = unicodedata.normalize("NFC", str(value or ""))
+    text = text.translate(_ZERO_WIDTH).replace(_THAI_SARA_AM_DECOMPOSED, _THAI_SARA_AM)
+    return " ".join(text.casefold().split())
+
+
+def name_ngrams(normalized: str) -> List[str]:
+    if len(normalized) < NGRAM_SIZE:
+        return [normalized] if normalized else []
+    return sorted({normalized[i:i + NGRAM_SIZE] for i in range(len(normalized) - NGRAM_SIZE + 1)})
+
+
+def search_fields(display_name: Any) -> Dict[str, Any]:
+    """Derived fields to ``$set`` whenever ``user_profiles`` (the display name) changes."""
+    normalized = normalize_name(display_name)
+    return {"search_name": normalized, "search_ngrams": name_ngrams(normalized)}
+
+
+def build_search_query(keyword: str) -> Dict[str, Any]:
+    keyword = (keyword or "").strip()
+    if LINE_ID_PATTERN.match(keyword):
+        return {"line_id": keyword}
+
+    normalized = normalize_name(keyword)
+    if len(normalized) >= NGRAM_SIZE:
+        indexed = {
+            "search_ngrams": {"$all": name_ngrams(normalized)},
+            "search_name": {"$regex": re.escape(normalized)},
+        }
+    else:
+        indexed = {"search_name": {"$regex": "^" + re.escape(normalized)}}
+
+    legacy = {
+        "search_name": {"$exists": False},
+        "user_profiles": {"$regex": re.escape(keyword), "$options": "i"},
+    }
+    return {"$or": [indexed, legacy]}
+
+
+def search_users(
+    collection,
+    keyword: str,
+    *,
+    limit: int = 200,
+    projection: Dict[str, Any] | None = SEARCH_RESULT_PROJECTION,
+) -> List[Dict[str, Any]]:
+    return list(collection.find(build_search_query(keyword), projection, limit=limit))
+
+
+def keyset_filter(after: Tuple[str | None, str] | None) -> Dict[str, Any]:
+    """
+    Filter selecting documents that sort after ``after`` = (search_name, _id).
+
+    Documents without ``search_name`` sort first (null), so a null cursor
+    continues through them and then into every named document.
+    """
+    if after is None:
+        return {}
+    name, doc_id = after
+    last_id = ObjectId(doc_id)
+    if name is None:
+        return {"$or": [
+            {"search_name": None, "_id": {"$gt": last_id}},
+            {"search_name": {"$type": "string"}},
+        ]}
+    return {"$or": [
+        {"search_name": {"$gt": name}},
+        {"search_name": name, "_id": {"$gt": last_id}},
+    ]}
+
+
+def search_users_page(
+    collection,
+    keyword: str,
+    *,
+    page_size: int,
+    after: Tuple[str | None, str] | None = None,
+    projection: Dict[str, Any] | None = SEARCH_RESULT_PROJECTION,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """Return one page of matches ordered by (search_name, _id) and whether more follow."""
+    query = build_search_query(keyword)
+    cursor_filter = keyset_filter(after)
+    if cursor_filter:
+        query = {"$and": [query, cursor_filter]}
+    docs = list(collection.find(query, projection).sort(SEARCH_SORT).limit(page_size + 1))
+    return docs[:page_size], len(docs) > page_size
+
+
+def estimate_search_total(collection, keyword: str, *, cap: int = SEARCH_COUNT_CAP) -> Tuple[int, bool]:
+    """Count matches up to ``cap``; returns ``(count, capped)``."""
+    count = collection.count_documents(build_search_query(keyword), limit=cap)
+    return count, count >= cap
+
+
+def ensure_search_indexes(collection) -> None:
+    create_group_indexes(collection, "search")
+
+
+def count_missing_search_fields(collection) -> int:
+    return collection.count_documents({"search_name": {"$exists": False}})
+
+
+def backfill_search_fields(
+    collection,
+    *,
+    batch_size: int = 1000,
+    updated_since: datetime | None = None,
+) -> int:
+    """
+    Populate ``search_name``/``search_ngrams`` in batches.
+
+    Covers documents never indexed and, with ``updated_since``, documents the
+    main API renamed after that time. Returns the number of documents updated.
+    """
+    query: Dict[str, Any] = {"search_name": {"$exists": False}}
+    if updated_since is not None:
+        query = {"$or": [query, {"updated_at": {"$gt": updated_since}}]}
+
+    updated = 0
+    batch: List[UpdateOne] = []
+    cursor = collection.find(query, {"user_profiles": 1}, batch_size=batch_size)
+    for doc in cursor:
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": search_fields(doc.get("user_profiles"))}))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
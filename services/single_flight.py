@@ -0,0 +1,146 @@
+"""Single-flight helpers for deduplicating identical GPT work.
+
+``do`` collapses concurrent calls with the same key inside this process: the
+first caller runs the function and later callers block until it finishes and
+share its result (or exception).
+
+``acquire_lease`` / ``release_lease`` extend the same idea across processes
+with a MongoDB document per key. A lease expires on its own after
+``LEASE_SECONDS`` so a crashed worker never blocks a day forever; a live holder
+keeps it with ``lease_heartbeat`` for as long as the generation runs (up to
+``LEASE_MAX_HOLD_SECONDS``), so slow retries never let a second worker in.
+"""
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, TypeVar
+
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+
+import config
+from .indexes import create_group_indexes
+
+T = TypeVar("T")
+
+LEASE_DB_NAME = "your_database"
+LEASE_COLLECTION_NAME = "gpt_generation_leases"
+LEASE_SECONDS = 180
+# Renewed every third of LEASE_SECONDS; a holder stops renewing after this long.
+LEASE_MAX_HOLD_SECONDS = 900
+# How long a worker waits on someone else's lease before giving up on the day.
+LEASE_WAIT_SECONDS = LEASE_MAX_HOLD_SECONDS + LEASE_SECONDS
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+_calls: Dict[str, _Call] = {}
+_calls_lock = threading.Lock()
+
+
+def do(key: str, fn: Callable[[], T]) -> T:
+    """Run ``fn`` once per in-flight ``key``; concurrent callers share the outcome."""
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _calls[key] = call
+
+    if not leader:
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+        return call.result
+    except BaseException as exc:
+        call.error = exc
+        raise
+    finally:
+        with _calls_lock:
+            _calls.pop(key, None)
+        call.event.set()
+
+
+@lru_cache(maxsize=1)
+def _lease_client() -> MongoClient:
+    return MongoClient(config.MONGO_URL)
+
+
+@lru_cache(maxsize=1)
+def _lease_collection():
+    collection = _lease_client()[LEASE_DB_NAME][LEASE_COLLECTION_NAME]
+    create_group_indexes(collection, "leases")
+    return collection
+
+
+def lease_key(line_id: str, target_date: str) -> str:
+    return f"{line_id}:{target_date}"
+
+
+def acquire_lease(key: str, seconds: int = LEASE_SECONDS) -> str | None:
+    """Take the lease for ``key``; returns an owner token, or ``None`` if another worker holds it."""
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    try:
+        _lease_collection().update_one(
+            {"_id": key, "expires_at": {"$lte": now}},
+            {"$set": {"owner": token, "acquired_at": now, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # A live lease exists, so the filter did not match and the upsert collided.
+        return None
+    return token
+
+
+def release_lease(key: str, token: str) -> None:
+    _lease_collection().delete_one({"_id": key, "owner": token})
+
+
+def renew_lease(key: str, token: str, seconds: int = LEASE_SECONDS) -> bool:
+    """Push the expiry of a lease we still own; False when it was lost."""
+    result = _lease_collection().update_one(
+        {"_id": key, "owner": token},
+        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=seconds)}},
+    )
+    return result.matched_count > 0
+
+
+@contextmanager
+def lease_heartbeat(key: str, token: str) -> Iterator[None]:
+    """Renew the lease from a daemon thread while the block runs."""
+    stop = threading.Event()
+
+    def _beat() -> None:
+        started = time.monotonic()
+        while not stop.wait(LEASE_SECONDS / 3):
+            if time.monotonic() - started > LEASE_MAX_HOLD_SECONDS:
+                return
+            try:
+                if not renew_lease(key, token):
+                    return
+            except Exception:  # noqa: BLE001 - a missed beat is retried on the next one
+                continue
+
+    thread = threading.Thread(target=_beat, name=f"lease-{key}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
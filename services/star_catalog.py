@@ -0,0 +1,159 @@
+"""In-memory star catalog and compact storage for ``period_predictions``.
+
+``Api5StarPredict`` returns, per day, ``{star: {star, start_thai, detail_short,
+detail_long}}`` with the texts copied from ``StarDetail.csv``. Stored that way
+every user document repeats the same five texts hundreds of times. The compact
+forms keep only which stars apply:
+
+- ``ids``: a sorted list of star ids, e.g. ``[0, 3]``.
+- ``bitmask``: an int with bit ``id`` set for each star, e.g. ``9``.
+
+Readers call ``expand_prediction`` which accepts all three forms, so documents
+can be migrated gradually.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import bson
+import pandas as pd
+from pymongo import UpdateOne
+
+import config
+from . import jobs
+
+STAR_DETAIL_PATH = Path(__file__).resolve().parent.parent / "StarDetail.csv"
+# Star ids are positions in this list; never reorder it, only append.
+STAR_ORDER = ["Nobleman", "Peach blossom", "Heavenly virtue", "Fortune virtue", "Clash"]
+STAR_IDS = {name: idx for idx, name in enumerate(STAR_ORDER)}
+STORAGE_MODES = ("full", "ids", "bitmask")
+PREDICTION_STORAGE_JOB_KEY = "migrate:prediction_storage"
+
+
+@lru_cache(maxsize=1)
+def load_star_catalog() -> Dict[str, Dict[str, Any]]:
+    """Star name -> detail record from ``StarDetail.csv`` (first row per star)."""
+    frame = pd.read_csv(STAR_DETAIL_PATH).fillna("")
+    catalog: Dict[str, Dict[str, Any]] = {}
+    for record in frame.to_dict(orient="records"):
+        catalog.setdefault(record["star"], record)
+    return catalog
+
+
+def encode_prediction(day: Any, mode: str | None = None) -> Any:
+    """Convert one day's prediction to the storage ``mode`` (default ``PREDICTION_STORAGE``)."""
+    mode = mode or config.PREDICTION_STORAGE
+    if mode == "full":
+        return expand_prediction(day)
+    names = prediction_star_names(day)
+    ids = sorted(STAR_IDS[name] for name in names if name in STAR_IDS)
+    if mode == "ids":
+        return ids
+    if mode == "bitmask":
+        mask = 0
+        for star_id in ids:
+            mask |= 1 << star_id
+        return mask
+    raise ValueError(f"Unknown prediction storage mode: {mode}")
+
+
+def prediction_star_names(day: Any) -> List[str]:
+    if isinstance(day, dict):
+        return list(day.keys())
+    if isinstance(day, bool):
+        return []
+    if isinstance(day, int):
+        return [name for idx, name in enumerate(STAR_ORDER) if day & (1 << idx)]
+    if isinstance(day, list):
+        return [STAR_ORDER[idx] for idx in day if isinstance(idx, int) and 0 <= idx < len(STAR_ORDER)]
+    return []
+
+
+def expand_prediction(day: Any) -> Dict[str, Dict[str, Any]]:
+    """Return the full ``{star: detail}`` form for any stored representation."""
+    if isinstance(day, dict):
+        return day
+    catalog = load_star_catalog()
+    return {name: dict(catalog.get(name) or {"star": name}) for name in prediction_star_names(day)}
+
+
+def expand_predictions(predictions: Dict[str, Any] | None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    return {date: expand_prediction(day) for date, day in (predictions or {}).items()}
+
+
+def _field_bytes(predictions: Dict[str, Any]) -> int:
+    return len(bson.encode({"period_predictions": predictions}))
+
+
+def migrate_prediction_storage(
+    collection,
+    *,
+    mode: str | None = None,
+    batch_size: int = 200,
+    dry_run: bool = False,
+    limit: int | None = None,
+    on_batch: Callable[[int], None] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Rewrite ``period_predictions`` of every user into ``mode`` and report bytes saved.
+
+    Returns one entry per user that changed: ``{line_id, days, bytes_before,
+    bytes_after, bytes_saved}``. With ``dry_run`` nothing is written.
+    """
+    mode = mode or config.PREDICTION_STORAGE
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown prediction storage mode: {mode}")
+
+    report: List[Dict[str, Any]] = []
+    operations: List[UpdateOne] = []
+    cursor = collection.find(
+        {"period_predictions": {"$type": "object"}},
+        {"line_id": 1, "period_predictions": 1},
+        batch_size=batch_size,
+    ).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(int(limit))
+
+    for doc in cursor:
+        before = doc.get("period_predictions") or {}
+        after = {date: encode_prediction(day, mode) for date, day in before.items()}
+        if after == before:
+            continue
+        bytes_before = _field_bytes(before)
+        bytes_after = _field_bytes(after)
+        report.append(
+            {
+                "line_id": doc.get("line_id"),
+                "days": len(before),
+                "bytes_before": bytes_before,
+                "bytes_after": bytes_after,
+                "bytes_saved": bytes_before - bytes_after,
+            }
+        )
+        if dry_run:
+            continue
+        # Per-day $set so days added by a concurrent calendar build are left alone.
+        operations.append(
+            UpdateOne({"_id": doc["_id"]}, {"$set": {f"period_predictions.{date}": day for date, day in after.items()}})
+        )
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+            if on_batch is not None:
+                on_batch(len(report))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    if on_batch is not None:
+        on_batch(len(report))
+    return report
+
+
+def submit_prediction_storage_job(collection, *, mode: str | None = None) -> str:
+    """Run ``migrate_prediction_storage`` over all users as a background job; returns the job id."""
+
+    def _job(progress):
+        return migrate_prediction_storage(collection, mode=mode, on_batch=lambda done: progress(users=done))
+
+    return jobs.submit(PREDICTION_STORAGE_JOB_KEY, _job, kind="migration", mode=mode)
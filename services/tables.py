@@ -0,0 +1,154 @@
+"""Arrow tables for the search results and calendar views.
+
+Both views used to build a dict per row and hand the list to pandas. Here the
+projected documents are split into columns once and the derived columns
+(token balance, user type, GPT summary) are computed with ``pyarrow.compute``.
+``st.dataframe`` renders the tables directly, and the same tables feed the
+CSV/Parquet downloads.
+"""
+from __future__ import annotations
+
+import io
+from typing import Any, Dict, Iterable, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from .history import first_sub_type
+from .star_catalog import expand_prediction
+
+SEARCH_ROW_SCHEMA = pa.schema(
+    [
+        ("doc_id", pa.string()),
+        ("name", pa.string()),
+        ("line_id", pa.string()),
+        ("tokens", pa.int64()),
+        ("user_type", pa.string()),
+        ("sort_name", pa.string()),
+    ]
+)
+_SEARCH_TEXT_FIELDS = pa.struct([("user_profiles", pa.string()), ("line_id", pa.string()), ("search_name", pa.string())])
+SEARCH_DISPLAY_COLUMNS = {"name": "LINE Name", "line_id": "LINE ID", "tokens": "Tokens", "user_type": "User Type"}
+_NUMBER = r"^\s*[-+]?\d+(\.\d*)?\s*$"
+
+
+def _text(value: Any) -> str:
+    return "" if value is None else str(value)
+
+
+def parse_tokens(values: pa.Array) -> pa.Array:
+    """Column-wise ``as_int``: numeric strings truncate to int64, anything else becomes 0."""
+    text = pc.cast(values, pa.string())
+    numeric = pc.if_else(pc.fill_null(pc.match_substring_regex(text, _NUMBER), False), text, pa.scalar(None, pa.string()))
+    return pc.fill_null(pc.cast(pc.trunc(pc.cast(numeric, pa.float64())), pa.int64()), 0)
+
+
+def user_types(sub_types: pa.Array) -> pa.Array:
+    standard = pc.equal(pc.utf8_lower(pc.utf8_trim_whitespace(pc.fill_null(sub_types, ""))), "standard")
+    return pc.if_else(standard, "mu insight", "basic")
+
+
+def _string_fields(docs: List[Dict[str, Any]]) -> pa.StructArray:
+    """``_SEARCH_TEXT_FIELDS`` of every document, converted by Arrow in one call."""
+    try:
+        return pa.array(docs, _SEARCH_TEXT_FIELDS)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # A legacy non-string value somewhere on the page: coerce document by document.
+        names = _SEARCH_TEXT_FIELDS.names
+        return pa.array(
+            [{name: None if doc.get(name) is None else str(doc[name]) for name in names} for doc in docs],
+            _SEARCH_TEXT_FIELDS,
+        )
+
+
+def search_rows_table(docs: Iterable[Dict[str, Any]]) -> pa.Table:
+    """Projected user documents -> one row per user in ``SEARCH_ROW_SCHEMA``."""
+    docs = list(docs)
+    text = _string_fields(docs)
+    # ObjectIds, mixed int/str balances and the history fallback still need Python.
+    raw_tokens = pa.array([_text(doc.get("user_question_left", 0)) for doc in docs], pa.string())
+    sub_types = pa.array([first_sub_type(doc) for doc in docs], pa.string())
+    return pa.Table.from_arrays(
+        [
+            pa.array([str(doc.get("_id")) for doc in docs], pa.string()),
+            pc.fill_null(text.field("user_profiles"), ""),
+            pc.fill_null(text.field("line_id"), ""),
+            parse_tokens(raw_tokens),
+            user_types(sub_types),
+            text.field("search_name"),
+        ],
+        schema=SEARCH_ROW_SCHEMA,
+    )
+
+
+def patch_search_rows(table: pa.Table, row: Dict[str, Any]) -> pa.Table:
+    """``table`` with the row whose ``doc_id`` matches ``row["doc_id"]`` replaced by ``row``."""
+    mask = pc.equal(table["doc_id"], row["doc_id"])
+    if not pc.any(mask).as_py():
+        return table
+    return pa.Table.from_arrays(
+        [pc.if_else(mask, pa.scalar(row[field.name], field.type), table[field.name]) for field in table.schema],
+        schema=table.schema,
+    )
+
+
+def drop_search_rows(table: pa.Table, doc_id: str) -> pa.Table:
+    return table.filter(pc.not_equal(table["doc_id"], doc_id))
+
+
+def search_display_table(rows: pa.Table) -> pa.Table:
+    """The visible columns of the search page, renamed for display."""
+    return rows.select(list(SEARCH_DISPLAY_COLUMNS)).rename_columns(list(SEARCH_DISPLAY_COLUMNS.values()))
+
+
+def _gpt_summary(day_names: pa.Array, themes: pa.Array) -> pa.Array:
+    """``"day (theme)"``, or whichever part is present."""
+    day_names = pc.fill_null(day_names, "")
+    themes = pc.fill_null(themes, "")
+    both = pc.binary_join_element_wise(day_names, " (", themes, ")", "")
+    return pc.if_else(
+        pc.equal(themes, ""),
+        day_names,
+        pc.if_else(pc.equal(day_names, ""), themes, both),
+    )
+
+
+def calendar_table(
+    predictions_std: Dict[str, Any],
+    predictions_gpt: Dict[str, Any],
+    archived_dates: Iterable[str] = (),
+) -> pa.Table:
+    """One row per date in either map: Date, Standard, GPT Summary, Archived."""
+    dates = sorted(set(predictions_std) | set(predictions_gpt))
+    archived = set(archived_dates)
+    standard = [
+        ", ".join(_text(star.get("start_thai", "")) for star in expand_prediction(predictions_std.get(date, {})).values())
+        for date in dates
+    ]
+    gpt_days = [predictions_gpt.get(date) or {} for date in dates]
+    summary = _gpt_summary(
+        pa.array([_text(day.get("day_name", "")) for day in gpt_days], pa.string()),
+        pa.array([_text(day.get("theme", "")) for day in gpt_days], pa.string()),
+    )
+    return pa.table(
+        {
+            "Date": pa.array(dates, pa.string()),
+            "Standard": pa.array(standard, pa.string()),
+            "GPT Summary": summary,
+            "Archived": pa.array([date in archived for date in dates], pa.bool_()),
+        }
+    )
+
+
+def table_to_csv(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    pa_csv.write_csv(table, sink)
+    return sink.getvalue()
+
+
+def table_to_parquet(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
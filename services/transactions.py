@@ -6,7 +6,7 @@ import streamlit as st
 from datetime import datetime
 
 
-def record_transaction(
+def build_transaction_doc(
     *,
     user: Dict[str, Any],
     package: Dict[str, Any],
@@ -14,13 +14,9 @@ def record_transaction(
     timestamp_iso: str,
     sub_type: str,
     payment_type: str,
-) -> None:
-    collection = st.session_state.get("collection_transactions")
-    if collection is None:
-        return
-
+) -> Dict[str, Any]:
     line_id = user.get("line_id")
-    doc = {
+    return {
         "userId": line_id,
         "line_id": line_id,
         "packageId": package.get("id"),
@@ -35,4 +31,28 @@ def record_transaction(
         "referenceId": reference_id,
         "created_at": datetime.utcnow().isoformat() + "Z",
     }
-    collection.insert_one(doc)
+
+
+def record_transaction(
+    *,
+    user: Dict[str, Any],
+    package: Dict[str, Any],
+    reference_id: str,
+    timestamp_iso: str,
+    sub_type: str,
+    payment_type: str,
+) -> None:
+    collection = st.session_state.get("collection_transactions")
+    if collection is None:
+        return
+
+    collection.insert_one(
+        build_transaction_doc(
+            user=user,
+            package=package,
+            reference_id=reference_id,
+            timestamp_iso=timestamp_iso,
+            sub_type=sub_type,
+            payment_type=payment_type,
+        )
+    )
@@ -1,17 +1,35 @@
 from __future__ import annotations
 
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Any, Callable, Dict
 
 import pytz
-from dateutil.relativedelta import relativedelta
+from pymongo import ReturnDocument
 import streamlit as st
 from dateutil.relativedelta import relativedelta
 
+import config
+from .calendar import (
+    PREDICTION_DATES_FIELD,
+    calendar_update_doc,
+    compute_calendar_updates,
+    prediction_dates_stage,
+    split_calendar_update,
+    submit_calendar_job,
+    trigger_gpt_calendar,
+    with_bucket_prediction_dates,
+)
+from . import calendar_store
+from .history import history_update, merge_update, record_events
 from .packages import get_package
+from .transactions import build_transaction_doc
 
 THAI_TZ = pytz.timezone("Asia/Bangkok")
 
+# Fields the upgrade never needs to read; predictions are summarised as a date list instead.
+UPGRADE_READ_EXCLUDED = ["period_predictions", "period_predictions_gpt", "calendar_basic", "detail", "history_log"]
+
 
 def _add_duration(base_date: datetime.date, months: int, days: int):
     result = base_date
@@ -22,19 +40,17 @@ def _add_duration(base_date: datetime.date, months: int, days: int):
     return result
 
 
-def apply_package_upgrade(
+def plan_upgrade(
     user: Dict[str, Any],
-    package_key: str,
+    package: Dict[str, Any],
     *,
+    now: datetime,
     reference_id: str,
     timestamp_iso: str,
     sub_type: str,
     payment_type: str,
 ) -> Dict[str, Any]:
-    package = get_package(package_key)
-
-    collection = st.session_state.collection
-    now = datetime.now(THAI_TZ)
+    """Work out the new period, token balance and history entry for ``package``."""
     today = now.date()
 
     existing_period = user.get("period_available") or {}
@@ -69,49 +85,308 @@ def apply_package_upgrade(
 
     start_dt = min(start_dt, end_dt)
 
-    user_question_left = int(user.get("user_question_left") or 0)
+    user_question_left = user_balance(user)
     extra_tokens = int(package.get("tokens", 0) or 0)
     new_token_balance = user_question_left + extra_tokens
 
-    collection.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "period_available": {
-                    "start_date": start_dt.strftime("%Y-%m-%d"),
-                    "end_date": end_dt.strftime("%Y-%m-%d"),
-                    "updated_at": now,
-                },
-                "user_question_left": new_token_balance,
-            },
-            "$push": {
-                "history_log": {
-                    "event": "buy_package",
-                    "start_date": start_dt.strftime("%Y-%m-%d"),
-                    "end_date": end_dt.strftime("%Y-%m-%d"),
-                    "num_months": months,
-                    "duration_days": days,
-                    "packageId": package.get("id"),
-                    "subType": sub_type,
-                    "paymentType": payment_type,
-                    "timestamp": timestamp_iso,
-                    "referenceId": reference_id,
-                }
-            },
-        },
-    )
-
     if last_end_dt and last_end_dt >= today:
         calendar_start_dt = min(last_end_dt + timedelta(days=1), end_dt)
     else:
         calendar_start_dt = start_dt
 
     return {
-        "start_date": start_dt.strftime("%Y-%m-%d"),
-        "end_date": end_dt.strftime("%Y-%m-%d"),
-        "extra_tokens": extra_tokens,
-        "new_token_balance": new_token_balance,
-        "calendar_start_date": calendar_start_dt.strftime("%Y-%m-%d"),
-        "package_id": package.get("id"),
-        "reference_id": reference_id,
+        "period_available": {
+            "start_date": start_dt.strftime("%Y-%m-%d"),
+            "end_date": end_dt.strftime("%Y-%m-%d"),
+            "updated_at": now,
+        },
+        "history_entry": {
+            "event": "buy_package",
+            "start_date": start_dt.strftime("%Y-%m-%d"),
+            "end_date": end_dt.strftime("%Y-%m-%d"),
+            "num_months": months,
+            "duration_days": days,
+            "packageId": package.get("id"),
+            "subType": sub_type,
+            "paymentType": payment_type,
+            "timestamp": timestamp_iso,
+            "referenceId": reference_id,
+        },
+        "result": {
+            "start_date": start_dt.strftime("%Y-%m-%d"),
+            "end_date": end_dt.strftime("%Y-%m-%d"),
+            "extra_tokens": extra_tokens,
+            "new_token_balance": new_token_balance,
+            "calendar_start_date": calendar_start_dt.strftime("%Y-%m-%d"),
+            "package_id": package.get("id"),
+            "reference_id": reference_id,
+        },
+    }
+
+
+def user_balance(user: Dict[str, Any]) -> int:
+    try:
+        return int(float(user.get("user_question_left") or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def token_update(user: Dict[str, Any], extra_tokens: int) -> Dict[str, Dict[str, Any]]:
+    """
+    Update operators adding ``extra_tokens`` to the balance.
+
+    Numeric balances use ``$inc`` so concurrent adjustments (spends, bulk token
+    runs) are not lost. Legacy string balances cannot be ``$inc``-ed, by this or
+    any concurrent writer, so they are normalised with ``$set`` instead.
+    """
+    balance = user.get("user_question_left")
+    if balance is None or (isinstance(balance, (int, float)) and not isinstance(balance, bool)):
+        return {"$inc": {"user_question_left": int(extra_tokens)}}
+    return {"$set": {"user_question_left": user_balance(user) + int(extra_tokens)}}
+
+
+def _reported_balance(result: Dict[str, Any], updated_user: Dict[str, Any] | None) -> Dict[str, Any]:
+    """``result`` with ``new_token_balance`` taken from the post-update document when it has it."""
+    if updated_user and "user_question_left" in updated_user:
+        return {**result, "new_token_balance": updated_user["user_question_left"]}
+    return result
+
+
+def apply_package_upgrade(
+    user: Dict[str, Any],
+    package_key: str,
+    *,
+    reference_id: str,
+    timestamp_iso: str,
+    sub_type: str,
+    payment_type: str,
+    projection: Dict[str, Any] | None = None,
+) -> Dict[str, Any]:
+    """
+    Extend the user's mu insight period, add the package tokens and log the purchase.
+
+    The returned dict carries the post-update user document under ``"user"``,
+    limited to ``projection`` when given.
+    """
+    package = get_package(package_key)
+    collection = st.session_state.collection
+    plan = plan_upgrade(
+        user,
+        package,
+        now=datetime.now(THAI_TZ),
+        reference_id=reference_id,
+        timestamp_iso=timestamp_iso,
+        sub_type=sub_type,
+        payment_type=payment_type,
+    )
+
+    updated_user = collection.find_one_and_update(
+        {"_id": user["_id"]},
+        merge_update(
+            merge_update(
+                {"$set": {"period_available": plan["period_available"]}},
+                token_update(user, plan["result"]["extra_tokens"]),
+            ),
+            history_update(plan["history_entry"], user=user),
+        ),
+        projection=projection,
+        return_document=ReturnDocument.AFTER,
+    )
+    record_events(st.session_state.get("collection_user_events"), [(user, plan["history_entry"])])
+
+    return {**_reported_balance(plan["result"], updated_user), "user": updated_user}
+
+
+def run_upgrade_pipeline(
+    user_id: Any,
+    package_key: str,
+    *,
+    reference_id: str,
+    timestamp_iso: str,
+    sub_type: str,
+    payment_type: str,
+    projection: Dict[str, Any] | None = None,
+    collection=None,
+    transactions_collection=None,
+    events_collection=None,
+    client=None,
+    use_transactions: bool | None = None,
+    defer_calendar: bool | None = None,
+    on_step: Callable[[str, float], None] | None = None,
+) -> Dict[str, Any]:
+    """
+    Upgrade a user with one read and one write.
+
+    1. read: the user without heavy maps, plus the list of already predicted dates.
+    2. calendar: star predictions for missing days and basic calendar entries (no writes).
+    3. write: period, tokens, history, predictions and calendar_basic in a single
+       ``find_one_and_update``; with transactions enabled the transaction record and
+       history event are inserted in the same multi-document transaction.
+    4. gpt: trigger GPT generation for the new period.
+
+    With ``defer_calendar`` (default ``UPGRADE_BACKGROUND_CALENDAR``) steps 2 and 4
+    are skipped and ``ensure_calendar_entries`` is submitted as a background job
+    after the write; its id is returned as ``calendar_job_id``.
+
+    ``on_step(name, elapsed_ms)`` is called after each step. The result holds the
+    ``apply_package_upgrade`` fields plus ``user`` (post-update, limited to
+    ``projection``), ``calendar_result``, ``transaction_recorded`` and ``timings``.
+    """
+    if collection is None:
+        collection = st.session_state.collection
+    if transactions_collection is None:
+        transactions_collection = st.session_state.get("collection_transactions")
+    if events_collection is None:
+        events_collection = st.session_state.get("collection_user_events")
+    if client is None:
+        client = st.session_state.get("mongo_client")
+    if use_transactions is None:
+        use_transactions = config.MONGO_USE_TRANSACTIONS
+    if defer_calendar is None:
+        defer_calendar = config.UPGRADE_BACKGROUND_CALENDAR
+
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+
+    def _mark(step: str) -> None:
+        nonlocal started
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        timings[step] = round(elapsed_ms, 1)
+        if on_step is not None:
+            on_step(step, elapsed_ms)
+        started = time.perf_counter()
+
+    package = get_package(package_key)
+    rows = list(
+        collection.aggregate(
+            [
+                {"$match": {"_id": user_id}},
+                prediction_dates_stage(),
+                {"$unset": UPGRADE_READ_EXCLUDED},
+            ]
+        )
+    )
+    if not rows:
+        raise RuntimeError("User not found.")
+    user = rows[0]
+    prediction_dates = user.pop(PREDICTION_DATES_FIELD, None)
+    if not defer_calendar:
+        prediction_dates = with_bucket_prediction_dates(
+            user.get("line_id"), prediction_dates, database=collection.database
+        )
+    plan = plan_upgrade(
+        user,
+        package,
+        now=datetime.now(THAI_TZ),
+        reference_id=reference_id,
+        timestamp_iso=timestamp_iso,
+        sub_type=sub_type,
+        payment_type=payment_type,
+    )
+    result = plan["result"]
+    _mark("read")
+
+    if defer_calendar:
+        calendar_plan = {"valid_range": True, "set": {}, "min": {}, "max": {}, "errors": []}
+    else:
+        calendar_plan = compute_calendar_updates(
+            user,
+            result["calendar_start_date"],
+            result["end_date"],
+            prediction_dates,
+        )
+        _mark("calendar")
+    if not user.get("line_id"):
+        calendar_plan["errors"].insert(0, "Missing line_id on user record.")
+
+    update, bucket_sets = split_calendar_update(calendar_update_doc(calendar_plan))
+    update["$set"] = {**update.get("$set", {}), "period_available": plan["period_available"]}
+    update = merge_update(update, token_update(user, result["extra_tokens"]))
+    update = merge_update(update, history_update(plan["history_entry"], user=user))
+    transaction_doc = build_transaction_doc(
+        user=user,
+        package=package,
+        reference_id=reference_id,
+        timestamp_iso=timestamp_iso,
+        sub_type=sub_type,
+        payment_type=payment_type,
+    )
+
+    def _write(session=None):
+        calendar_store.write_day_updates(
+            user.get("line_id"), bucket_sets, database=collection.database, session=session
+        )
+        updated = collection.find_one_and_update(
+            {"_id": user_id},
+            update,
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if session is not None:
+            if transactions_collection is not None:
+                transactions_collection.insert_one(transaction_doc, session=session)
+            record_events(events_collection, [(user, plan["history_entry"])], session=session)
+        return updated
+
+    transaction_recorded = False
+    if use_transactions and client is not None:
+        with client.start_session() as session:
+            updated_user = session.with_transaction(_write)
+        transaction_recorded = transactions_collection is not None
+    else:
+        updated_user = _write()
+    _mark("write")
+
+    if not transaction_recorded and transactions_collection is not None:
+        try:
+            transactions_collection.insert_one(transaction_doc)
+            transaction_recorded = True
+        except Exception as exc:  # noqa: BLE001
+            calendar_plan["errors"].append(f"Failed to record transaction: {exc}")
+        _mark("transaction")
+    if not (use_transactions and client is not None):
+        try:
+            record_events(events_collection, [(user, plan["history_entry"])])
+        except Exception as exc:  # noqa: BLE001
+            calendar_plan["errors"].append(f"Failed to record history event: {exc}")
+
+    calendar_ok = calendar_plan["valid_range"] and bool(user.get("line_id"))
+    summary = {
+        **_reported_balance(result, updated_user),
+        "user": updated_user,
+        "calendar_ok": calendar_ok,
+        "transaction_recorded": transaction_recorded,
+        "timings": timings,
+    }
+
+    if defer_calendar:
+        calendar_result: Dict[str, Any] = {}
+        if calendar_ok:
+            summary["calendar_job_id"] = submit_calendar_job(
+                user, result["calendar_start_date"], result["end_date"], collection=collection
+            )
+        if calendar_plan["errors"]:
+            calendar_result["errors"] = calendar_plan["errors"]
+        summary["calendar_result"] = calendar_result
+        return summary
+
+    if calendar_ok:
+        gpt = trigger_gpt_calendar(user)
+    else:
+        gpt = {"gpt_triggered": False, "gpt_details": None, "errors": []}
+    _mark("gpt")
+
+    calendar_result = {
+        "updated_days": calendar_plan["updated_days"],
+        "gpt_triggered": gpt["gpt_triggered"],
+        "basic_profile_days": calendar_plan["basic_profile_days"],
+        "basic_holiday_days": calendar_plan["basic_holiday_days"],
     }
+    if gpt["gpt_details"] is not None:
+        calendar_result["gpt_details"] = gpt["gpt_details"]
+    errors = calendar_plan["errors"] + gpt["errors"]
+    if errors:
+        calendar_result["errors"] = errors
+    summary["calendar_result"] = calendar_result
+    return summary
@@ -0,0 +1,101 @@
+"""Bulk token grant / adjustment."""
+from __future__ import annotations
+
+from datetime import date
+from typing import List, Tuple
+
+import streamlit as st
+
+from services.bulk_tokens import apply_token_delta, build_token_filter, count_token_targets
+from services.search import LINE_ID_PATTERN
+from um_utils import mark_user_write
+
+TARGET_LINE_IDS = "List of LINE IDs"
+TARGET_FILTER = "Filter"
+
+
+def _parse_line_ids(text: str) -> Tuple[List[str], List[str]]:
+    valid: List[str] = []
+    invalid: List[str] = []
+    for token in text.replace(",", "\n").split():
+        (valid if LINE_ID_PATTERN.match(token) else invalid).append(token)
+    return valid, invalid
+
+
+def render_bulk_tokens_tab() -> None:
+    st.subheader("Bulk token adjustment")
+    st.caption("Adds (or removes) tokens server-side for every selected user and writes an audit entry per user.")
+
+    target_mode = st.radio("Select users by", [TARGET_LINE_IDS, TARGET_FILTER], horizontal=True)
+    if target_mode == TARGET_LINE_IDS:
+        text = st.text_area("LINE IDs (one per line or comma separated)", height=150)
+        line_ids, invalid = _parse_line_ids(text)
+        if invalid:
+            st.warning(f"Ignoring {len(invalid)} invalid LINE ID(s): {', '.join(invalid[:5])}")
+        if not line_ids:
+            st.info("Enter at least one LINE ID.")
+            return
+        query = build_token_filter(line_ids=line_ids)
+    else:
+        active_only = st.checkbox("Only users with an active mu insight period on", value=False)
+        active_on = st.date_input("Active on", value=date.today(), disabled=not active_only)
+        min_col, max_col = st.columns(2)
+        min_tokens = min_col.number_input("Minimum tokens (optional)", value=None, step=1)
+        max_tokens = max_col.number_input("Maximum tokens (optional)", value=None, step=1)
+        query = build_token_filter(
+            active_on=active_on.strftime("%Y-%m-%d") if active_only else None,
+            min_tokens=min_tokens,
+            max_tokens=max_tokens,
+        )
+        if not query:
+            st.warning("No filter set: the adjustment would apply to every user.")
+
+    delta = st.number_input("Token delta (negative to remove)", value=1, step=1)
+    floor_at_zero = st.checkbox("Skip users whose balance would go below zero", value=True)
+    reason = st.text_input("Reason (stored in the audit log)", placeholder="e.g. compensation for outage")
+
+    dry_col, apply_col = st.columns(2)
+    if dry_col.button("Dry run", use_container_width=True):
+        try:
+            counts = count_token_targets(
+                st.session_state.collection, query, delta=int(delta), floor_at_zero=floor_at_zero
+            )
+            st.info(
+                f"{counts['matched']} user(s) match; {counts['eligible']} would be adjusted by {int(delta):+d}"
+                + (f", {counts['skipped']} skipped by the zero floor." if counts["skipped"] else ".")
+                + " Nothing was written."
+            )
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Dry run failed: {exc}")
+
+    confirm = st.checkbox("I have checked the dry run and want to apply this adjustment")
+    if apply_col.button(
+        "Apply adjustment",
+        type="primary",
+        use_container_width=True,
+        disabled=not (confirm and reason.strip() and int(delta)),
+    ):
+        mark_user_write()
+        with st.status("Adjusting tokens...", expanded=False) as status_box:
+            try:
+                summary = apply_token_delta(
+                    st.session_state.collection,
+                    st.session_state.get("collection_token_audit"),
+                    query,
+                    int(delta),
+                    reason=reason.strip(),
+                    floor_at_zero=floor_at_zero,
+                    on_batch=lambda updated: status_box.update(label=f"Adjusted {updated} user(s)..."),
+                )
+            except Exception as exc:  # noqa: BLE001
+                status_box.update(label="Adjustment failed.", state="error")
+                st.error(f"Unable to adjust tokens: {exc}")
+                return
+            state = "error" if summary["errors"] else "complete"
+            status_box.update(label=f"Adjusted {summary['updated']} user(s).", state=state)
+        st.write(
+            f"Operation `{summary['operation_id']}`: {summary['updated']} updated, {summary['skipped']} skipped"
+            + (f", {summary['normalized']} text balance(s) converted to numbers." if summary["normalized"] else ".")
+        )
+        for err in summary["errors"]:
+            st.error(err)
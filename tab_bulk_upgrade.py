@@ -0,0 +1,135 @@
+"""Bulk package upgrade from a CSV upload."""
+from __future__ import annotations
+
+from typing import Any, Dict, List
+
+import pandas as pd
+import streamlit as st
+
+from services import jobs
+from services.bulk_upgrade import count_known_users, parse_upgrade_csv, run_bulk_upgrade
+from services.packages import list_packages
+from um_utils import gen_reference_id, mark_user_write, now_iso_ms_z
+
+JOB_POLL_SECONDS = 3
+REPORT_KEY = "bulk_upgrade_report"
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def _calendar_jobs_progress(report: List[Dict[str, Any]]) -> None:
+    job_ids = sorted({entry["calendar_job_id"] for entry in report if entry.get("calendar_job_id")})
+    if not job_ids:
+        return
+
+    counts: Dict[str, int] = {}
+    rows = []
+    for job_id in job_ids:
+        job = jobs.get_job(job_id)
+        status = job["status"] if job else "expired"
+        counts[status] = counts.get(status, 0) + 1
+        progress = (job or {}).get("progress") or {}
+        meta = (job or {}).get("meta") or {}
+        rows.append(
+            {
+                "LINE ID": meta.get("line_id", ""),
+                "Status": status,
+                "Days": f"{progress.get('days_done', 0)}/{progress.get('days_total', '?')}",
+                "Errors": progress.get("errors", 0),
+                "Message": (job or {}).get("error") or "",
+            }
+        )
+
+    finished = len(job_ids) - counts.get("queued", 0) - counts.get("running", 0)
+    st.progress(finished / len(job_ids), text=f"Calendar jobs: {finished}/{len(job_ids)} finished")
+    st.caption(" | ".join(f"{status} {count}" for status, count in sorted(counts.items())))
+    st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+
+def render_bulk_upgrade_tab() -> None:
+    st.subheader("Bulk package upgrade")
+    st.caption(
+        "Upload a CSV with `line_id` and `package_id` columns. Package ids: "
+        + ", ".join(f"`{pkg['id']}` {pkg['title']}" for pkg in list_packages())
+    )
+
+    uploaded = st.file_uploader("Upgrade list (CSV)", type=["csv"], key="bulk_upgrade_file")
+    if uploaded is None:
+        _render_report()
+        return
+
+    try:
+        rows, errors = parse_upgrade_csv(uploaded)
+    except Exception as exc:  # noqa: BLE001
+        st.error(f"Unable to read the CSV: {exc}")
+        return
+
+    if errors:
+        with st.expander(f"{len(errors)} row(s) rejected", expanded=not rows):
+            for err in errors:
+                st.write(f"- {err}")
+    if not rows:
+        st.warning("No valid rows to upgrade.")
+        return
+
+    st.write(f"{len(rows)} valid row(s) for {len({row['line_id'] for row in rows})} distinct user(s).")
+    st.dataframe(pd.DataFrame(rows).head(50), hide_index=True, use_container_width=True)
+
+    batch_size = st.number_input("Batch size", min_value=10, max_value=1000, value=200, step=10)
+    queue_calendar = st.checkbox("Queue calendar, star and GPT work in the background", value=True)
+
+    check_col, apply_col = st.columns(2)
+    if check_col.button("Dry run", use_container_width=True):
+        try:
+            known = count_known_users(st.session_state.collection, rows)
+            st.info(f"{known} of {len({row['line_id'] for row in rows})} line_id(s) exist. Nothing was written.")
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Dry run failed: {exc}")
+
+    if apply_col.button("Apply upgrades", type="primary", use_container_width=True):
+        progress_bar = st.progress(0.0, text="Upgrading...")
+
+        def _on_batch(done: int, total: int) -> None:
+            progress_bar.progress(done / total, text=f"Upgraded {done}/{total} row(s)")
+
+        mark_user_write()
+        try:
+            report = run_bulk_upgrade(
+                rows,
+                collection=st.session_state.collection,
+                transactions_collection=st.session_state.get("collection_transactions"),
+                events_collection=st.session_state.get("collection_user_events"),
+                timestamp_iso=now_iso_ms_z(),
+                reference_factory=gen_reference_id,
+                batch_size=int(batch_size),
+                queue_calendar=queue_calendar,
+                on_batch=_on_batch,
+            )
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Bulk upgrade stopped: {exc}")
+            return
+        st.session_state[REPORT_KEY] = report
+        st.toast("Bulk upgrade finished")
+
+    _render_report()
+
+
+def _render_report() -> None:
+    report = st.session_state.get(REPORT_KEY)
+    if not report:
+        return
+
+    st.markdown("#### Result report")
+    frame = pd.DataFrame(report)
+    summary = frame["status"].value_counts().to_dict()
+    st.write(" | ".join(f"**{status}** {count}" for status, count in summary.items()))
+    st.dataframe(frame, hide_index=True, use_container_width=True)
+    st.download_button(
+        "Download report (CSV)",
+        data=frame.to_csv(index=False).encode("utf-8"),
+        file_name="bulk_upgrade_report.csv",
+        mime="text/csv",
+        use_container_width=True,
+    )
+
+    st.markdown("#### Background calendar jobs")
+    _calendar_jobs_progress(report)
@@ -3,6 +3,9 @@ from __future__ import annotations
 
 import streamlit as st
 
+import config
+from um_utils import drop_search_row, get_autocomplete_index
+
 
 def render_delete_user_tab(user):
     st.subheader("Danger zone: delete user")
@@ -31,9 +34,11 @@ def render_delete_user_tab(user):
             if result.deleted_count != 1:
                 raise RuntimeError("User document was not removed. Please try again.")
             st.session_state.found_user = None
-            st.session_state.user_questions = []
+            st.session_state.user_facets = {}
             st.session_state.selected_id = None
-            st.session_state.search_results = []
+            drop_search_row(str(user["_id"]))
+            if config.SEARCH_AUTOCOMPLETE_ENABLED:
+                get_autocomplete_index().remove(str(user["_id"]))
             status_box.update(label="User removed.", state="complete")
             st.toast("User deleted permanently.")
         except Exception as exc:  # noqa: BLE001
@@ -1,9 +1,13 @@
 """Profile editing tab."""
 from __future__ import annotations
 
+from datetime import datetime, timezone
+
 import streamlit as st
 
-from um_utils import as_int, get_user_type, refresh_current_user
+import config
+from services.search import search_fields
+from um_utils import as_int, get_autocomplete_index, get_user_type, update_current_user
 
 
 def render_edit_user_tab(user):
@@ -30,11 +34,19 @@ def render_edit_user_tab(user):
 
     with st.status("Updating user…", expanded=False) as status_box:
         try:
-            st.session_state.collection.update_one(
-                {"_id": user["_id"]},
-                {"$set": {"user_profiles": new_name.strip(), "user_question_left": int(new_token)}},
+            update_current_user(
+                {
+                    "$set": {
+                        "user_profiles": new_name.strip(),
+                        "user_question_left": int(new_token),
+                        **search_fields(new_name.strip()),
+                        # Other app processes pick up renames by polling updated_at.
+                        "updated_at": datetime.now(timezone.utc),
+                    }
+                }
             )
-            refresh_current_user()
+            if config.SEARCH_AUTOCOMPLETE_ENABLED:
+                get_autocomplete_index().upsert(str(user["_id"]), new_name.strip())
             status_box.update(label="User updated.", state="complete")
             st.toast("User profile updated", icon="✅")
         except Exception as exc:  # noqa: BLE001
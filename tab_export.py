@@ -0,0 +1,107 @@
+"""Streaming CSV/Parquet export of users and transactions."""
+from __future__ import annotations
+
+import os
+
+import streamlit as st
+
+import config
+from services import jobs
+from services.export import EXPORT_DATASETS, EXPORT_FORMATS, export_job_key, submit_export_job
+
+DATASET_LABELS = {"users": "Users (core fields)", "transactions": "Transactions"}
+MIMES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def _collection(dataset: str):
+    if dataset == "users":
+        return st.session_state.get("collection")
+    return st.session_state.get("collection_transactions")
+
+
+@st.fragment(run_every=2)
+def _export_progress(dataset: str) -> None:
+    job = jobs.latest_job(export_job_key(dataset))
+    if not jobs.is_active(job):
+        if job and st.session_state.get("export_watching") == job["id"]:
+            # Finished while we were watching: rerun the page to show the download.
+            st.session_state.export_watching = None
+            st.rerun()
+        return
+    st.session_state.export_watching = job["id"]
+    progress = job.get("progress") or {}
+    rows, total = progress.get("rows", 0), progress.get("total") or 0
+    st.progress(min(rows / total, 1.0) if total else 0.0, text=f"Exported {rows} of ~{total} row(s)...")
+
+
+def _set_download_ready(dataset: str, job_id: str | None) -> None:
+    st.session_state[f"export_download_ready_{dataset}"] = job_id
+
+
+def _render_result(dataset: str) -> None:
+    job = jobs.latest_job(export_job_key(dataset))
+    if not job or jobs.is_active(job):
+        return
+    if job["status"] == "failed":
+        st.error(f"Export failed: {job['error']}")
+        return
+    result = job["result"] or {}
+    path = result.get("path")
+    if not path or not os.path.exists(path):
+        st.info("The last export file has been removed; run the export again.")
+        return
+    size_mb = result["bytes"] / (1024 * 1024)
+    st.write(f"Last export: {result['rows']} row(s), {size_mb:.1f} MB ({job['meta'].get('format', '').upper()}).")
+    if size_mb > config.EXPORT_DOWNLOAD_MAX_MB:
+        st.warning(
+            f"The file is larger than export.download_max_mb ({config.EXPORT_DOWNLOAD_MAX_MB} MB); "
+            f"copy it from the server instead: `{path}`"
+        )
+        return
+    # The file is only read into the session when asked for, and dropped again once downloaded.
+    if st.session_state.get(f"export_download_ready_{dataset}") != job["id"]:
+        st.button(
+            f"Prepare {result['file_name']} for download",
+            use_container_width=True,
+            key=f"export_prepare_{dataset}",
+            on_click=_set_download_ready,
+            args=(dataset, job["id"]),
+        )
+        return
+    fmt = job["meta"].get("format", "csv")
+    with open(path, "rb") as handle:
+        st.download_button(
+            f"Download {result['file_name']}",
+            data=handle,
+            file_name=result["file_name"],
+            mime=MIMES.get(fmt, "application/octet-stream"),
+            use_container_width=True,
+            key=f"export_download_{dataset}",
+            on_click=_set_download_ready,
+            args=(dataset, None),
+        )
+
+
+def render_export_tab() -> None:
+    st.subheader("Export")
+    st.caption(
+        f"Streams the collection in batches of {config.EXPORT_BATCH_SIZE} documents into a file on the server, "
+        "so memory use stays flat whatever the size. Users are exported with their core fields only "
+        "(no calendar maps or full history)."
+    )
+    dataset_col, format_col = st.columns(2)
+    dataset = dataset_col.selectbox(
+        "Data", options=list(EXPORT_DATASETS), format_func=DATASET_LABELS.get, key="export_dataset"
+    )
+    fmt = format_col.radio("Format", options=list(EXPORT_FORMATS), horizontal=True, key="export_format")
+
+    collection = _collection(dataset)
+    running = jobs.is_active(jobs.latest_job(export_job_key(dataset)))
+    if st.button("Start export", type="primary", use_container_width=True, disabled=running or collection is None):
+        try:
+            submit_export_job(collection, dataset, fmt)
+            st.toast("Export started.")
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Unable to start the export: {exc}")
+    _export_progress(dataset)
+    _render_result(dataset)
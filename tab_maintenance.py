@@ -0,0 +1,285 @@
+"""Maintenance workspace: storage migrations and housekeeping."""
+from __future__ import annotations
+
+from typing import Any
+
+import pandas as pd
+import streamlit as st
+
+import config
+from services import jobs, read_routing
+from services.archive import ARCHIVE_JOB_KEY, archive_cutoff, submit_archive_job
+from services.calendar import (
+    CALENDAR_BASIC_JOB_KEY,
+    migrate_calendar_basic_to_reference,
+    submit_calendar_basic_job,
+)
+from services.calendar_store import (
+    BUCKET_COLLECTION_NAME,
+    BUCKET_MIGRATION_JOB_KEY,
+    count_embedded_users,
+    submit_bucket_migration_job,
+)
+from services.history import HISTORY_BACKFILL_JOB_KEY, submit_history_backfill_job
+from services.indexes import VERIFY_JOB_KEY, explain_hot_queries, start_index_verification
+from services.star_catalog import (
+    PREDICTION_STORAGE_JOB_KEY,
+    STORAGE_MODES,
+    migrate_prediction_storage,
+    submit_prediction_storage_job,
+)
+
+
+def _render_migration_report(report) -> None:
+    if not report:
+        st.info("No user documents need rewriting.")
+        return
+    frame = pd.DataFrame(report)
+    saved = int(frame["bytes_saved"].sum())
+    st.write(f"{len(frame)} user(s), {saved:,} bytes saved ({saved / max(len(frame), 1):,.0f} per user).")
+    st.dataframe(frame.sort_values("bytes_saved", ascending=False), hide_index=True, use_container_width=True)
+
+
+@st.fragment(run_every=3)
+def _migration_job_progress(job_key: str, verb: str) -> None:
+    """Progress of a running migration job; the page reruns once it finishes to show the result."""
+    job = jobs.latest_job(job_key)
+    watching_key = f"{job_key}:watching"
+    if not jobs.is_active(job):
+        if job and st.session_state.get(watching_key) == job["id"]:
+            st.session_state[watching_key] = None
+            st.rerun()
+        return
+    st.session_state[watching_key] = job["id"]
+    st.info(f"{verb} {(job.get('progress') or {}).get('users', 0)} user(s)...")
+
+
+def _finished_job_result(job_key: str, failure: str) -> Any:
+    """Result of the latest finished job under ``job_key`` (``None`` while running, failed or never run)."""
+    job = jobs.latest_job(job_key)
+    if not job or jobs.is_active(job):
+        return None
+    if job["status"] == "failed":
+        st.error(f"{failure}: {job['error']}")
+        return None
+    return job["result"]
+
+
+def _render_prediction_storage() -> None:
+    st.markdown("#### Star prediction storage")
+    st.caption(
+        f"New days are written as **{config.PREDICTION_STORAGE}** (calendar.prediction_storage). "
+        "Compact forms keep only star ids; detail texts are joined from StarDetail.csv when read."
+    )
+    mode = st.selectbox(
+        "Target storage",
+        options=list(STORAGE_MODES),
+        index=list(STORAGE_MODES).index(config.PREDICTION_STORAGE) if config.PREDICTION_STORAGE in STORAGE_MODES else 0,
+        key="prediction_storage_target",
+    )
+    sample_col, run_col = st.columns(2)
+    if sample_col.button("Estimate on 200 users", use_container_width=True):
+        try:
+            report = migrate_prediction_storage(st.session_state.collection, mode=mode, dry_run=True, limit=200)
+            _render_migration_report(report)
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Estimate failed: {exc}")
+
+    running = jobs.is_active(jobs.latest_job(PREDICTION_STORAGE_JOB_KEY))
+    if run_col.button(f"Rewrite all users as {mode}", type="primary", use_container_width=True, disabled=running):
+        submit_prediction_storage_job(st.session_state.collection, mode=mode)
+        st.toast("Prediction storage rewrite started.")
+    _migration_job_progress(PREDICTION_STORAGE_JOB_KEY, "Rewrote")
+    report = _finished_job_result(PREDICTION_STORAGE_JOB_KEY, "Unable to migrate predictions")
+    if report is not None:
+        st.caption("Last rewrite:")
+        _render_migration_report(report)
+
+
+def _render_calendar_basic_storage() -> None:
+    st.markdown("#### Basic calendar storage")
+    st.caption(
+        f"New upgrades use **{config.CALENDAR_BASIC_STORAGE}** (calendar.basic_storage). "
+        "Converting replaces each user's copied general calendar days with a date range that is "
+        "resolved against the shared calendar collections when read."
+    )
+    sample_col, run_col = st.columns(2)
+    if sample_col.button("Estimate on 200 users", use_container_width=True, key="calendar_basic_estimate"):
+        try:
+            report = migrate_calendar_basic_to_reference(st.session_state.collection, dry_run=True, limit=200)
+            _render_migration_report(report)
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Estimate failed: {exc}")
+
+    running = jobs.is_active(jobs.latest_job(CALENDAR_BASIC_JOB_KEY))
+    if run_col.button("Convert all users to ranges", type="primary", use_container_width=True, disabled=running):
+        submit_calendar_basic_job(st.session_state.collection)
+        st.toast("Basic calendar conversion started.")
+    _migration_job_progress(CALENDAR_BASIC_JOB_KEY, "Converted")
+    report = _finished_job_result(CALENDAR_BASIC_JOB_KEY, "Unable to convert calendar_basic")
+    if report is not None:
+        st.caption("Last conversion:")
+        _render_migration_report(report)
+
+
+def _render_calendar_buckets() -> None:
+    st.markdown("#### Calendar buckets")
+    st.caption(
+        f"Calendar days are stored **{config.CALENDAR_STORAGE}** (calendar.storage). "
+        f"Moving copies each user's day maps into `{BUCKET_COLLECTION_NAME}` (one document per user and "
+        "month) and removes them from the user document. Users written to mid-copy are left for the next run."
+    )
+    if config.CALENDAR_STORAGE != "bucketed":
+        st.warning("Set calendar.storage = \"bucketed\" before moving, or readers will miss the moved days.")
+    count_col, run_col = st.columns(2)
+    if count_col.button("Count users to move", use_container_width=True):
+        try:
+            st.info(f"{count_embedded_users(st.session_state.collection)} user(s) still have embedded day maps.")
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Count failed: {exc}")
+
+    running = jobs.is_active(jobs.latest_job(BUCKET_MIGRATION_JOB_KEY))
+    if run_col.button(
+        "Move day maps to buckets",
+        type="primary",
+        use_container_width=True,
+        disabled=running or config.CALENDAR_STORAGE != "bucketed",
+    ):
+        submit_bucket_migration_job(st.session_state.collection)
+        st.toast("Calendar bucket move started.")
+    _migration_job_progress(BUCKET_MIGRATION_JOB_KEY, "Moved")
+    summary = _finished_job_result(BUCKET_MIGRATION_JOB_KEY, "Unable to move calendar days")
+    if summary is not None:
+        st.write(
+            f"Last move: {summary['users']} user(s), {summary['days']} day(s) in {summary['buckets']} bucket(s); "
+            f"{summary['retry']} user(s) changed during the copy, {summary['skipped']} without line_id."
+        )
+
+
+@st.fragment(run_every=3)
+def _archive_job_progress() -> None:
+    job = jobs.latest_job(ARCHIVE_JOB_KEY)
+    if not job:
+        return
+    progress = job.get("progress") or {}
+    st.write(
+        f"Archive job **{job['status']}** (cutoff {progress.get('cutoff', '?')}): "
+        f"{progress.get('users', 0)} user(s), {progress.get('buckets', 0)} bucket(s), "
+        f"{progress.get('days', 0)} day(s) moved."
+    )
+    if job.get("error"):
+        st.error(job["error"])
+
+
+def _render_calendar_archive() -> None:
+    st.markdown("#### Calendar archive")
+    st.caption(
+        f"Moves star prediction and GPT days older than {config.ARCHIVE_HORIZON_DAYS} days "
+        f"(archive.horizon_days, currently before {archive_cutoff()}) to "
+        f"`{config.COLL_CALENDAR_ARCHIVE_NAME}`. Days in a user's current period always stay. "
+        "The calendar tab can still show archived days."
+    )
+    running = jobs.is_active(jobs.latest_job(ARCHIVE_JOB_KEY))
+    if st.button("Archive old calendar days", type="primary", use_container_width=True, disabled=running):
+        submit_archive_job(st.session_state.collection, st.session_state.collection_calendar_archive)
+        st.toast("Archive job started.")
+    _archive_job_progress()
+
+
+def _render_history_backfill() -> None:
+    st.markdown("#### Purchase history summary")
+    st.caption(
+        "Computes history_summary (first subType, purchase count, last purchase) from each user's "
+        f"history_log and copies the entries to `{config.COLL_USER_EVENTS_NAME}`. User lists read the summary "
+        "instead of the array once a user is backfilled. Run this before setting history.tail_cap."
+    )
+    running = jobs.is_active(jobs.latest_job(HISTORY_BACKFILL_JOB_KEY))
+    if st.button("Backfill history summaries", type="primary", use_container_width=True, disabled=running):
+        submit_history_backfill_job(st.session_state.collection, st.session_state.get("collection_user_events"))
+        st.toast("History backfill started.")
+    _migration_job_progress(HISTORY_BACKFILL_JOB_KEY, "Backfilled")
+    summary = _finished_job_result(HISTORY_BACKFILL_JOB_KEY, "Unable to backfill history summaries")
+    if summary is not None:
+        st.write(
+            f"Last backfill: {summary['users']} user(s), {summary['events']} history event(s) copied, "
+            f"{summary.get('repaired', 0)} empty first purchase(s) repaired."
+        )
+
+
+def missing_index_count() -> int:
+    """Missing indexes found by the latest verification (0 while it is still running)."""
+    job = jobs.latest_job(VERIFY_JOB_KEY)
+    if not job or job["status"] != "completed":
+        return 0
+    return sum(1 for row in job["result"] or [] if row["status"] == "missing")
+
+
+def _render_indexes() -> None:
+    st.markdown("#### Indexes")
+    st.caption(
+        "Indexes registered in services/indexes.py are verified in the background when the app connects"
+        + (" and created if missing." if config.MONGO_CREATE_INDEXES else "; set mongo.create_indexes to create them.")
+    )
+    job = jobs.latest_job(VERIFY_JOB_KEY)
+    client = st.session_state.get("mongo_client")
+    verify_col, create_col, explain_col = st.columns(3)
+    if verify_col.button("Verify again", use_container_width=True, disabled=jobs.is_active(job) or client is None):
+        start_index_verification(client, create=False)
+        st.rerun()
+    if create_col.button("Create missing", use_container_width=True, disabled=jobs.is_active(job) or client is None):
+        start_index_verification(client, create=True)
+        st.rerun()
+
+    if jobs.is_active(job):
+        st.info("Index verification is running...")
+    elif job and job["status"] == "failed":
+        st.error(f"Index verification failed: {job['error']}")
+    elif job:
+        frame = pd.DataFrame(job["result"] or [])
+        missing = frame[frame["status"] == "missing"] if not frame.empty else frame
+        if len(missing):
+            st.warning(f"{len(missing)} index(es) missing: " + ", ".join(missing["namespace"] + " " + missing["keys"]))
+        st.dataframe(frame, hide_index=True, use_container_width=True)
+
+    if explain_col.button("Explain hot queries", use_container_width=True, disabled=client is None):
+        try:
+            st.dataframe(pd.DataFrame(explain_hot_queries(client)), hide_index=True, use_container_width=True)
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Explain failed: {exc}")
+
+
+def _render_read_routing() -> None:
+    st.markdown("#### Read routing")
+    if config.READ_ROUTING_ENABLED:
+        st.caption(
+            f"Routes {', '.join(config.READ_SECONDARY_ROUTES)} read from secondaries "
+            f"(max staleness {read_routing.max_staleness_seconds()}s); everything else reads from the primary. "
+            "A session reads from the primary for the staleness window after its own writes."
+        )
+    else:
+        st.caption("All reads go to the primary; set read_routing.enabled to use secondaries.")
+    stats = read_routing.route_stats()
+    if stats:
+        st.dataframe(pd.DataFrame(stats), hide_index=True, use_container_width=True)
+    else:
+        st.info("No reads recorded in this process yet.")
+    if st.button("Reset latency metrics", disabled=not stats):
+        read_routing.reset_route_stats()
+        st.rerun()
+
+
+def render_maintenance_tab() -> None:
+    st.subheader("Maintenance")
+    _render_read_routing()
+    st.divider()
+    _render_indexes()
+    st.divider()
+    _render_prediction_storage()
+    st.divider()
+    _render_calendar_basic_storage()
+    st.divider()
+    _render_calendar_buckets()
+    st.divider()
+    _render_calendar_archive()
+    st.divider()
+    _render_history_backfill()
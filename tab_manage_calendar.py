@@ -1,11 +1,133 @@
 """Calendar management tab."""
 from __future__ import annotations
 
-import pandas as pd
+from datetime import date, timedelta
+from typing import List, Tuple
+
 import streamlit as st
 
-from services.calendar import ensure_calendar_entries
-from um_utils import get_user_type, refresh_current_user
+from services.calendar import (
+    ensure_calendar_entries,
+    estimate_stale_gpt_days,
+    regenerate_stale_gpt_days,
+    resolve_calendar_basic,
+)
+from services.tables import calendar_table
+from um_utils import (
+    get_user_type,
+    invalidate_user_facets,
+    load_calendar_days,
+    load_calendar_months,
+    render_table_downloads,
+)
+
+
+def _month_bounds(month: str) -> Tuple[date, date]:
+    first = date.fromisoformat(f"{month}-01")
+    return first, (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _window_table(line_id: str, start: str, end: str, fetched_at: float, _std, _gpt, _archived):
+    # Keyed by the window and its fetch stamp; the day maps themselves are not hashed.
+    return calendar_table(_std, _gpt, _archived)
+
+
+def _shift_month(key: str, months: List[str], step: int) -> None:
+    index = months.index(st.session_state[key]) + step
+    st.session_state[key] = months[max(0, min(index, len(months) - 1))]
+
+
+def _render_month_picker(line_id: str, months: List[str]) -> str:
+    key = f"calendar_month_{line_id}"
+    if st.session_state.get(key) not in months:
+        current = date.today().isoformat()[:7]
+        st.session_state[key] = current if current in months else months[-1]
+    position = months.index(st.session_state[key])
+    prev_col, month_col, next_col = st.columns([1, 2, 1])
+    prev_col.button(
+        "Previous month",
+        use_container_width=True,
+        disabled=position == 0,
+        on_click=_shift_month,
+        args=(key, months, -1),
+        key=f"{key}_prev",
+    )
+    month_col.selectbox("Month", options=months, key=key, label_visibility="collapsed")
+    next_col.button(
+        "Next month",
+        use_container_width=True,
+        disabled=position == len(months) - 1,
+        on_click=_shift_month,
+        args=(key, months, 1),
+        key=f"{key}_next",
+    )
+    return st.session_state[key]
+
+
+def _render_calendar_review(user) -> None:
+    """Range filter, month pager, and the table of the visible month (the only days fetched)."""
+    line_id = user.get("line_id") or str(user.get("_id"))
+    include_archived = st.toggle("Include archived days", key="calendar_include_archived")
+    month_days = load_calendar_months(include_archived=include_archived)
+    if not month_days:
+        st.info("This user has no stored calendar predictions yet.")
+        return
+
+    all_months = sorted(month_days)
+    first, _ = _month_bounds(all_months[0])
+    _, last = _month_bounds(all_months[-1])
+    picked = st.date_input(
+        "Date range",
+        value=(first, last),
+        min_value=first,
+        max_value=last,
+        key=f"calendar_range_{line_id}",
+    )
+    # While the second date is being picked the widget returns only the first one.
+    bounds = (list(picked) if isinstance(picked, (list, tuple)) else [picked]) or [first, last]
+    range_start, range_end = bounds[0], bounds[-1]
+    months = [
+        month
+        for month in all_months
+        if _month_bounds(month)[0] <= range_end and _month_bounds(month)[1] >= range_start
+    ]
+    if not months:
+        st.info("No calendar days in this date range.")
+        return
+
+    month = _render_month_picker(line_id, months)
+    month_start, month_end = _month_bounds(month)
+    start = max(month_start, range_start).isoformat()
+    end = min(month_end, range_end).isoformat()
+    window = load_calendar_days(start, end, include_archived=include_archived)
+    st.caption(
+        f"{month}: showing {start} to {end}. "
+        f"{sum(month_days[m] for m in months)} day(s) across {len(months)} month(s) in range."
+    )
+    table = _window_table(
+        line_id,
+        start,
+        end,
+        window["fetched_at"],
+        window.get("period_predictions") or {},
+        window.get("period_predictions_gpt") or {},
+        window["archived_dates"],
+    )
+    if table.num_rows:
+        st.dataframe(table, use_container_width=True, hide_index=True)
+        render_table_downloads(
+            table, f"calendar_{line_id}_{start}_{end}", key="calendar_table", stamp=window["fetched_at"]
+        )
+    else:
+        st.info("No prediction days in this window.")
+
+    basic = resolve_calendar_basic(window, start, end)
+    storage = "date range" if window.get("calendar_basic_range") else "copied days"
+    st.caption(
+        f"Basic calendar ({storage}): {len(basic['profile'])} profile day(s), {len(basic['holiday'])} holiday(s) "
+        "in this window."
+    )
 
 
 def render_manage_calendar_tab(user):
@@ -15,35 +137,7 @@ def render_manage_calendar_tab(user):
         st.warning("Calendar management is available only for mu insight users.")
         return
 
-    predictions_gpt = user.get("period_predictions_gpt") or {}
-    predictions_std = user.get("period_predictions") or {}
-    combined_dates = sorted(set(predictions_gpt.keys()) | set(predictions_std.keys()))
-
-    if not combined_dates:
-        st.info("This user has no stored calendar predictions yet.")
-    else:
-        rows = []
-        for date_str in combined_dates:
-            std_predictions = predictions_std.get(date_str, {})
-            std_text = ", ".join(
-                str(result.get("start_thai", "")) for result in std_predictions.values()
-            )
-            gpt_detail = predictions_gpt.get(date_str, {})
-            gpt_text = ""
-            if g_detail := gpt_detail:
-                day_name = g_detail.get("day_name", "")
-                theme = g_detail.get("theme", "")
-                gpt_text = f"{day_name} ({theme})".strip(" ()")
-
-            rows.append(
-                {
-                    "Date": date_str,
-                    "Standard": std_text,
-                    "GPT Summary": gpt_text,
-                }
-            )
-
-        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    _render_calendar_review(user)
 
     st.markdown("---")
 
@@ -67,7 +161,44 @@ def render_manage_calendar_tab(user):
                     st.warning("Calendar rebuild completed with warnings:")
                     for err in result["errors"]:
                         st.write(f"- {err}")
-                refresh_current_user()
+                # Core fields are untouched; only the calendar facets changed.
+                invalidate_user_facets("predictions", "calendar_basic", "gpt_calendar")
             except Exception as exc:  # noqa: BLE001
                 status_box.update(label="Calendar rebuild failed.", state="error")
                 st.error(f"Unable to rebuild calendar entries: {exc}")
+
+    _render_stale_regeneration(user)
+
+
+def _render_stale_regeneration(user):
+    st.markdown("#### Prompt updates")
+    st.caption(
+        "GPT days are stamped with the prompt version used to generate them. "
+        "Regenerate only the days built from an older prompt after config_prompts changes."
+    )
+
+    line_id = user.get("line_id")
+    if not line_id:
+        return
+
+    estimate_key = f"stale_gpt_estimate_{line_id}"
+    if st.button("Check for outdated GPT days", use_container_width=True):
+        try:
+            st.session_state[estimate_key] = estimate_stale_gpt_days(line_id)
+        except Exception as exc:  # noqa: BLE001
+            st.error(f"Unable to estimate regeneration: {exc}")
+
+    estimate = st.session_state.get(estimate_key)
+    if not estimate:
+        return
+
+    pending = estimate.get("pending_dates", 0)
+    st.write(
+        f"Prompt version **{estimate.get('prompt_version')}**: {pending} day(s) outdated or missing, "
+        f"{estimate.get('up_to_date', 0)} up to date. "
+        f"Estimated cost about ${estimate.get('estimated_cost_usd', 0):.2f}."
+    )
+    if st.button("Regenerate outdated GPT days", use_container_width=True, disabled=not pending):
+        response = regenerate_stale_gpt_days(line_id)
+        st.session_state.pop(estimate_key, None)
+        st.info(response.get("message") or "Regeneration queued.")
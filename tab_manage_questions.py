@@ -7,13 +7,13 @@ from bson.objectid import ObjectId
 import pandas as pd
 import streamlit as st
 
-from um_utils import refresh_current_user
+from um_utils import load_user_facet, update_current_user
 
 
 def render_manage_questions_tab():
     st.subheader("Manage stored questions for this user")
 
-    questions_data: List[dict] = st.session_state.get("user_questions", [])
+    questions_data: List[dict] = load_user_facet("questions")
     if not questions_data:
         st.info("This user has no custom questions yet.")
         return
@@ -42,13 +42,11 @@ def render_manage_questions_tab():
         with st.status(f"Deleting {len(ids)} question(s)...", expanded=False) as status_box:
             try:
                 result = st.session_state.collection_questions.delete_many({"_id": {"$in": ids}})
-                st.session_state.collection.update_one(
-                    {"_id": ObjectId(st.session_state.selected_id)},
-                    {"$inc": {"user_question_left": result.deleted_count}},
-                )
+                update_current_user({"$inc": {"user_question_left": result.deleted_count}})
+                removed = set(to_delete_ids)
+                questions_data[:] = [row for row in questions_data if row["id"] not in removed]
                 status_box.update(label="Questions deleted.", state="complete")
                 st.toast(f"Removed {result.deleted_count} question(s).")
-                refresh_current_user()
             except Exception as exc:  # noqa: BLE001
                 status_box.update(label="Deletion failed.", state="error")
                 st.error(f"Unable to delete questions: {exc}")
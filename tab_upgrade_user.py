@@ -5,11 +5,21 @@ from typing import Any, Dict
 
 import streamlit as st
 
-from services.calendar import ensure_calendar_entries
+from services import jobs
+from services.calendar import calendar_job_key
 from services.packages import list_packages
-from services.transactions import record_transaction
-from services.upgrade import apply_package_upgrade
-from um_utils import gen_reference_id, get_user_type, now_iso_ms_z, refresh_current_user
+from services.upgrade import run_upgrade_pipeline
+from um_utils import (
+    USER_CORE_PROJECTION,
+    apply_user_patch,
+    gen_reference_id,
+    get_user_type,
+    invalidate_user_facets,
+    now_iso_ms_z,
+)
+
+JOB_POLL_SECONDS = 2
+CALENDAR_FACETS = ("predictions", "calendar_basic", "gpt_calendar")
 
 
 def _format_package_label(pkg: Dict) -> str:
@@ -21,97 +31,29 @@ def _format_package_label(pkg: Dict) -> str:
     return f"{title} (THB {price})"
 
 
-def render_upgrade_user_tab(user):
-    st.subheader("Upgrade package and token allowance")
-
-    current_user_type = get_user_type(user)
-    if current_user_type == "mu insight":
-        period_info = user.get("period_available") or {}
-        start_date = period_info.get("start_date")
-        end_date = period_info.get("end_date")
-        if start_date and end_date:
-            st.success(f"This user already has an active mu insight package ({start_date} to {end_date}).")
-        else:
-            st.success("This user already has an active mu insight package.")
-    else:
-        st.info("This user is currently on a basic package.")
-
-    st.markdown("---")
-
-    packages = list_packages()
-    if not packages:
-        st.error("Package configuration is empty. Update services/packages.py.")
-        return
-
-    with st.form("upgrade_form"):
-        selected_idx = st.selectbox(
-            "Choose a package",
-            options=list(range(len(packages))),
-            format_func=lambda idx: _format_package_label(packages[idx]),
-        )
-        submitted = st.form_submit_button("Apply upgrade", use_container_width=True, type="primary")
+STEP_LABELS = {
+    "read": "Read user",
+    "calendar": "Prepare star predictions and basic calendar",
+    "write": "Apply upgrade, tokens and calendar",
+    "transaction": "Record transaction",
+    "gpt": "Trigger GPT calendar",
+}
 
-    if not submitted:
-        return
 
-    selected_package = packages[selected_idx]
-    line_id = user.get("line_id")
-    if not line_id:
-        st.error("The user record is missing a LINE ID.")
-        return
-
-    timestamp_iso = now_iso_ms_z()
-    reference_id = gen_reference_id()
-    sub_type = "standard"
-    payment_type = "free"
-
-    with st.status("Processing...", expanded=True) as status_box:
-        status_box.write("1. Upgrade to mu insight")
-        # Step 1: upgrade package (also extends mu insight period)
-        try:
-            result = apply_package_upgrade(
-                user,
-                selected_package["id"],
-                reference_id=reference_id,
-                timestamp_iso=timestamp_iso,
-                sub_type=sub_type,
-                payment_type=payment_type,
-            )
-            status_box.write("    Upgrade to mu insight")
-        except Exception as exc:  # noqa: BLE001
-            status_box.update(label="Upgrade failed.", state="error")
-            st.error(f"Unable to apply the upgrade: {exc}")
-            return
-
-        status_box.write("2. Add Token")
-        token_delta = result.get("extra_tokens", 0)
-        new_balance = result.get("new_token_balance")
-        status_box.write(f"    Add Token (delta {token_delta}, new balance {new_balance})")
-
-    updated_user = st.session_state.collection.find_one({"_id": user["_id"]}) or user
-
-    calendar_result: Dict[str, Any] = {}
-    status_box.write("3. Add Basic Calendar")
-    basic_ok = False
-    try:
-        calendar_result = ensure_calendar_entries(
-            updated_user,
-            result.get("calendar_start_date", result["start_date"]),
-            result["end_date"],
-        )
-        star_days = calendar_result.get("updated_days", 0) or 0
-        basic_days = calendar_result.get("basic_profile_days", 0) or 0
-        holiday_days = calendar_result.get("basic_holiday_days", 0) or 0
-        status_box.write(
+def _write_calendar_report(out, calendar_result: Dict[str, Any], basic_ok: bool) -> bool:
+    """Write steps 3-4 of the upgrade report to ``out``; returns False when anything failed."""
+    out.write("3. Add Basic Calendar")
+    star_days = calendar_result.get("updated_days", 0) or 0
+    basic_days = calendar_result.get("basic_profile_days", 0) or 0
+    holiday_days = calendar_result.get("basic_holiday_days", 0) or 0
+    if basic_ok:
+        out.write(
             f"    Add Basic Calendar (star {star_days}, profile {basic_days}, holiday {holiday_days})"
         )
-        basic_ok = True
-    except Exception as exc:  # noqa: BLE001
-        status_box.write(f"    Add Basic Calendar failed: {exc}")
-        calendar_result = {}
-
+    else:
+        out.write("    Add Basic Calendar failed.")
 
-    status_box.write("4. Add GPT Calendar")
+    out.write("4. Add GPT Calendar")
     gpt_details_raw = calendar_result.get("gpt_details") if isinstance(calendar_result, dict) else None
 
     status_sources = []
@@ -143,15 +85,15 @@ def render_upgrade_user_tab(user):
     gpt_status = _first_from_sources("status")
     gpt_triggered = bool(basic_ok and gpt_status in success_statuses)
     if gpt_triggered:
-        status_box.write("    Add GPT Calendar request submitted.")
+        out.write("    Add GPT Calendar request submitted.")
     elif gpt_status == "error":
         error_message = _first_from_sources("message") or "unknown error"
-        status_box.write(f"    Add GPT Calendar failed: {error_message}")
+        out.write(f"    Add GPT Calendar failed: {error_message}")
     elif gpt_status == "skipped":
         skip_message = _first_from_sources("message") or "GPT calendar skipped."
-        status_box.write(f"    Add GPT Calendar skipped: {skip_message}")
+        out.write(f"    Add GPT Calendar skipped: {skip_message}")
     else:
-        status_box.write("    Add GPT Calendar did not start. Check configuration or logs.")
+        out.write("    Add GPT Calendar did not start. Check configuration or logs.")
 
     if isinstance(gpt_details_raw, dict):
         info_parts = []
@@ -165,6 +107,16 @@ def render_upgrade_user_tab(user):
         failed_count = _first_from_sources("failed_count")
         if failed_count:
             info_parts.append(f"failed {failed_count}")
+        cache_info = _first_from_sources("cache")
+        if isinstance(cache_info, dict) and (cache_info.get("hits") or cache_info.get("misses")):
+            info_parts.append(
+                f"cache hit rate {cache_info.get('hit_rate', 0):.0%} (saved ${cache_info.get('saved_usd', 0):.2f})"
+            )
+        validation_info = _first_from_sources("validation")
+        if isinstance(validation_info, dict) and validation_info.get("days_incomplete"):
+            info_parts.append(
+                f"repaired {validation_info.get('days_repaired', 0)}/{validation_info.get('days_incomplete', 0)} incomplete day(s)"
+            )
         queue_size = _first_from_sources("queue_size")
         if queue_size is not None:
             info_parts.append(f"queue size {queue_size}")
@@ -172,14 +124,14 @@ def render_upgrade_user_tab(user):
         if line_ref:
             info_parts.append(f"line_id {line_ref}")
         if info_parts:
-            status_box.write("    Details: " + " | ".join(str(part) for part in info_parts))
+            out.write("    Details: " + " | ".join(str(part) for part in info_parts))
 
         last_request = _first_from_sources("last_request")
         if isinstance(last_request, dict):
             request_date = last_request.get("date", "unknown date")
             request_status = last_request.get("status", "unknown")
             request_message = last_request.get("message", "")
-            status_box.write(
+            out.write(
                 f"    Last request: {request_date} ({request_status}) {request_message}".strip()
             )
 
@@ -192,28 +144,163 @@ def render_upgrade_user_tab(user):
                 failures = failure_list
                 break
         if failures:
-            status_box.write("    Recent GPT failures:")
+            out.write("    Recent GPT failures:")
             for failure in failures:
                 failure_date = failure.get("date", "unknown date")
                 failure_msg = failure.get("error", "unknown error")
-                status_box.write(f"      - {failure_date}: {failure_msg}")
+                out.write(f"      - {failure_date}: {failure_msg}")
     errors = calendar_result.get("errors") if isinstance(calendar_result, dict) else None
     if errors:
-        status_box.write("    Calendar update completed with warnings:")
+        out.write("    Calendar update completed with warnings:")
         for err in errors if isinstance(errors, list) else [errors]:
-            status_box.write(f"     - {err}")
+            out.write(f"     - {err}")
 
     failed_count_value = 0
-    if '_first_from_sources' in locals():
-        failed_raw = _first_from_sources("failed_count")
+    failed_raw = _first_from_sources("failed_count")
+    try:
+        failed_count_value = int(failed_raw or 0)
+    except (TypeError, ValueError):
+        failed_count_value = 0
+
+    return basic_ok and gpt_status != "error" and failed_count_value == 0
+
+
+def render_upgrade_user_tab(user):
+    st.subheader("Upgrade package and token allowance")
+
+    current_user_type = get_user_type(user)
+    if current_user_type == "mu insight":
+        period_info = user.get("period_available") or {}
+        start_date = period_info.get("start_date")
+        end_date = period_info.get("end_date")
+        if start_date and end_date:
+            st.success(f"This user already has an active mu insight package ({start_date} to {end_date}).")
+        else:
+            st.success("This user already has an active mu insight package.")
+    else:
+        st.info("This user is currently on a basic package.")
+
+    st.markdown("---")
+
+    packages = list_packages()
+    if not packages:
+        st.error("Package configuration is empty. Update services/packages.py.")
+        return
+
+    with st.form("upgrade_form"):
+        selected_idx = st.selectbox(
+            "Choose a package",
+            options=list(range(len(packages))),
+            format_func=lambda idx: _format_package_label(packages[idx]),
+        )
+        submitted = st.form_submit_button("Apply upgrade", use_container_width=True, type="primary")
+
+    if submitted:
+        _apply_upgrade(user, packages[selected_idx])
+
+    _render_calendar_job(user.get("line_id"))
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def _calendar_job_progress(line_id: str) -> None:
+    """Poll the running calendar job without rerunning the whole script."""
+    job = jobs.latest_job(calendar_job_key(line_id))
+    if not jobs.is_active(job):
+        # Finished: one full rerun swaps this poller for the static report and
+        # lets the calendar tab reload the facets the job wrote.
+        invalidate_user_facets(*CALENDAR_FACETS)
+        st.rerun()
+
+    progress = job["progress"]
+    done = int(progress.get("days_done") or 0)
+    total = int(progress.get("days_total") or 0)
+    if job["status"] == "queued":
+        text = "Calendar job queued..."
+    elif progress.get("stage") == "gpt":
+        text = f"Star and basic calendar done ({done} day(s)); triggering GPT calendar..."
+    else:
+        text = f"Building calendar: {done}/{total or '?'} day(s)"
+    st.progress(min(done / total, 1.0) if total else 0.0, text=text)
+    errors = int(progress.get("errors") or 0)
+    if errors:
+        st.caption(f"{errors} day(s) failed so far.")
+
+
+def _render_calendar_job(line_id: str | None) -> None:
+    if not line_id:
+        return
+    job = jobs.latest_job(calendar_job_key(line_id))
+    if job is None:
+        return
+
+    st.markdown("#### Calendar build")
+    if jobs.is_active(job):
+        _calendar_job_progress(line_id)
+        return
+
+    # A job that picked up a later upgrade reports the range it ran last.
+    bounds = {**(job.get("meta") or {}), **(job.get("progress") or {})}
+    period = f"{bounds.get('start_date')} to {bounds.get('end_date')}"
+    if job["status"] == "failed":
+        st.error(f"Calendar build for {period} failed: {job.get('error')}")
+        return
+    with st.expander(f"Calendar build for {period} finished", expanded=False):
+        ok = _write_calendar_report(st, job.get("result") or {}, True)
+        if not ok:
+            st.warning("The calendar build finished with errors. Review the steps above.")
+
+
+def _apply_upgrade(user, selected_package: Dict[str, Any]) -> None:
+    line_id = user.get("line_id")
+    if not line_id:
+        st.error("The user record is missing a LINE ID.")
+        return
+
+    timestamp_iso = now_iso_ms_z()
+    reference_id = gen_reference_id()
+    sub_type = "standard"
+    payment_type = "free"
+
+    with st.status("Processing...", expanded=True) as status_box:
+        def _report_step(step: str, elapsed_ms: float) -> None:
+            status_box.write(f"    {STEP_LABELS.get(step, step)} ({elapsed_ms:.0f} ms)")
+
+        status_box.write("1. Upgrade to mu insight")
         try:
-            failed_count_value = int(failed_raw or 0)
-        except (TypeError, ValueError):
-            failed_count_value = 0
+            result = run_upgrade_pipeline(
+                user["_id"],
+                selected_package["id"],
+                reference_id=reference_id,
+                timestamp_iso=timestamp_iso,
+                sub_type=sub_type,
+                payment_type=payment_type,
+                projection=USER_CORE_PROJECTION,
+                on_step=_report_step,
+            )
+        except Exception as exc:  # noqa: BLE001
+            status_box.update(label="Upgrade failed.", state="error")
+            st.error(f"Unable to apply the upgrade: {exc}")
+            return
+
+        status_box.write("2. Add Token")
+        token_delta = result.get("extra_tokens", 0)
+        new_balance = result.get("new_token_balance")
+        status_box.write(f"    Add Token (delta {token_delta}, new balance {new_balance})")
 
-    final_state = "complete"
-    if not basic_ok or gpt_status == "error" or failed_count_value > 0:
-        final_state = "error"
+    updated_user = result.get("user") or user
+
+    calendar_result: Dict[str, Any] = result.get("calendar_result") or {}
+    calendar_job_id = result.get("calendar_job_id")
+    if calendar_job_id:
+        status_box.write("3. Add Basic Calendar / 4. Add GPT Calendar")
+        status_box.write("    Running in the background; progress is shown below.")
+        for err in calendar_result.get("errors") or []:
+            status_box.write(f"     - {err}")
+        calendar_ok = True
+    else:
+        calendar_ok = _write_calendar_report(status_box, calendar_result, bool(result.get("calendar_ok")))
+
+    final_state = "complete" if calendar_ok else "error"
 
     status_box.update(label="Processing complete." if final_state == "complete" else "Processing finished with errors.", state=final_state)
     if final_state == "complete":
@@ -221,22 +308,14 @@ def render_upgrade_user_tab(user):
     else:
         st.warning("Upgrade workflow finished with errors. Review the steps above.")
 
-    try:
-        record_transaction(
-            user=updated_user,
-            package=selected_package,
-            reference_id=reference_id,
-            timestamp_iso=timestamp_iso,
-            sub_type=sub_type,
-            payment_type=payment_type,
-        )
-    except Exception as exc:  # noqa: BLE001
-        st.warning(f"Failed to record transaction: {exc}")
+    if not result.get("transaction_recorded"):
+        st.warning("The transaction record was not written. Review the warnings above.")
 
-    refresh_current_user()
+    apply_user_patch(updated_user, stale_facets=("history",) + CALENDAR_FACETS)
 
     summary = dict(result)
     summary["package"] = selected_package.get("title")
     summary["reference_id"] = reference_id
     summary["calendar_result"] = calendar_result
+    summary.pop("user", None)
     st.json(summary, expanded=False)
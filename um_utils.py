@@ -3,14 +3,30 @@ from __future__ import annotations
 
 import secrets
 import string
+import time
 from datetime import datetime, timezone
 from typing import Any, Dict, Iterable, Tuple
 
 from bson.objectid import ObjectId
-from pymongo import MongoClient
+import pyarrow as pa
+from pymongo import MongoClient, ReturnDocument
 import streamlit as st
 
 import config
+from services import calendar_store, read_routing
+from services.archive import archived_month_counts, load_archived_days
+from services.autocomplete import AutocompleteIndex
+from services.calendar import calendar_months, load_calendar_window
+from services.history import first_sub_type
+from services.indexes import start_index_verification
+from services.search import search_users_page
+from services.tables import (
+    drop_search_rows,
+    patch_search_rows,
+    search_rows_table,
+    table_to_csv,
+    table_to_parquet,
+)
 
 
 @st.cache_resource(show_spinner=False)
@@ -21,20 +37,37 @@ def get_db() -> Tuple[Any, MongoClient]:
     client = MongoClient(config.MONGO_URI, serverSelectionTimeoutMS=4000)
     client.admin.command("ping")
     db = client[config.DB_NAME]
+    # Checked once per process, off the script thread; results show in the Maintenance workspace.
+    start_index_verification(client)
     return db, client
 
 
+@st.cache_resource(show_spinner=False)
+def get_autocomplete_index() -> AutocompleteIndex:
+    """Process-wide name index; built on a background thread so startup is not blocked."""
+    db, _ = get_db()
+    index = AutocompleteIndex(read_routing.routed(db[config.COLL_NAME], "search"), refresh_seconds=config.SEARCH_AUTOCOMPLETE_REFRESH_SECONDS)
+    index.start()
+    return index
+
+
 def ensure_session() -> None:
     """Initialise Streamlit session state with the keys our UI expects."""
     defaults = {
         "kw": "",
         "kw_submit": "",
         "do_search": False,
-        "search_results": [],
+        "search_results": None,
+        "search_results_stamp": None,
+        "search_page_size": 50,
+        "search_page_index": 0,
+        "search_page_cursors": [None],
+        "search_has_more": False,
+        "search_total": None,
         "selected_id": None,
         "found_user": None,
         "connected": False,
-        "user_questions": [],
+        "user_facets": {},
     }
     for key, value in defaults.items():
         st.session_state.setdefault(key, value)
@@ -64,29 +97,228 @@ def as_int(value: Any, default: int = 0) -> int:
 
 
 def get_user_type(doc: Dict[str, Any]) -> str:
-    """Infer the user type from the history log."""
-    history = doc.get("history_log") or []
-    first_entry = history[0] if history else None
-    if isinstance(first_entry, dict):
-        if str(first_entry.get("subType", "")).strip().lower() == "standard":
-            return "mu insight"
+    """Infer the user type from the first purchase (history summary or history log)."""
+    if str(first_sub_type(doc) or "").strip().lower() == "standard":
+        return "mu insight"
     return "basic"
 
 
+def to_search_row(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce a projected user document to one row of ``services.tables.SEARCH_ROW_SCHEMA``."""
+    return {
+        "doc_id": str(doc.get("_id")),
+        "name": str(doc.get("user_profiles") or ""),
+        "line_id": str(doc.get("line_id") or ""),
+        "tokens": as_int(doc.get("user_question_left", 0)),
+        "user_type": get_user_type(doc),
+        "sort_name": doc.get("search_name"),
+    }
+
+
+def mark_user_write() -> None:
+    """Note that this session just wrote, so its next reads go to the primary."""
+    st.session_state.last_write_at = time.monotonic()
+
+
+def read_collection(collection, route: str):
+    """``collection`` routed for ``route``; stays on the primary shortly after this session wrote."""
+    last_write = st.session_state.get("last_write_at")
+    fresh = last_write is not None and time.monotonic() - last_write < read_routing.max_staleness_seconds()
+    return read_routing.routed(collection, route, fresh=fresh)
+
+
+def _set_search_results(table: pa.Table) -> None:
+    st.session_state.search_results = table
+    # Changes with every new or patched page, so cached downloads are rebuilt.
+    st.session_state.search_results_stamp = time.time()
+
+
+def load_search_page(keyword: str) -> pa.Table:
+    """Fetch the current search page (per session cursor state) into session state as an Arrow table."""
+    collection = read_collection(st.session_state.collection, "search")
+    cursors = st.session_state.search_page_cursors or [None]
+    page_index = min(st.session_state.search_page_index, len(cursors) - 1)
+    with read_routing.timed("search"):
+        docs, has_more = search_users_page(
+            collection,
+            keyword,
+            page_size=int(st.session_state.search_page_size),
+            after=cursors[page_index],
+        )
+    table = search_rows_table(docs)
+    _set_search_results(table)
+    st.session_state.search_has_more = has_more
+    return table
+
+
+# Heavy maps stay in Mongo until a tab asks for them; get_user_type reads
+# history_summary, or the first history entry for users not yet backfilled.
+USER_CORE_PROJECTION = {
+    "period_predictions": 0,
+    "period_predictions_gpt": 0,
+    "calendar_basic": 0,
+    "detail": 0,
+    "history_log": {"$slice": 1},
+}
+USER_FACET_PROJECTIONS = {
+    "history": {"history_log": 1},
+    "predictions": {"period_predictions": 1},
+    "gpt_calendar": {"period_predictions_gpt": 1},
+    "calendar_basic": {"calendar_basic": 1, "calendar_basic_range": 1},
+}
+# Read route per facet (see services/read_routing.py); unlisted facets read as "profile".
+FACET_ROUTES = {
+    "predictions": "calendar",
+    "gpt_calendar": "calendar",
+    "calendar_basic": "calendar",
+}
+
+
 def _fetch_user_questions(line_id: str, collection) -> Iterable[Dict[str, Any]]:
-    cursor = collection.find({"line_id": line_id})
+    cursor = collection.find({"line_id": line_id}, {"dict_prompt.question": 1})
     for doc in cursor:
         dict_prompt = doc.get("dict_prompt") or {}
         question_text = dict_prompt.get("question", "N/A")
         yield {"id": str(doc["_id"]), "question": question_text}
 
 
+def _facet_cache() -> Dict[str, Any]:
+    selected_id = st.session_state.get("selected_id")
+    facets = st.session_state.setdefault("user_facets", {})
+    if not selected_id:
+        return {}
+    return facets.setdefault(selected_id, {})
+
+
+def load_user_facet(name: str) -> Any:
+    """
+    Return one facet of the selected user, fetching it with a projection on first use.
+
+    ``questions`` yields the user's stored questions; every other facet yields
+    the projected user document (e.g. ``{"period_predictions": {...}}``). The
+    calendar review reads date windows instead (``load_calendar_days``).
+    """
+    cache = _facet_cache()
+    if name in cache:
+        return cache[name]
+
+    user = st.session_state.get("found_user") or {}
+    route = FACET_ROUTES.get(name, "profile")
+    with read_routing.timed(route):
+        if name == "questions":
+            line_id = user.get("line_id")
+            questions = read_collection(st.session_state.collection_questions, route)
+            value = list(_fetch_user_questions(line_id, questions)) if line_id else []
+        elif name in USER_FACET_PROJECTIONS:
+            collection = read_collection(st.session_state.collection, route)
+            value = collection.find_one({"_id": user.get("_id")}, USER_FACET_PROJECTIONS[name]) or {}
+            day_maps = [field for field in USER_FACET_PROJECTIONS[name] if field in calendar_store.USER_MAP_ROOTS]
+            if day_maps and calendar_store.is_bucketed() and user.get("line_id"):
+                # Same shape as the embedded facet; maps not yet migrated are merged in.
+                value.update(
+                    calendar_store.read_day_maps(
+                        user["line_id"],
+                        day_maps,
+                        embedded=value,
+                        database=read_collection(st.session_state.collection.database, route),
+                    )
+                )
+        else:
+            raise KeyError(f"Unknown user facet: {name}")
+
+    cache[name] = value
+    return value
+
+
+def invalidate_user_facets(*names: str) -> None:
+    """Drop cached facets of the selected user (all of them when no names are given)."""
+    mark_user_write()
+    cache = _facet_cache()
+    if not names:
+        cache.clear()
+    for name in names:
+        cache.pop(name, None)
+    if set(names) & set(FACET_ROUTES):
+        # Windowed calendar reads are derived from the same maps.
+        for key in [key for key in cache if isinstance(key, tuple) and key[0] in CALENDAR_WINDOW_FACETS]:
+            cache.pop(key)
+
+
+# Windowed calendar reads, cached per (facet, *arguments) next to the named facets.
+CALENDAR_WINDOW_FACETS = ("calendar_months", "calendar_window")
+
+
+def load_calendar_months(*, include_archived: bool = False) -> Dict[str, int]:
+    """``{"YYYY-MM": days}`` for the selected user's calendar review, from date keys only."""
+    cache = _facet_cache()
+    key = ("calendar_months", include_archived)
+    if key in cache:
+        return cache[key]
+
+    user = st.session_state.get("found_user") or {}
+    line_id = user.get("line_id")
+    with read_routing.timed("calendar"):
+        months = calendar_months(
+            read_collection(st.session_state.collection, "calendar"),
+            user.get("_id"),
+            line_id=line_id,
+            database=read_collection(st.session_state.collection.database, "calendar"),
+        )
+        if include_archived and line_id:
+            archive = read_collection(st.session_state.collection_calendar_archive, "calendar")
+            for month, days in archived_month_counts(archive, line_id).items():
+                months[month] = months.get(month, 0) + days
+
+    cache[key] = months
+    return months
+
+
+def load_calendar_days(start_date: str, end_date: str, *, include_archived: bool = False) -> Dict[str, Any]:
+    """
+    The selected user's calendar days between two ISO dates.
+
+    Returns the ``load_calendar_window`` document plus ``archived_dates`` (days
+    only found in the archive) and ``fetched_at``, a stamp that changes whenever
+    the window is fetched again.
+    """
+    cache = _facet_cache()
+    key = ("calendar_window", start_date, end_date, include_archived)
+    if key in cache:
+        return cache[key]
+
+    user = st.session_state.get("found_user") or {}
+    line_id = user.get("line_id")
+    with read_routing.timed("calendar"):
+        window = load_calendar_window(
+            read_collection(st.session_state.collection, "calendar"),
+            user.get("_id"),
+            start_date,
+            end_date,
+            line_id=line_id,
+            database=read_collection(st.session_state.collection.database, "calendar"),
+        )
+        archived_dates: set = set()
+        if include_archived and line_id:
+            archive = read_collection(st.session_state.collection_calendar_archive, "calendar")
+            archived = load_archived_days(archive, line_id, start_date, end_date)
+            hot_dates = set().union(*(window.get(field) or {} for field in archived))
+            for field, days in archived.items():
+                archived_dates.update(days)
+                # Hot days win if a day exists in both places (e.g. mid-archive).
+                window[field] = {**days, **(window.get(field) or {})}
+            archived_dates -= hot_dates
+        window["archived_dates"] = sorted(archived_dates)
+        window["fetched_at"] = time.time()
+
+    cache[key] = window
+    return window
+
+
 def load_user_data(doc_id: str) -> Tuple[bool, str]:
-    """Load a user document and associated questions into session state."""
+    """Load the core fields of a user into session state; other facets load on demand."""
     try:
         collection = st.session_state.collection
-        questions_collection = st.session_state.collection_questions
-    except KeyError as exc:
+    except (KeyError, AttributeError) as exc:
         return False, f"Session state is missing required key: {exc}"
 
     try:
@@ -94,21 +326,63 @@ def load_user_data(doc_id: str) -> Tuple[bool, str]:
     except Exception:
         return False, "Invalid document identifier."
 
-    user = collection.find_one({"_id": object_id})
+    with read_routing.timed("profile"):
+        user = read_collection(collection, "profile").find_one({"_id": object_id}, USER_CORE_PROJECTION)
     if not user:
         return False, "User not found."
 
     st.session_state.selected_id = doc_id
     st.session_state.found_user = user
-
-    if user.get("line_id"):
-        st.session_state.user_questions = list(_fetch_user_questions(user["line_id"], questions_collection))
-    else:
-        st.session_state.user_questions = []
+    # Facets are per user; keep only the selected one so switching users cannot leak data.
+    st.session_state.user_facets = {doc_id: {}}
 
     return True, "User loaded."
 
 
+def patch_search_row(doc: Dict[str, Any]) -> None:
+    """Replace the matching row of the current search page with fields from ``doc``."""
+    table = st.session_state.get("search_results")
+    if table is not None:
+        _set_search_results(patch_search_rows(table, to_search_row(doc)))
+
+
+def drop_search_row(doc_id: str) -> None:
+    mark_user_write()
+    table = st.session_state.get("search_results")
+    if table is not None:
+        _set_search_results(drop_search_rows(table, doc_id))
+
+
+def apply_user_patch(doc: Dict[str, Any], *, stale_facets: Iterable[str] = ()) -> None:
+    """Install a post-update core document as ``found_user`` and sync dependent state."""
+    st.session_state.found_user = doc
+    invalidate_user_facets(*stale_facets)  # also marks the session as having written
+    patch_search_row(doc)
+
+
+def update_current_user(
+    update: Dict[str, Any],
+    *,
+    stale_facets: Iterable[str] = (),
+) -> Dict[str, Any] | None:
+    """
+    Apply ``update`` to the selected user in one round trip.
+
+    The post-update core fields replace ``found_user`` and the search row; facets
+    named in ``stale_facets`` are dropped so they reload on next use.
+    """
+    user = st.session_state.get("found_user") or {}
+    doc = st.session_state.collection.find_one_and_update(
+        {"_id": user.get("_id")},
+        update,
+        projection=USER_CORE_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc:
+        apply_user_patch(doc, stale_facets=stale_facets)
+    return doc
+
+
 def refresh_current_user() -> Tuple[bool, str]:
     """Reload active user data and re-run the latest search query."""
     collection = st.session_state.get("collection")
@@ -122,10 +396,52 @@ def refresh_current_user() -> Tuple[bool, str]:
     keyword = (st.session_state.get("kw_submit") or "").strip()
     if keyword:
         try:
-            st.session_state.search_results = list(
-                collection.find({"user_profiles": {"$regex": keyword, "$options": "i"}}, limit=200)
-            )
+            load_search_page(keyword)
         except Exception as exc:  # noqa: BLE001
             return False, f"Unable to refresh search results: {exc}"
 
     return True, "Refreshed."
+
+
+def _prepare_downloads(key: str, stamp: Any) -> None:
+    st.session_state[f"{key}_downloads"] = {"stamp": stamp}
+
+
+def render_table_downloads(table, basename: str, *, key: str, stamp: Any) -> None:
+    """
+    CSV and Parquet download buttons for an Arrow table.
+
+    The files are only encoded once the user asks for them, and are kept in
+    session state until ``stamp`` (which changes whenever the table is fetched
+    or patched) moves on.
+    """
+    state_key = f"{key}_downloads"
+    payloads = st.session_state.get(state_key)
+    if not payloads or payloads["stamp"] != stamp:
+        st.button(
+            "Prepare CSV / Parquet downloads",
+            use_container_width=True,
+            key=f"{key}_prepare",
+            on_click=_prepare_downloads,
+            args=(key, stamp),
+        )
+        return
+    if "csv" not in payloads:
+        payloads.update(csv=table_to_csv(table), parquet=table_to_parquet(table))
+    csv_col, parquet_col = st.columns(2)
+    csv_col.download_button(
+        "Download CSV",
+        data=payloads["csv"],
+        file_name=f"{basename}.csv",
+        mime="text/csv",
+        use_container_width=True,
+        key=f"{key}_csv",
+    )
+    parquet_col.download_button(
+        "Download Parquet",
+        data=payloads["parquet"],
+        file_name=f"{basename}.parquet",
+        mime="application/vnd.apache.parquet",
+        use_container_width=True,
+        key=f"{key}_parquet",
+    )